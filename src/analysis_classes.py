@@ -3,14 +3,31 @@ Classes for ROI data analysis.
 """
 
 import os
-import zarr
+from typing import Optional
+
 import numpy as np
 
+import cropping
+import profiling
+import storage
+from zone_statistics import zone_statistics
+
 PIXEL_SIZE = 0.325
 
 
 class RoiAnalyzer:
-    def __init__(self, zarr_path: str, mix: str, apical_type: str, roi: str):
+    stage = "analysis"
+
+    def __init__(
+        self,
+        zarr_path: str,
+        mix: str,
+        apical_type: str,
+        roi: str,
+        raw_data: Optional[np.ndarray] = None,
+        roi_mask: Optional[np.ndarray] = None,
+        zones: Optional[dict] = None,
+    ):
         self.zarr_path = zarr_path
 
         assert apical_type in ["apical_in", "apical_out"], "Invalid apical type."
@@ -19,61 +36,192 @@ class RoiAnalyzer:
         self.roi_path = f"{mix}/{apical_type}/{roi}"
 
         try:
-            self.root = zarr.open(zarr_path, mode="r")
+            self.root = profiling.open_zarr(zarr_path, mode="r")
         except FileNotFoundError:
             raise ValueError(f"Zarr file not found at {zarr_path}")
 
+        # arrays already held in memory, e.g. by the fused pipeline
+        self.raw_data = raw_data
+        self.roi_mask = roi_mask
+        self.zones = zones
+
+    def _load_channels(self, crop: tuple) -> list:
+        """
+        Returns the cropped Cy3 and AF647 planes. Only those channels within the crop
+        are read from the Zarr file.
+        """
+        if self.raw_data is not None:
+            return [self.raw_data[crop + (c,)] for c in (1, 2)]
+        dataset = self.root[self.roi_path]["raw_data"]
+        return [storage.read_channel(dataset, c, crop) for c in (1, 2)]
+
+    def _load_roi_mask(self) -> np.ndarray:
+        if self.roi_mask is not None:
+            return self.roi_mask
+        return self.root[self.roi_path]["segmentation"]["mask"][:]
+
+    @profiling.profiled_stage
     def analyze(self) -> dict:
-        raw_data = self.root[self.roi_path]["raw_data"][:]
-        cy3 = raw_data[:, :, 1]
-        af647 = raw_data[:, :, 2]
-
-        roi_mask = self.root[self.roi_path]["segmentation"]["mask"][:]
-        outer_zone_mask = self.root[self.roi_path]["segmentation"]["zones"]["outer"][:]
+        roi_mask = self._load_roi_mask()
+
+        zones = self.zones
+        if zones is None:
+            zones_group = self.root[self.roi_path]["segmentation"]["zones"]
+            zones = {"outer": zones_group["outer"][:]}
+            if self.apical_type == "apical_in":
+                if "inner_manual" in zones_group:
+                    zones["inner_manual"] = zones_group["inner_manual"][:]
+                else:
+                    zones["inner"] = zones_group["inner"][:]
+
+        outer_zone_mask = zones["outer"]
         if self.apical_type == "apical_in":
-            if "inner_manual" in self.root[self.roi_path]["segmentation"]["zones"]:
-                inner_zone_mask = self.root[self.roi_path]["segmentation"]["zones"][
-                    "inner_manual"
-                ][:]
+            if zones.get("inner_manual") is not None:
+                inner_zone_mask = zones["inner_manual"]
             else:
-                inner_zone_mask = self.root[self.roi_path]["segmentation"]["zones"][
-                    "inner"
-                ][:]
+                inner_zone_mask = zones["inner"]
+        else:
+            inner_zone_mask = None
+
+        zones = [roi_mask, outer_zone_mask]
+        if inner_zone_mask is not None:
+            zones.append(inner_zone_mask)
+        # pixels outside all zones do not contribute, so only the bounding box of the
+        # zones is read and measured
+        crop = cropping.mask_crop(np.logical_or.reduce(zones))
+        channels = self._load_channels(crop)
+
+        return self._measure(channels, crop, roi_mask, outer_zone_mask, inner_zone_mask)
+
+    @profiling.profiled_stage
+    def analyze_thicknesses(self, thicknesses: list) -> list:
+        """
+        Measures the ROI for every zone thickness in `thicknesses`.
+
+        The zones are derived by thresholding the distance maps stored by the zoners
+        with `save_distances=True`, so the zoning step does not need to be rerun for
+        each thickness. The same thickness is used for the inner and outer zones, and
+        a manual inner zone, if present, replaces the inner zone for every thickness.
+
+        Raises:
+        ValueError: If the ROI was zoned without storing the distance maps.
+
+        Returns:
+        list: One row of measurements per thickness, with a `zone_thickness` column.
+        """
+        roi_mask = self._load_roi_mask()
+
+        zones = self.zones if self.zones is not None else {}
+        distances = zones.get("distances")
+        inner_zone_manual = zones.get("inner_manual")
+        if self.zones is None:
+            segmentation = self.root[self.roi_path]["segmentation"]
+            if "distances" in segmentation:
+                distances = {
+                    name: distance_map[:]
+                    for name, distance_map in segmentation["distances"].arrays()
+                }
+            if "inner_manual" in segmentation["zones"]:
+                inner_zone_manual = segmentation["zones"]["inner_manual"][:]
+        if distances is None:
+            raise ValueError(
+                f"No distance maps stored for {self.roi_path}. Rerun the zoning with "
+                "--zone-thicknesses (without --skip-zoning) to store them."
+            )
+
+        # imported here, so that analysis-only runs do not load scikit-image
+        from zoning_classes import zones_from_distances
+
+        # the zones of every thickness lie within the mask, the boundary distance map
+        # and the manual inner zone, so the channels are read once for their crop
+        extent = np.logical_or(roi_mask, distances["boundary"] > 0)
+        if inner_zone_manual is not None:
+            extent |= inner_zone_manual
+        crop = cropping.mask_crop(extent)
+        channels = self._load_channels(crop)
+
+        rows = []
+        for thickness in thicknesses:
+            thickness_zones = zones_from_distances(
+                roi_mask, distances, thickness, thickness
+            )
+
+            inner_zone_mask = None
+            if self.apical_type == "apical_in":
+                inner_zone_mask = thickness_zones["inner"]
+                if inner_zone_manual is not None:
+                    inner_zone_mask = inner_zone_manual
+
+            row = {"zone_thickness": thickness}
+            row.update(
+                self._measure(
+                    channels,
+                    crop,
+                    roi_mask,
+                    thickness_zones["outer"],
+                    inner_zone_mask,
+                )
+            )
+            rows.append(row)
+
+        return rows
+
+    def _measure(
+        self,
+        channels: list,
+        crop: tuple,
+        roi_mask: np.ndarray,
+        outer_zone_mask: np.ndarray,
+        inner_zone_mask: Optional[np.ndarray],
+    ) -> dict:
+        """
+        Measures the Cy3 and AF647 `channels`, cropped to `crop`, in the full-frame
+        zones. All zones must lie within the crop.
+        """
+        zones = [roi_mask, outer_zone_mask]
+        if self.apical_type == "apical_in":
+            zones.append(inner_zone_mask)
+        zones = [zone[crop] for zone in zones]
+
+        # counts, sums and means of both channels in all zones in a single pass
+        with profiling.span("zone_statistics"):
+            stats = zone_statistics(channels, zones)
+        counts, sums, means = stats["count"], stats["sum"], stats["mean"]
 
-        roi_pixels = np.count_nonzero(roi_mask)
+        roi_pixels = counts[0]
         roi_area = roi_pixels * PIXEL_SIZE
-        oz_pixels = np.count_nonzero(outer_zone_mask)
+        oz_pixels = counts[1]
         oz_area = oz_pixels * PIXEL_SIZE
 
         if self.apical_type == "apical_in":
-            iz_pixels = np.count_nonzero(inner_zone_mask)
+            iz_pixels = counts[2]
             iz_area = iz_pixels * PIXEL_SIZE
         else:
             iz_pixels = None
             iz_area = None
 
         # Cy3 channel data
-        cy3_id = cy3[roi_mask].sum()
-        cy3_mean = cy3[roi_mask].mean()
-        cy3_oz_id = cy3[outer_zone_mask].sum()
-        cy3_oz_mean = cy3[outer_zone_mask].mean()
+        cy3_id = sums[0, 0]
+        cy3_mean = means[0, 0]
+        cy3_oz_id = sums[1, 0]
+        cy3_oz_mean = means[1, 0]
 
         if self.apical_type == "apical_in":
-            cy3_iz_id = cy3[inner_zone_mask].sum()
-            cy3_iz_mean = cy3[inner_zone_mask].mean()
+            cy3_iz_id = sums[2, 0]
+            cy3_iz_mean = means[2, 0]
         else:
             cy3_iz_id = None
             cy3_iz_mean = None
 
         # AF647 channel data
-        af647_id = af647[roi_mask].sum()
-        af647_mean = af647[roi_mask].mean()
-        af647_oz_id = af647[outer_zone_mask].sum()
-        af647_oz_mean = af647[outer_zone_mask].mean()
+        af647_id = sums[0, 1]
+        af647_mean = means[0, 1]
+        af647_oz_id = sums[1, 1]
+        af647_oz_mean = means[1, 1]
 
         if self.apical_type == "apical_in":
-            af647_iz_id = af647[inner_zone_mask].sum()
-            af647_iz_mean = af647[inner_zone_mask].mean()
+            af647_iz_id = sums[2, 1]
+            af647_iz_mean = means[2, 1]
         else:
             af647_iz_id = None
             af647_iz_mean = None
@@ -0,0 +1,114 @@
+"""
+Benchmark compression codecs on the datasets of a Zarr file.
+
+For every kind of dataset (raw data, masks, nuclei labels, zone overlays, distance maps
+and intensity histograms), a sample of the datasets in the Zarr file is rewritten with each codec of
+`storage.CODECS` into an in-memory store, keeping the chunking of the source dataset.
+Reports the compression ratio and the write and read throughput of each codec, which
+are then used to choose `storage.DATASET_CODECS`.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+import zarr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import storage  # noqa: E402
+
+ZARR_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "zarr_data", "roi_data.zarr"
+)
+
+# dataset paths relative to the ROI group of each kind of dataset
+DATASET_KINDS = {
+    "raw": ["raw_data"],
+    "mask": ["segmentation/mask", "segmentation/zones/outer"],
+    "labels": ["segmentation/nuclei"],
+    "overlay": ["segmentation/zones/overlay"],
+    "distances": ["segmentation/distances/boundary"],
+    "histograms": ["histograms"],
+}
+
+
+def sample_datasets(root: zarr.Group, paths: list, max_rois: int) -> list:
+    datasets = []
+    for mix in list(root.keys()):
+        for apical_type in list(root[mix].keys()):
+            rois = list(root[mix][apical_type].keys())[:max_rois]
+            for roi in rois:
+                for path in paths:
+                    full_path = f"{mix}/{apical_type}/{roi}/{path}"
+                    if full_path in root:
+                        datasets.append(root[full_path])
+    return datasets
+
+
+def benchmark_codec(arrays: list, codec, repeats: int) -> dict:
+    stored_bytes = 0
+    raw_bytes = 0
+    write_seconds = 0.0
+    read_seconds = 0.0
+
+    for data, chunks in arrays:
+        for _ in range(repeats):
+            store = zarr.MemoryStore()
+
+            start = time.perf_counter()
+            dataset = zarr.array(data, chunks=chunks, compressor=codec, store=store)
+            write_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            dataset[:]
+            read_seconds += time.perf_counter() - start
+
+        stored_bytes += dataset.nbytes_stored
+        raw_bytes += data.nbytes
+
+    total_bytes = raw_bytes * repeats
+    return {
+        "ratio": raw_bytes / stored_bytes,
+        "write_mb_s": total_bytes / write_seconds / 1e6,
+        "read_mb_s": total_bytes / read_seconds / 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare compression codecs on the datasets of a Zarr file."
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--max-rois",
+        type=int,
+        default=3,
+        help="Number of ROIs sampled per mix and apical type",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--csv-path", type=str, default=None)
+    args = parser.parse_args()
+
+    root = zarr.open(args.zarr_path, mode="r")
+
+    rows = []
+    for kind, paths in DATASET_KINDS.items():
+        datasets = sample_datasets(root, paths, args.max_rois)
+        if not datasets:
+            continue
+
+        arrays = [(dataset[:], dataset.chunks) for dataset in datasets]
+        for name, codec in storage.CODECS.items():
+            row = {"kind": kind, "codec": name, "datasets": len(arrays)}
+            row.update(benchmark_codec(arrays, codec, args.repeats))
+            row["selected"] = storage.DATASET_CODECS[kind] == name
+            rows.append(row)
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False, float_format="{:.2f}".format))
+
+    if args.csv_path is not None:
+        df.to_csv(args.csv_path, index=False)
@@ -0,0 +1,282 @@
+"""
+Benchmark the pipeline stages on synthetic data.
+
+A synthetic Zarr dataset is written with `synthetic_data.py`, unless an existing one is
+given, and the stages are run on all of its ROIs in pipeline order: the ROI segmenters,
+the zoners, nuclei segmentation, RoiAnalyzer and measure_correlation. Every stage is
+run with each of its alternative backends and each number of parallel workers.
+
+StarDist is replaced by a mock that labels the bright DAPI blobs of the synthetic
+nuclei, so the benchmark runs offline and without TensorFlow. Everything else in the
+nuclei segmentation stage runs as in the pipeline.
+
+Reports the median time per ROI for every stage, backend, worker count and ROI size,
+and the wall time of every stage over all ROIs. The summary can be saved and later
+passed as `--baseline` to flag performance regressions.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy import ndimage as ndi
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+import cropping  # noqa: E402
+import profiling  # noqa: E402
+import segmentation_classes  # noqa: E402
+import zoning_classes  # noqa: E402
+from analysis_classes import RoiAnalyzer  # noqa: E402
+from measure_correlation import measure_roi  # noqa: E402
+from nuclei_segmentation import INFERENCE_MARGIN, NucleiSegmenter  # noqa: E402
+from segmentation_classes import ApicalInSegmenter, ApicalOutSegmenter  # noqa: E402
+from synthetic_data import write_synthetic_dataset  # noqa: E402
+from zoning_classes import ApicalInZoner, ApicalOutZoner  # noqa: E402
+
+STAGES = ["segmentation", "zoning", "nuclei_segmentation", "analysis", "correlation"]
+
+# alternative backends of each stage, the default last so the later stages run on its
+# outputs
+BACKENDS = {
+    "segmentation": ["gaussian", "integral"],
+    "zoning": ["footprint", "distance"],
+}
+for stage, default in [
+    ("segmentation", segmentation_classes.THRESHOLD_METHOD),
+    ("zoning", zoning_classes.ZONING_METHOD),
+]:
+    BACKENDS[stage] = [b for b in BACKENDS[stage] if b != default] + [default]
+
+# DAPI intensity separating the synthetic nuclei from the cytoplasm
+NUCLEUS_THRESHOLD = 3000
+
+
+class MockedNucleiSegmenter(NucleiSegmenter):
+    """
+    Nuclei segmentation with StarDist inference replaced by labeling the DAPI blobs.
+    """
+
+    def _predict(self, dapi: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        labels = np.zeros(dapi.shape, dtype=np.int32)
+
+        bbox = cropping.bounding_box(mask, INFERENCE_MARGIN)
+        if bbox is None:
+            return labels
+
+        with profiling.span("predict_instances"):
+            labels[bbox], _ = ndi.label(dapi[bbox] > NUCLEUS_THRESHOLD)
+        return labels
+
+
+def run_roi_stage(
+    stage: str, zarr_path: str, entry: dict, backend: str = None
+) -> float:
+    """
+    Runs a stage on an ROI with the given backend and returns its run time in seconds.
+    """
+    mix, apical_type, roi = entry["mix"], entry["apical_type"], entry["roi"]
+    if stage == "zoning":
+        # module-level setting, set in the worker process running the stage
+        zoning_classes.ZONING_METHOD = backend
+
+    start = time.perf_counter()
+    if stage == "segmentation":
+        if apical_type == "apical_in":
+            ApicalInSegmenter(zarr_path, mix, roi, threshold_method=backend).segment()
+        else:
+            ApicalOutSegmenter(zarr_path, mix, roi).segment()
+    elif stage == "zoning":
+        if apical_type == "apical_in":
+            ApicalInZoner(zarr_path, mix, roi).generate()
+        else:
+            ApicalOutZoner(zarr_path, mix, roi).generate()
+    elif stage == "nuclei_segmentation":
+        MockedNucleiSegmenter(zarr_path, f"{mix}/{apical_type}/{roi}").segment()
+    elif stage == "analysis":
+        RoiAnalyzer(zarr_path, mix, apical_type, roi).analyze()
+    elif stage == "correlation":
+        measure_roi(zarr_path, mix, apical_type, roi)
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    return time.perf_counter() - start
+
+
+def run_benchmarks(zarr_path: str, stages: list, jobs: list, repeats: int = 1) -> tuple:
+    """
+    Runs every stage with every backend and number of workers on all ROIs.
+
+    Returns:
+    tuple: (per-ROI timings, wall times of the stages over all ROIs) as DataFrames.
+    """
+    entries = catalog.read_catalog(zarr_path)
+
+    roi_rows = []
+    stage_rows = []
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+
+        for backend in BACKENDS.get(stage, [None]):
+            for n_jobs in jobs:
+                for repeat in range(repeats):
+                    start = time.perf_counter()
+                    seconds = Parallel(n_jobs=n_jobs)(
+                        delayed(run_roi_stage)(stage, zarr_path, entry, backend)
+                        for entry in entries
+                    )
+                    wall = time.perf_counter() - start
+
+                    key = {"stage": stage, "backend": backend, "jobs": n_jobs}
+                    pixels = 0
+                    for entry, roi_seconds in zip(entries, seconds):
+                        height, width = entry["shape"][:2]
+                        pixels += height * width
+                        roi_rows.append(
+                            {
+                                **key,
+                                "repeat": repeat,
+                                "roi": entry["roi"],
+                                "apical_type": entry["apical_type"],
+                                "size": height,
+                                "pixels": height * width,
+                                "seconds": roi_seconds,
+                            }
+                        )
+                    stage_rows.append(
+                        {
+                            **key,
+                            "repeat": repeat,
+                            "rois": len(entries),
+                            "wall_seconds": wall,
+                            "mpixels_per_s": pixels / wall / 1e6,
+                        }
+                    )
+                print(f"{stage} ({backend or 'default'}, {n_jobs} jobs): {wall:.2f} s")
+
+    return pd.DataFrame(roi_rows), pd.DataFrame(stage_rows)
+
+
+def summarize(roi_timings: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the median time and throughput per ROI for every stage, backend, number of
+    workers, apical type and ROI size.
+    """
+    keys = ["stage", "backend", "jobs", "apical_type", "size"]
+    timings = roi_timings.fillna({"backend": "default"})
+    summary = timings.groupby(keys, sort=False).agg(
+        rois=("roi", "nunique"),
+        median_seconds=("seconds", "median"),
+        max_seconds=("seconds", "max"),
+        pixels=("pixels", "first"),
+    )
+    summary["mpixels_per_s"] = summary["pixels"] / summary["median_seconds"] / 1e6
+    return summary.drop(columns="pixels").reset_index()
+
+
+def compare(summary: pd.DataFrame, baseline: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compares the median times per ROI with those of a baseline summary.
+    """
+    keys = ["stage", "backend", "jobs", "apical_type", "size"]
+    comparison = summary.merge(
+        baseline[keys + ["median_seconds"]],
+        on=keys,
+        suffixes=("", "_baseline"),
+    )
+    comparison["ratio"] = (
+        comparison["median_seconds"] / comparison["median_seconds_baseline"]
+    )
+    return comparison[keys + ["median_seconds_baseline", "median_seconds", "ratio"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic ROIs."
+    )
+    parser.add_argument(
+        "--zarr-path",
+        type=str,
+        default=None,
+        help="Existing synthetic dataset. It is modified by the stages. By default, "
+        "a temporary dataset is written and removed afterwards.",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[512, 1024, 2048],
+        help="Side lengths of the synthetic ROIs in pixels",
+    )
+    parser.add_argument(
+        "--rois-per-size",
+        type=int,
+        default=2,
+        help="Number of apical-in and of apical-out ROIs of each size per mix",
+    )
+    parser.add_argument("--stages", choices=STAGES, nargs="+", default=STAGES)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="Numbers of parallel workers to run every stage with",
+    )
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument(
+        "--csv-path", type=str, default=None, help="Save the summary to a CSV file"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help="Summary CSV of an earlier run to compare against",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown against the baseline reported as a regression",
+    )
+    args = parser.parse_args()
+
+    zarr_path = args.zarr_path
+    temporary_dir = None
+    if zarr_path is None:
+        temporary_dir = tempfile.mkdtemp()
+        zarr_path = os.path.join(temporary_dir, "synthetic.zarr")
+        print("Writing synthetic dataset...")
+        write_synthetic_dataset(zarr_path, args.sizes, args.rois_per_size)
+
+    try:
+        roi_timings, stage_timings = run_benchmarks(
+            zarr_path, args.stages, args.jobs, args.repeats
+        )
+    finally:
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir)
+
+    summary = summarize(roi_timings)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print()
+        print(summary.round(4).to_string(index=False))
+        print()
+        print(stage_timings.round(3).to_string(index=False))
+
+    if args.csv_path is not None:
+        summary.to_csv(args.csv_path, index=False)
+
+    if args.baseline is not None:
+        comparison = compare(summary, pd.read_csv(args.baseline))
+        regressions = comparison[comparison["ratio"] > 1 + args.tolerance]
+        print()
+        print(comparison.round(3).to_string(index=False))
+        if not regressions.empty:
+            sys.exit(f"{len(regressions)} regressions slower than the baseline")
@@ -0,0 +1,102 @@
+"""
+Benchmark the startup time of the pipeline entrypoint.
+
+Imports main.py in fresh interpreters and reports the import time and whether any of the
+heavy dependencies were pulled in: those of nuclei segmentation (TensorFlow, StarDist,
+CSBDeep) and of the image processing stages (scikit-image, SciPy).
+Optionally also times a complete analysis-only run of main.py on a Zarr dataset.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+HEAVY_MODULES = ["tensorflow", "stardist", "csbdeep", "skimage", "scipy"]
+
+IMPORT_SNIPPET = f"""
+import json, sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "heavy_modules": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def time_import(repeats: int) -> dict:
+    timings = []
+    heavy_modules = set()
+    for _ in range(repeats):
+        result = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            cwd=SRC_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        data = json.loads(result.stdout.strip().splitlines()[-1])
+        timings.append(data["seconds"])
+        heavy_modules.update(data["heavy_modules"])
+
+    return {
+        "median_seconds": statistics.median(timings),
+        "min_seconds": min(timings),
+        "heavy_modules": sorted(heavy_modules),
+    }
+
+
+def time_analysis_only_run(zarr_path: str, csv_path: str) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            "main.py",
+            "--zarr-path",
+            zarr_path,
+            "--csv-path",
+            csv_path,
+            "--skip-roi-segmentation",
+            "--skip-zoning",
+            "--skip-nuclei-segmentation",
+        ],
+        cwd=SRC_DIR,
+        check=True,
+        capture_output=True,
+    )
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark main.py startup time.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--zarr-path",
+        type=str,
+        default=None,
+        help="Also time a full analysis-only run on this Zarr file.",
+    )
+    parser.add_argument("--csv-path", type=str, default=os.devnull)
+    args = parser.parse_args()
+
+    result = time_import(args.repeats)
+    print(f"import main: {result['median_seconds']:.3f} s (median of {args.repeats})")
+    print(f"import main: {result['min_seconds']:.3f} s (best)")
+
+    if result["heavy_modules"]:
+        print(
+            f"Heavy modules imported at startup: {', '.join(result['heavy_modules'])}"
+        )
+    else:
+        print("No heavy modules imported at startup")
+
+    if args.zarr_path is not None:
+        seconds = time_analysis_only_run(args.zarr_path, args.csv_path)
+        print(f"analysis-only run: {seconds:.3f} s")
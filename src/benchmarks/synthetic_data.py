@@ -0,0 +1,209 @@
+"""
+Generate a synthetic Zarr dataset for testing and benchmarking the pipeline.
+
+The ROIs are written in the hierarchy created by `convert_to_zarr.py`, so every stage
+runs on them unchanged. Each ROI is a zero-padded YXC image with an irregular tissue
+region placed off-centre in the frame, like the QuPath exports:
+
+- apical-in ROIs have a ring of epithelium around a dark lumen, surrounded by stroma;
+- apical-out ROIs have a solid sphere of epithelium without a lumen.
+
+Blob-shaped nuclei are drawn into the DAPI channel of the epithelium, and the Cy3 and
+AF647 channels share a smooth, partially correlated signal that is enriched towards
+the apical pole.
+"""
+
+import argparse
+import os
+import sys
+import zlib
+
+import numpy as np
+import zarr
+from scipy import ndimage as ndi
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "util"))
+
+import catalog  # noqa: E402
+import storage  # noqa: E402
+from convert_to_zarr import create_mix_group, create_roi_dataset  # noqa: E402
+
+ZARR_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "zarr_data", "synthetic.zarr"
+)
+
+MIXES = ["mix_1", "mix_2"]
+DATE = "231019"
+
+NUCLEUS_RADIUS = 6
+# nuclei per pixel of epithelium
+NUCLEUS_DENSITY = 1 / 600
+
+
+def _tissue_radius(theta: np.ndarray, radius: float, rng: np.random.Generator):
+    """
+    Radius of an irregular blob outline at the angles `theta`.
+    """
+    harmonics = np.arange(2, 6)
+    amplitudes = rng.uniform(0.02, 0.06, harmonics.size)
+    phases = rng.uniform(0, 2 * np.pi, harmonics.size)
+    wobble = np.sum(
+        amplitudes[:, None, None]
+        * np.cos(harmonics[:, None, None] * theta[None] + phases[:, None, None]),
+        axis=0,
+    )
+    return radius * (1 + wobble)
+
+
+def synthetic_roi(size: int, apical_type: str, seed: int = 0) -> np.ndarray:
+    """
+    Returns a synthetic uint16 YXC image of `size` × `size` pixels.
+    """
+    rng = np.random.default_rng(seed)
+
+    # tissue in about half of the frame, off-centre so that cropping matters
+    radius = size * 0.3
+    center = np.array([size * 0.4, size * 0.55]) + rng.uniform(-0.05, 0.05, 2) * size
+    yy, xx = np.mgrid[:size, :size].astype(np.float32)
+    dy, dx = yy - center[0], xx - center[1]
+    distance = np.hypot(dy, dx)
+    theta = np.arctan2(dy, dx)
+    # relative position between the center (0) and the outline (1) of the tissue
+    position = distance / _tissue_radius(theta, radius, rng)
+    del yy, xx, dy, dx, theta
+
+    tissue = position < 1
+    if apical_type == "apical_in":
+        lumen = position < 0.35
+        epithelium = (position >= 0.35) & (position < 0.7)
+        # the apical pole faces the lumen
+        apical = np.clip((0.7 - position) / 0.35, 0, 1)
+    elif apical_type == "apical_out":
+        lumen = np.zeros_like(tissue)
+        epithelium = position < 0.8
+        # the apical pole faces the stroma
+        apical = np.clip(position / 0.8, 0, 1)
+    else:
+        raise ValueError(f"Unknown apical type: {apical_type}")
+    apical[~epithelium] = 0
+
+    img = np.zeros((size, size, 3), dtype=np.uint16)
+
+    # DAPI: dim cytoplasm with bright nuclei in the epithelium
+    dapi = np.where(epithelium, 800, 300).astype(np.float32)
+    candidates = np.flatnonzero(epithelium[::NUCLEUS_RADIUS, ::NUCLEUS_RADIUS])
+    n_nuclei = int(np.count_nonzero(epithelium) * NUCLEUS_DENSITY)
+    centers = rng.choice(candidates, min(n_nuclei, candidates.size), replace=False)
+    seeds = np.zeros((size, size), dtype=bool)
+    grid_width = epithelium[::NUCLEUS_RADIUS, ::NUCLEUS_RADIUS].shape[1]
+    seeds[
+        (centers // grid_width) * NUCLEUS_RADIUS,
+        (centers % grid_width) * NUCLEUS_RADIUS,
+    ] = True
+    nuclei = ndi.binary_dilation(
+        seeds, structure=_disk(NUCLEUS_RADIUS - 1)
+    ) & np.invert(lumen)
+    dapi[nuclei] = 6000
+    dapi += rng.normal(0, 150, (size, size)).astype(np.float32)
+
+    # Cy3 and AF647: a shared smooth signal plus independent noise
+    shared = ndi.gaussian_filter(rng.normal(0, 1, (size, size)).astype(np.float32), 8)
+    shared /= shared.std() + 1e-6
+    base = np.where(epithelium, 3000, 1200).astype(np.float32) * (1 + apical)
+    for channel, weight in [(1, 1.0), (2, 0.6)]:
+        noise = rng.normal(0, 1, (size, size)).astype(np.float32)
+        signal = base * (1 + 0.2 * (weight * shared + (1 - weight) * noise))
+        img[:, :, channel] = np.clip(signal, 1, 65535)
+    img[:, :, 0] = np.clip(dapi, 1, 65535)
+
+    # the lumen is nearly empty, and everything outside the tissue is zero padding
+    img[lumen] = rng.integers(1, 50, (np.count_nonzero(lumen), 3), dtype=np.uint16)
+    img[~tissue] = 0
+    return img
+
+
+def _disk(radius: int) -> np.ndarray:
+    y, x = np.ogrid[-radius : radius + 1, -radius : radius + 1]
+    return x**2 + y**2 <= radius**2
+
+
+def _roi_seed(seed: int, name: str) -> int:
+    # stable across processes, unlike hash()
+    return seed * 1_000_003 + zlib.crc32(name.encode())
+
+
+def roi_name(mix: str, patient: int, apical_type: str, index: int) -> str:
+    """
+    Returns an ROI name in the format of the real data, e.g. `231019_mix1_8_in_1`.
+    """
+    return (
+        f"{DATE}_{mix.replace('_', '')}_{patient}_{apical_type.split('_')[1]}_{index}"
+    )
+
+
+def write_synthetic_dataset(
+    zarr_path: str,
+    sizes: list,
+    rois_per_size: int = 1,
+    mixes: list = None,
+    layout: str = None,
+    seed: int = 0,
+) -> list:
+    """
+    Writes a synthetic Zarr dataset with `rois_per_size` apical-in and apical-out ROIs
+    of every size in `sizes` per mix, and its catalog.
+
+    The ROIs of each size belong to their own patient, so the patient-level statistics
+    can be tested too.
+
+    Returns:
+    list: The catalog entries of the ROIs.
+    """
+    mixes = MIXES if mixes is None else mixes
+
+    root = zarr.open(zarr_path, mode="w")
+    for mix in mixes:
+        mix_group = create_mix_group(root, mix)
+        for patient, size in enumerate(sizes, start=1):
+            for apical_type in ["apical_in", "apical_out"]:
+                for index in range(1, rois_per_size + 1):
+                    name = roi_name(mix, patient, apical_type, index)
+                    img = synthetic_roi(size, apical_type, _roi_seed(seed, name))
+                    create_roi_dataset(mix_group, apical_type, name, img, layout)
+
+    return catalog.write_catalog(zarr_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic Zarr dataset of apical-in and apical-out ROIs."
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[512, 1024, 2048],
+        help="Side lengths of the square ROIs in pixels",
+    )
+    parser.add_argument(
+        "--rois-per-size",
+        type=int,
+        default=2,
+        help="Number of apical-in and of apical-out ROIs of each size per mix",
+    )
+    parser.add_argument(
+        "--layout", choices=storage.LAYOUTS, default=storage.DEFAULT_LAYOUT
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    entries = write_synthetic_dataset(
+        args.zarr_path,
+        args.sizes,
+        args.rois_per_size,
+        layout=args.layout,
+        seed=args.seed,
+    )
+    print(f"Wrote {len(entries)} ROIs to {args.zarr_path}")
@@ -0,0 +1,78 @@
+"""
+Compare the local threshold backends of ApicalInSegmenter.
+
+For every apical-in ROI, the primitive mask is computed with the gaussian and the
+integral (summed-area table) backends. Reports the run time of each backend and how well
+the resulting masks agree, so the faster backend can be chosen where the masks match.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import zarr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from segmentation_classes import primitive_mask  # noqa: E402
+
+ZARR_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "zarr_data", "roi_data.zarr"
+)
+
+METHODS = ["gaussian", "integral"]
+
+
+def compare_roi(img: np.ndarray) -> dict:
+    masks = {}
+    result = {"pixels": img.shape[0] * img.shape[1]}
+    for method in METHODS:
+        start = time.perf_counter()
+        masks[method] = primitive_mask(img, method)
+        result[f"{method}_seconds"] = time.perf_counter() - start
+
+    reference, candidate = masks["gaussian"], masks["integral"]
+    intersection = np.count_nonzero(reference & candidate)
+    total = np.count_nonzero(reference) + np.count_nonzero(candidate)
+
+    result["pixel_agreement"] = (
+        np.count_nonzero(reference == candidate) / reference.size
+    )
+    result["dice"] = 2 * intersection / total if total > 0 else 1.0
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the gaussian and integral local threshold backends."
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument("--max-rois", type=int, default=None)
+    parser.add_argument("--csv-path", type=str, default=None)
+    args = parser.parse_args()
+
+    root = zarr.open(args.zarr_path, mode="r")
+
+    rows = []
+    for mix in list(root.keys()):
+        for roi in list(root[mix]["apical_in"].keys()):
+            if args.max_rois is not None and len(rows) >= args.max_rois:
+                break
+
+            img = root[mix]["apical_in"][roi]["raw_data"][:]
+            rows.append({"mix": mix, "roi": roi, **compare_roi(img)})
+
+    df = pd.DataFrame(rows)
+    print(df.to_string(index=False))
+    print()
+    print(f"Total gaussian time: {df['gaussian_seconds'].sum():.2f} s")
+    print(f"Total integral time: {df['integral_seconds'].sum():.2f} s")
+    print(
+        f"Median Dice: {df['dice'].median():.4f}, minimum Dice: {df['dice'].min():.4f}"
+    )
+
+    if args.csv_path is not None:
+        df.to_csv(args.csv_path, index=False)
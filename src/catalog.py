@@ -0,0 +1,127 @@
+"""
+Persistent catalog of the ROIs in the Zarr file.
+
+Enumerating the ROIs by listing the mix, apical type and ROI groups costs one metadata
+round trip per group, which adds up on network filesystems. Instead, the catalog of all
+ROIs, with their shape, tissue bounding box and completed stages, is stored in the root
+attributes, and the metadata of the whole hierarchy is consolidated into a single key.
+Entry points then enumerate the ROIs with one read. The catalog is rewritten after every
+pipeline stage.
+"""
+
+from contextlib import contextmanager
+from typing import Optional
+
+import zarr
+
+import cropping
+
+CATALOG_ATTR = "catalog"
+
+# output whose presence marks a stage as completed for an ROI
+STAGE_OUTPUTS = {
+    "segmentation": "segmentation/mask",
+    "zoning": "segmentation/zones/outer",
+    "nuclei_segmentation": "segmentation/nuclei",
+    "histograms": "histograms",
+}
+
+
+def build_catalog(root: zarr.Group) -> list:
+    """
+    Walks the hierarchy and returns one catalog entry per ROI.
+    """
+    entries = []
+    for mix in sorted(root.group_keys()):
+        for apical_type in sorted(root[mix].group_keys()):
+            for roi in sorted(root[mix][apical_type].group_keys()):
+                group = root[mix][apical_type][roi]
+                entries.append(
+                    {
+                        "mix": mix,
+                        "apical_type": apical_type,
+                        "roi": roi,
+                        "shape": list(group["raw_data"].shape),
+                        "tissue_bbox": group.attrs.get(cropping.TISSUE_BBOX_ATTR),
+                        "stages": {
+                            stage: output in group
+                            for stage, output in STAGE_OUTPUTS.items()
+                        },
+                    }
+                )
+    return entries
+
+
+def write_catalog(zarr_path: str) -> list:
+    """
+    Rebuilds the catalog, stores it in the root attributes and consolidates the
+    metadata of the Zarr file.
+    """
+    root = zarr.open(zarr_path, mode="a")
+    entries = build_catalog(root)
+    root.attrs[CATALOG_ATTR] = entries
+    zarr.consolidate_metadata(root.store)
+    return entries
+
+
+@contextmanager
+def updated_after(zarr_path: str):
+    """
+    Rewrites the catalog and the consolidated metadata when the enclosed writes end,
+    also when they fail, so the read-only entry points do not see the outputs written
+    before the failure as stale or missing.
+    """
+    try:
+        yield
+    finally:
+        write_catalog(zarr_path)
+
+
+def open_root(zarr_path: str) -> zarr.Group:
+    """
+    Opens the Zarr file read-only, from the consolidated metadata when present.
+
+    Outputs written since the last consolidation are missing from the consolidated
+    view, so stages that write use `zarr.open` instead, and writers rewrite the catalog
+    with `updated_after` also when they fail.
+    """
+    try:
+        return zarr.open_consolidated(zarr_path, mode="r")
+    except KeyError:
+        return zarr.open(zarr_path, mode="r")
+
+
+def read_catalog(zarr_path: str) -> list:
+    """
+    Returns the catalog entries of all ROIs. Falls back to walking the hierarchy when
+    no catalog has been written yet.
+    """
+    root = open_root(zarr_path)
+    entries = root.attrs.get(CATALOG_ATTR)
+    if entries is None:
+        entries = build_catalog(root)
+    return entries
+
+
+def select(
+    entries: list, mix: Optional[str] = None, apical_type: Optional[str] = None
+) -> list:
+    """
+    Returns the catalog entries of the given mix and apical type.
+    """
+    return [
+        entry
+        for entry in entries
+        if (mix is None or entry["mix"] == mix)
+        and (apical_type is None or entry["apical_type"] == apical_type)
+    ]
+
+
+def mixes(entries: list) -> list:
+    return sorted({entry["mix"] for entry in entries})
+
+
+def roi_names(
+    entries: list, mix: Optional[str] = None, apical_type: Optional[str] = None
+) -> list:
+    return [entry["roi"] for entry in select(entries, mix, apical_type)]
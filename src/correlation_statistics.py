@@ -0,0 +1,155 @@
+"""
+Pooled correlations and intensities from stored sufficient statistics.
+
+`measure_correlation.py` stores the sufficient statistics of every zone of every ROI:
+the pixel count, the sums of both channels, their squares and cross products, and the
+nuclei count. Counts and sums of any group of ROIs add up, so correlations and
+intensities pooled per patient, slide or date are computed from the stored statistics
+without reading the pixels again.
+
+ROI names encode where the ROI comes from, e.g. `231019_mix1_8_in_1` is the first
+apical-in ROI of patient 8 on the mix 1 slide `231019_mix1_8` scanned on 231019.
+"""
+
+import argparse
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from zone_statistics import ZoneMoments, pearson_from_sums
+
+STATISTICS_CSV = "correlation_statistics.csv"
+
+MIX_CH_NAMES = {"mix_1": ["HER2", "SORLA"], "mix_2": ["HER2", "HER3"]}
+
+PIXEL_SIZE = 0.325  # um
+
+SUMS = ["count"] + ZoneMoments.STATISTICS + ["nuclei_count"]
+
+ROI_NAME = re.compile(
+    r"^(?P<date>\d+)_mix(?P<mix>\d+)_(?P<patient>\d+)_(?P<apical>in|out)_(?P<index>\d+)$"
+)
+
+
+def parse_roi_name(roi: str) -> dict:
+    """
+    Parses the date, mix, patient, apical type and index of an ROI name like
+    `231019_mix1_8_in_1`. The slide is the name without the apical type and index.
+    """
+    match = ROI_NAME.match(roi)
+    if match is None:
+        raise ValueError(f"Cannot parse ROI name: {roi}")
+
+    parts = match.groupdict()
+    parts["index"] = int(parts["index"])
+    parts["slide"] = f"{parts['date']}_mix{parts['mix']}_{parts['patient']}"
+    return parts
+
+
+def statistics_rows(
+    roi: str,
+    mix: str,
+    apical_type: str,
+    zones: list,
+    moments: ZoneMoments,
+    nuclei_counts: list,
+) -> list:
+    """
+    Returns one row of sufficient statistics per zone of an ROI.
+
+    Args:
+    zones (list): Names of the zones, in the order they were given to `moments`.
+    nuclei_counts (list): Nuclei count per zone, None where not measured.
+    """
+    counts = moments.count()
+    sums = moments.sums()
+    return [
+        {
+            "roi": roi,
+            "mix": mix,
+            "roi_type": apical_type,
+            "zone": zone,
+            "count": counts[z],
+            **{name: sums[name][z] for name in ZoneMoments.STATISTICS},
+            "nuclei_count": nuclei_counts[z],
+        }
+        for z, zone in enumerate(zones)
+    ]
+
+
+def load_statistics(path: str = STATISTICS_CSV) -> pd.DataFrame:
+    """
+    Reads the stored statistics and adds the identifiers parsed from the ROI names.
+    """
+    statistics = pd.read_csv(path)
+    identifiers = pd.DataFrame([parse_roi_name(roi) for roi in statistics["roi"]])
+    return pd.concat([statistics, identifiers[["date", "patient", "slide"]]], axis=1)
+
+
+def pool(statistics: pd.DataFrame, by: str) -> pd.DataFrame:
+    """
+    Sums the statistics of the ROIs sharing the `by` identifier, e.g. "patient",
+    separately for every mix, apical type and zone.
+    """
+    keys = [by, "mix", "roi_type", "zone"]
+    # Python ints, the sums of squares of many ROIs overflow int64
+    sums = statistics[SUMS[:-1]].astype(object)
+    sums[keys] = statistics[keys]
+    sums["nuclei_count"] = statistics["nuclei_count"]
+
+    grouped = sums.groupby(keys, sort=False)
+    pooled = grouped[SUMS[:-1]].sum()
+    pooled["nuclei_count"] = grouped["nuclei_count"].sum(min_count=1)
+    return pooled.reset_index()
+
+
+def summarize(statistics: pd.DataFrame, by: str, mix: str) -> pd.DataFrame:
+    """
+    Computes the total and normalized intensities and the correlation of the channels
+    of a mix from the statistics, one row per `by` identifier, apical type and zone.
+    """
+    ch2_name, ch3_name = MIX_CH_NAMES[mix]
+
+    rows = []
+    for row in statistics[statistics["mix"] == mix].itertuples(index=False):
+        area = np.float64(row.count) * PIXEL_SIZE
+        ch2_total, ch3_total = np.int64(row.sum_x), np.int64(row.sum_y)
+        rows.append(
+            {
+                by: getattr(row, by),
+                "mix": row.mix,
+                "roi_type": row.roi_type,
+                "zone": row.zone,
+                f"{ch2_name}_total_intensity": ch2_total,
+                f"{ch2_name}_normalized_intensity_area": ch2_total / area,
+                f"{ch2_name}_normalized_intensity_nuclei": ch2_total / row.nuclei_count,
+                f"{ch3_name}_total_intensity": ch3_total,
+                f"{ch3_name}_normalized_intensity_area": ch3_total / area,
+                f"{ch3_name}_normalized_intensity_nuclei": ch3_total / row.nuclei_count,
+                f"{ch2_name}_{ch3_name}_correlation": pearson_from_sums(
+                    int(row.count),
+                    *(int(getattr(row, name)) for name in ZoneMoments.STATISTICS),
+                ),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pool the stored correlation statistics per patient, slide or date."
+    )
+    parser.add_argument("--statistics", type=str, default=STATISTICS_CSV)
+    parser.add_argument("--by", choices=["patient", "slide", "date"], default="patient")
+    parser.add_argument("--output-dir", type=str, default=".")
+    args = parser.parse_args()
+
+    statistics = load_statistics(args.statistics)
+    pooled = pool(statistics, args.by)
+    for mix in sorted(pooled["mix"].unique()):
+        summarize(pooled, args.by, mix).to_csv(
+            os.path.join(args.output_dir, f"correlation_{args.by}_{mix}.csv"),
+            index=False,
+        )
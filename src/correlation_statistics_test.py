@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import pearsonr
+
+from correlation_statistics import (
+    load_statistics,
+    parse_roi_name,
+    pool,
+    statistics_rows,
+    summarize,
+)
+from zone_statistics import ZoneMoments
+
+ZONES = ["whole_roi", "apical"]
+
+
+def _roi(shape, seed):
+    rng = np.random.default_rng(seed)
+    shared = rng.integers(0, 1 << 15, shape)
+    x = (shared + rng.integers(0, 1 << 15, shape)).astype(np.uint16)
+    y = (shared * (seed + 1) // 4 + rng.integers(0, 1 << 14, shape)).astype(np.uint16)
+    whole = np.ones(shape, dtype=bool)
+    apical = rng.random(shape) < 0.4
+    return x, y, [whole, apical]
+
+
+def _statistics(rois):
+    rows = []
+    for roi, (x, y, zones) in rois.items():
+        moments = ZoneMoments(len(zones))
+        moments.update(x, y, zones)
+        rows.extend(
+            statistics_rows(roi, "mix_1", "apical_out", ZONES, moments, [None, 10])
+        )
+    return pd.DataFrame(rows)
+
+
+def test_pool_matches_concatenated_pixels(tmp_path):
+    rois = {
+        "231019_mix1_8_out_1": _roi((60, 80), 0),
+        "231019_mix1_8_out_2": _roi((120, 50), 1),
+        "231020_mix1_9_out_1": _roi((70, 70), 2),
+    }
+    path = tmp_path / "correlation_statistics.csv"
+    _statistics(rois).to_csv(path, index=False)
+
+    statistics = load_statistics(path)
+    pooled = pool(statistics, "patient")
+    summary = summarize(pooled, "patient", "mix_1").set_index(["patient", "zone"])
+
+    for patient, names in [("8", list(rois)[:2]), ("9", list(rois)[2:])]:
+        for z, zone in enumerate(ZONES):
+            x = np.concatenate([rois[name][0][rois[name][2][z]] for name in names])
+            y = np.concatenate([rois[name][1][rois[name][2][z]] for name in names])
+            row = summary.loc[(patient, zone)]
+
+            assert row["HER2_SORLA_correlation"] == pytest.approx(
+                pearsonr(x, y)[0], rel=1e-12
+            )
+            assert row["HER2_total_intensity"] == x.sum(dtype=np.int64)
+            assert row["SORLA_total_intensity"] == y.sum(dtype=np.int64)
+
+    # nuclei counts add up, and stay missing where no ROI has one
+    nuclei = pooled.set_index(["patient", "zone"])["nuclei_count"]
+    assert nuclei.loc[("8", "apical")] == 20
+    assert pd.isna(nuclei.loc[("8", "whole_roi")])
+
+
+def test_parse_roi_name():
+    parts = parse_roi_name("231019_mix1_8_in_1")
+
+    assert parts == {
+        "date": "231019",
+        "mix": "1",
+        "patient": "8",
+        "apical": "in",
+        "index": 1,
+        "slide": "231019_mix1_8",
+    }
+
+
+@pytest.mark.parametrize(
+    "roi", ["231019_mix1_8_in", "231019_mix1_8_sideways_1", "roi_1", ""]
+)
+def test_parse_roi_name_rejects_other_names(roi):
+    with pytest.raises(ValueError):
+        parse_roi_name(roi)
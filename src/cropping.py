@@ -0,0 +1,138 @@
+"""
+Cropping of ROIs to the bounding box of their tissue.
+
+ROIs exported from QuPath are zero-padded outside the tissue. Instead of processing the
+full padded frame, the stages work on the bounding box of the tissue, expanded by the
+margin of context their filters need, and paste their results back into full-frame
+outputs. The tissue bounding box is computed once per ROI and stored in the attributes
+of the ROI group.
+"""
+
+from typing import Optional
+
+import numpy as np
+import zarr
+
+# Set to False to process the full frame in every stage, e.g. to verify that cropping
+# does not change the outputs.
+CROP_TO_TISSUE = True
+
+TISSUE_BBOX_ATTR = "tissue_bbox"
+
+
+def bounding_box(mask: np.ndarray, margin: int = 0) -> Optional[tuple]:
+    """
+    Returns the slices of the bounding box of `mask` expanded by `margin` pixels and
+    clipped to the image, or None if the mask is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        # the rows, columns, ... with any pixel of the mask
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.flatnonzero(np.any(mask, axis=other_axes))
+        if indices.size == 0:
+            return None
+        bbox.append(slice(int(indices[0]), int(indices[-1]) + 1))
+
+    return expand(tuple(bbox), margin, mask.shape)
+
+
+def expand(bbox: tuple, margin: int, shape: tuple) -> tuple:
+    """
+    Expands the slices of a bounding box by `margin` pixels, clipped to `shape`.
+    """
+    return tuple(
+        slice(max(0, s.start - margin), min(size, s.stop + margin))
+        for s, size in zip(bbox, shape)
+    )
+
+
+def union(*crops: tuple) -> tuple:
+    """
+    Returns the smallest crop containing all of the given crops.
+    """
+    return tuple(
+        slice(min(s.start for s in axis), max(s.stop for s in axis))
+        for axis in zip(*crops)
+    )
+
+
+def full_frame(shape: tuple) -> tuple:
+    return tuple(slice(0, size) for size in shape[:2])
+
+
+def tissue_bbox(
+    root: zarr.Group, roi_path: str, raw_data: Optional[np.ndarray] = None
+) -> Optional[tuple]:
+    """
+    Returns the slices of the bounding box of the non-zero pixels of an ROI, or None if
+    the ROI has no tissue.
+
+    The bounding box stored in the attributes of the ROI group is used when present.
+    Otherwise it is computed from `raw_data`, or from the raw data in the Zarr file if
+    `raw_data` is not given, and stored when the file is writable.
+    """
+    group = root[roi_path]
+
+    if TISSUE_BBOX_ATTR in group.attrs:
+        bbox = group.attrs[TISSUE_BBOX_ATTR]
+        if bbox is None:
+            return None
+        y0, y1, x0, x1 = bbox
+        return (slice(y0, y1), slice(x0, x1))
+
+    if raw_data is None:
+        raw_data = group["raw_data"][:]
+
+    bbox = bounding_box(np.any(raw_data != 0, axis=-1))
+
+    if not group.read_only:
+        group.attrs[TISSUE_BBOX_ATTR] = (
+            None
+            if bbox is None
+            else [bbox[0].start, bbox[0].stop, bbox[1].start, bbox[1].stop]
+        )
+    return bbox
+
+
+def tissue_crop(
+    root: zarr.Group,
+    roi_path: str,
+    margin: int = 0,
+    raw_data: Optional[np.ndarray] = None,
+) -> tuple:
+    """
+    Returns the slices a stage should work on: the tissue bounding box expanded by
+    `margin` pixels, or the full frame when cropping is disabled or there is no tissue.
+    """
+    shape = root[roi_path]["raw_data"].shape
+    if CROP_TO_TISSUE is False:
+        return full_frame(shape)
+
+    bbox = tissue_bbox(root, roi_path, raw_data)
+    if bbox is None:
+        return full_frame(shape)
+    return expand(bbox, margin, shape)
+
+
+def mask_crop(mask: np.ndarray, margin: int = 0) -> tuple:
+    """
+    Returns the bounding box of `mask` expanded by `margin` pixels, or the full frame
+    when cropping is disabled or the mask is empty.
+    """
+    if CROP_TO_TISSUE is False:
+        return full_frame(mask.shape)
+
+    bbox = bounding_box(mask, margin)
+    if bbox is None:
+        return full_frame(mask.shape)
+    return bbox
+
+
+def uncrop(cropped: np.ndarray, crop: tuple, shape: tuple, fill=0) -> np.ndarray:
+    """
+    Pastes a cropped result back into a full-frame array of the given shape.
+    """
+    full = np.full(tuple(shape[:2]) + cropped.shape[2:], fill, dtype=cropped.dtype)
+    full[crop] = cropped
+    return full
@@ -0,0 +1,194 @@
+"""
+Per-ROI intensity histograms of every zone and channel.
+
+The full 16-bit histograms of the measured channels are stored per ROI, so the EDA
+plots can aggregate them over any group of ROIs without loading the pixels again.
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+import zarr
+
+import cropping
+import profiling
+import provenance
+import storage
+from zone_statistics import zone_histograms
+
+# raw data channels that are measured, see RoiAnalyzer
+CHANNELS = {"Cy3": 1, "AF647": 2}
+N_VALUES = 1 << 16
+
+
+class HistogramGenerator:
+    stage = "histograms"
+    outputs = ["histograms"]
+
+    def __init__(
+        self,
+        zarr_path: str,
+        mix: str,
+        apical_type: str,
+        roi: str,
+        raw_data: Optional[np.ndarray] = None,
+        roi_mask: Optional[np.ndarray] = None,
+        zones: Optional[dict] = None,
+    ):
+        self.zarr_path = zarr_path
+        self.root = profiling.open_zarr(zarr_path, mode="a")
+
+        assert apical_type in ["apical_in", "apical_out"], "Invalid apical type."
+        self.apical_type = apical_type
+        self.roi_path = f"{mix}/{apical_type}/{roi}"
+
+        # arrays already held in memory, e.g. by the fused pipeline
+        self.raw_data = raw_data
+        self.roi_mask = roi_mask
+        self.zones = zones
+
+    @staticmethod
+    def parameters() -> dict:
+        return {"channels": CHANNELS}
+
+    @staticmethod
+    def _zone_names(root: zarr.Group, roi_path: str) -> list:
+        zones_group = root[roi_path]["segmentation"]["zones"]
+        return [
+            zone for zone in ["outer", "inner", "inner_manual"] if zone in zones_group
+        ]
+
+    @classmethod
+    def _input_hashes(
+        cls,
+        root: zarr.Group,
+        roi_path: str,
+        raw_data: Optional[np.ndarray] = None,
+        roi_mask: Optional[np.ndarray] = None,
+    ) -> dict:
+        segmentation = root[roi_path]["segmentation"]
+        inputs = {
+            "raw_data": provenance.dataset_hash(root[roi_path]["raw_data"], raw_data),
+            "mask": provenance.dataset_hash(segmentation["mask"], roi_mask),
+        }
+        for zone in cls._zone_names(root, roi_path):
+            inputs[zone] = provenance.dataset_hash(segmentation["zones"][zone])
+        return inputs
+
+    @classmethod
+    def is_up_to_date(
+        cls, root: zarr.Group, mix: str, apical_type: str, roi: str
+    ) -> bool:
+        roi_path = f"{mix}/{apical_type}/{roi}"
+        outputs = [f"{roi_path}/{output}" for output in cls.outputs]
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: cls._input_hashes(root, roi_path),
+            cls.parameters(),
+        )
+
+    @profiling.profiled_stage
+    def generate(self) -> np.ndarray:
+        """
+        Computes the intensity histograms of the measured channels in the ROI mask and
+        each of its zones, and stores them in a (zone, channel, intensity) dataset.
+
+        Returns:
+        np.ndarray: The pixel counts per zone, channel and intensity.
+        """
+        roi_mask = self.roi_mask
+        if roi_mask is None:
+            roi_mask = self.root[self.roi_path]["segmentation"]["mask"][:]
+
+        zone_names = self._zone_names(self.root, self.roi_path)
+        zones = self.zones if self.zones is not None else {}
+        zone_masks = [roi_mask]
+        for zone in zone_names:
+            zone_mask = zones.get(zone)
+            if zone_mask is None:
+                zone_mask = self.root[self.roi_path]["segmentation"]["zones"][zone][:]
+            zone_masks.append(zone_mask)
+
+        inputs = self._input_hashes(self.root, self.roi_path, self.raw_data, roi_mask)
+
+        # pixels outside all zones do not contribute, so only the measured channels
+        # within the bounding box of the zones are read
+        crop = cropping.mask_crop(np.logical_or.reduce(zone_masks))
+        if self.raw_data is not None:
+            channels = [self.raw_data[crop + (c,)] for c in CHANNELS.values()]
+        else:
+            raw_data = self.root[self.roi_path]["raw_data"]
+            channels = [
+                storage.read_channel(raw_data, c, crop) for c in CHANNELS.values()
+            ]
+        with profiling.span("zone_histograms"):
+            histograms = zone_histograms(
+                channels, [zone_mask[crop] for zone_mask in zone_masks], N_VALUES
+            )
+        histograms = histograms.astype(np.uint32)
+
+        histogram_path = f"{self.roi_path}/histograms"
+        if histogram_path in self.root:
+            del self.root[histogram_path]
+
+        histogram_dataset = storage.create_dataset(
+            self.root, histogram_path, histograms, "histograms"
+        )
+        histogram_dataset.attrs.update(
+            {
+                "author": "Turku BioImaging",
+                "description": "Intensity histograms per zone and channel",
+                "roi": os.path.basename(self.roi_path),
+                "zones": ["roi"] + zone_names,
+                "channels": list(CHANNELS),
+            }
+        )
+        provenance.record(
+            histogram_dataset, histograms, self.stage, inputs, self.parameters()
+        )
+
+        return histograms
+
+
+def load_histogram(
+    root: zarr.Group, entries: list, apical_type: str, zone: str, channel: str
+) -> np.ndarray:
+    """
+    Sums the histograms of a zone and channel over the ROIs of the given catalog
+    entries. ROIs without the zone are skipped.
+    """
+    total = np.zeros(N_VALUES, dtype=np.int64)
+    for entry in entries:
+        if entry["apical_type"] != apical_type:
+            continue
+
+        dataset = root[f"{entry['mix']}/{apical_type}/{entry['roi']}/histograms"]
+        zones = dataset.attrs["zones"]
+        if zone not in zones:
+            continue
+
+        channels = dataset.attrs["channels"]
+        total += dataset[zones.index(zone), channels.index(channel)]
+    return total
+
+
+def rebin(histogram: np.ndarray, bins: int = 128) -> tuple:
+    """
+    Rebins an intensity histogram to `bins` equal bins spanning the range of the
+    intensities, like `np.histogram` (and `plt.hist`) would on the pixel values.
+
+    Returns:
+    tuple: (counts, bin edges)
+    """
+    values = np.flatnonzero(histogram)
+    if values.size == 0:
+        return np.histogram([], bins=bins)
+
+    return np.histogram(
+        values,
+        bins=bins,
+        range=(values[0], values[-1]),
+        weights=histogram[values],
+    )
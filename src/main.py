@@ -1,48 +1,277 @@
 """
 Main entrypoint script for ROI segmentation and analysis.
+
+The segmentation, zoning and nuclei segmentation stages, which need scikit-image and
+SciPy, are imported by the functions running them, so that runs and worker processes
+doing only the analysis and correlation stages start without loading them.
 """
 
 import argparse
+import os
 
 import zarr
-from joblib import Parallel, delayed
-from segmentation_classes import ApicalInSegmenter, ApicalOutSegmenter
-from zoning_classes import ApicalInZoner, ApicalOutZoner
+from joblib import cpu_count, delayed
+
+import catalog
+import profiling
+import scheduling
 from analysis_classes import RoiAnalyzer
-from nuclei_segmentation import NucleiSegmenter
+from histograms import HistogramGenerator
+from measure_correlation import measure_correlation
 import pandas as pd
 
 
-def segment_roi(zarr_path: str, mix: str, roi: str):
+def segment_roi(zarr_path: str, mix: str, roi: str, threshold_method: str = None):
+    from segmentation_classes import ApicalInSegmenter, ApicalOutSegmenter
+
     if "_in_" in roi:
-        segmenter = ApicalInSegmenter(zarr_path, mix, roi)
-        segmenter.segment()
+        with profiling.span("segmentation", f"{mix}/apical_in/{roi}"):
+            segmenter = ApicalInSegmenter(
+                zarr_path, mix, roi, threshold_method=threshold_method
+            )
+            segmenter.segment()
     elif "_out_" in roi:
-        segmenter = ApicalOutSegmenter(zarr_path, mix, roi)
-        segmenter.segment()
+        with profiling.span("segmentation", f"{mix}/apical_out/{roi}"):
+            segmenter = ApicalOutSegmenter(zarr_path, mix, roi)
+            segmenter.segment()
+    else:
+        raise ValueError(f"Cannot infer apical type of ROI {roi}")
+
+
+def zone_roi(zarr_path: str, mix: str, roi: str, save_distances: bool = False):
+    from zoning_classes import ApicalInZoner, ApicalOutZoner
+
+    if "_in_" in roi:
+        with profiling.span("zoning", f"{mix}/apical_in/{roi}"):
+            zoner = ApicalInZoner(zarr_path, mix, roi)
+            zoner.generate(save_distances=save_distances)
+    elif "_out_" in roi:
+        with profiling.span("zoning", f"{mix}/apical_out/{roi}"):
+            zoner = ApicalOutZoner(zarr_path, mix, roi)
+            zoner.generate(save_distances=save_distances)
     else:
         raise ValueError(f"Cannot infer apical type of ROI {roi}")
 
 
-def zone_roi(zarr_path: str, mix: str, roi: str):
+def segmentation_is_current(
+    root: zarr.Group, mix: str, roi: str, threshold_method: str = None
+) -> bool:
+    from segmentation_classes import ApicalInSegmenter, ApicalOutSegmenter
+
     if "_in_" in roi:
-        zoner = ApicalInZoner(zarr_path, mix, roi)
-        zoner.generate()
+        return ApicalInSegmenter.is_up_to_date(root, mix, roi, threshold_method)
     elif "_out_" in roi:
-        zoner = ApicalOutZoner(zarr_path, mix, roi)
-        zoner.generate()
+        return ApicalOutSegmenter.is_up_to_date(root, mix, roi)
     else:
         raise ValueError(f"Cannot infer apical type of ROI {roi}")
 
 
-def segment_roi_nuclei(zarr_path: str, mix: str, apical_type: str, roi: str):
-    segmenter = NucleiSegmenter(zarr_path, f"{mix}/{apical_type}/{roi}")
-    segmenter.segment()
+def zoning_is_current(
+    root: zarr.Group, mix: str, roi: str, save_distances: bool = False
+) -> bool:
+    from zoning_classes import ApicalInZoner, ApicalOutZoner
+
+    if "_in_" in roi:
+        return ApicalInZoner.is_up_to_date(root, mix, roi, save_distances)
+    elif "_out_" in roi:
+        return ApicalOutZoner.is_up_to_date(root, mix, roi, save_distances)
+    else:
+        raise ValueError(f"Cannot infer apical type of ROI {roi}")
+
+
+def nuclei_segmentation_is_current(
+    root: zarr.Group, mix: str, apical_type: str, roi: str
+) -> bool:
+    from nuclei_segmentation import NucleiSegmenter
+
+    return NucleiSegmenter.is_up_to_date(root, f"{mix}/{apical_type}/{roi}")
+
+
+def segment_roi_nuclei(
+    zarr_path: str,
+    mix: str,
+    apical_type: str,
+    roi: str,
+    intra_op_threads: int = None,
+    memory_budget: int = None,
+):
+    from nuclei_segmentation import NucleiSegmenter
+
+    with profiling.span("nuclei_segmentation", f"{mix}/{apical_type}/{roi}"):
+        segmenter = NucleiSegmenter(
+            zarr_path,
+            f"{mix}/{apical_type}/{roi}",
+            intra_op_threads=intra_op_threads,
+            memory_budget=memory_budget,
+        )
+        segmenter.segment()
+
+
+def histograms_are_current(
+    root: zarr.Group, mix: str, apical_type: str, roi: str
+) -> bool:
+    return HistogramGenerator.is_up_to_date(root, mix, apical_type, roi)
+
+
+def generate_roi_histograms(zarr_path: str, mix: str, apical_type: str, roi: str):
+    with profiling.span("histograms", f"{mix}/{apical_type}/{roi}"):
+        generator = HistogramGenerator(zarr_path, mix, apical_type, roi)
+        generator.generate()
 
 
-def analyze_roi(zarr_path: str, mix: str, apical_type: str, roi: str):
-    analyzer = RoiAnalyzer(zarr_path, mix, apical_type, roi)
-    return analyzer.analyze()
+def roi_pixel_count(entry: dict) -> int:
+    height, width = entry["shape"][:2]
+    return height * width
+
+
+def analyze_roi(
+    zarr_path: str,
+    mix: str,
+    apical_type: str,
+    roi: str,
+    zone_thicknesses: list = None,
+) -> list:
+    with profiling.span("analysis", f"{mix}/{apical_type}/{roi}"):
+        analyzer = RoiAnalyzer(zarr_path, mix, apical_type, roi)
+        if zone_thicknesses:
+            return analyzer.analyze_thicknesses(zone_thicknesses)
+        return [analyzer.analyze()]
+
+
+def process_roi(
+    zarr_path: str,
+    mix: str,
+    apical_type: str,
+    roi: str,
+    skip_roi_segmentation: bool = False,
+    threshold_method: str = None,
+    skip_zoning: bool = False,
+    skip_nuclei_segmentation: bool = False,
+    skip_analysis: bool = False,
+    skip_histograms: bool = False,
+    incremental: bool = False,
+    zone_thicknesses: list = None,
+    intra_op_threads: int = None,
+    memory_budget: int = None,
+) -> list:
+    """
+    Run all pipeline stages for a single ROI in one worker.
+
+    The raw data is read from Zarr once and the outputs of each stage are handed
+    to the next stage in memory. Outputs are still persisted to Zarr by every stage.
+    Outputs of skipped stages are read from Zarr by the stages that need them.
+    In incremental mode, stages whose inputs and parameters are unchanged are skipped.
+    Returns the analysis rows of the ROI, one per zone thickness when sweeping.
+    """
+    from nuclei_segmentation import NucleiSegmenter
+    from segmentation_classes import ApicalInSegmenter, ApicalOutSegmenter
+    from zoning_classes import ApicalInZoner, ApicalOutZoner
+
+    save_distances = bool(zone_thicknesses)
+
+    roi_path = f"{mix}/{apical_type}/{roi}"
+
+    root = profiling.open_zarr(zarr_path, mode="r")
+    with profiling.span("read_raw_data", roi_path):
+        raw_data = root[f"{roi_path}/raw_data"][:]
+
+    if incremental is True:
+        skip_roi_segmentation = skip_roi_segmentation or segmentation_is_current(
+            root, mix, roi, threshold_method
+        )
+
+    segmentation = {}
+    if skip_roi_segmentation is False:
+        with profiling.span("segmentation", roi_path):
+            if apical_type == "apical_in":
+                segmenter = ApicalInSegmenter(
+                    zarr_path,
+                    mix,
+                    roi,
+                    img=raw_data,
+                    threshold_method=threshold_method,
+                )
+            else:
+                segmenter = ApicalOutSegmenter(zarr_path, mix, roi, img=raw_data)
+            segmentation = segmenter.segment()
+
+    if incremental is True:
+        skip_zoning = skip_zoning or zoning_is_current(root, mix, roi, save_distances)
+
+    zones = None
+    if skip_zoning is False:
+        with profiling.span("zoning", roi_path):
+            if apical_type == "apical_in":
+                zoner = ApicalInZoner(
+                    zarr_path,
+                    mix,
+                    roi,
+                    mask=segmentation.get("mask"),
+                    largest_hole_mask=segmentation.get("largest_hole"),
+                    raw_data=raw_data,
+                )
+            else:
+                zoner = ApicalOutZoner(
+                    zarr_path,
+                    mix,
+                    roi,
+                    mask=segmentation.get("mask"),
+                    raw_data=raw_data,
+                )
+            zones = zoner.generate(save_distances=save_distances)
+
+    if incremental is True:
+        skip_nuclei_segmentation = (
+            skip_nuclei_segmentation
+            or nuclei_segmentation_is_current(root, mix, apical_type, roi)
+        )
+
+    if skip_nuclei_segmentation is False:
+        with profiling.span("nuclei_segmentation", roi_path):
+            segmenter = NucleiSegmenter(
+                zarr_path,
+                roi_path,
+                dapi=raw_data[:, :, 0],
+                mask=segmentation.get("mask"),
+                intra_op_threads=intra_op_threads,
+                memory_budget=memory_budget,
+            )
+            segmenter.segment()
+
+    if incremental is True:
+        skip_histograms = skip_histograms or histograms_are_current(
+            root, mix, apical_type, roi
+        )
+
+    if skip_histograms is False:
+        with profiling.span("histograms", roi_path):
+            generator = HistogramGenerator(
+                zarr_path,
+                mix,
+                apical_type,
+                roi,
+                raw_data=raw_data,
+                roi_mask=segmentation.get("mask"),
+                zones=zones,
+            )
+            generator.generate()
+
+    if skip_analysis is False:
+        with profiling.span("analysis", roi_path):
+            analyzer = RoiAnalyzer(
+                zarr_path,
+                mix,
+                apical_type,
+                roi,
+                raw_data=raw_data,
+                roi_mask=segmentation.get("mask"),
+                zones=zones,
+            )
+            if zone_thicknesses:
+                return analyzer.analyze_thicknesses(zone_thicknesses)
+            return [analyzer.analyze()]
+
+    return []
 
 
 if __name__ == "__main__":
@@ -67,6 +296,14 @@ if __name__ == "__main__":
         help="Skip the ROI segmentation step",
     )
 
+    parser.add_argument(
+        "--threshold-method",
+        choices=["gaussian", "integral"],
+        default=None,
+        help="Local threshold backend of the apical-in ROI segmentation. "
+        "Defaults to segmentation_classes.THRESHOLD_METHOD.",
+    )
+
     parser.add_argument(
         "--skip-zoning", action="store_true", help="Skip the zoning step"
     )
@@ -81,58 +318,345 @@ if __name__ == "__main__":
         "--skip-analysis", action="store_true", help="Skip the analysis step"
     )
 
+    parser.add_argument(
+        "--skip-histograms",
+        action="store_true",
+        help="Skip storing the per-zone intensity histograms used by the EDA plots",
+    )
+
+    parser.add_argument(
+        "--skip-correlation",
+        action="store_true",
+        help="Skip measuring the channel correlations in the ROIs and their zones",
+    )
+
+    parser.add_argument(
+        "--correlation-dir",
+        type=str,
+        default=None,
+        help="Directory of the correlation CSV files. Defaults to the directory of --csv-path.",
+    )
+
+    parser.add_argument(
+        "--nuclei-jobs",
+        type=int,
+        default=1,
+        help="Number of nuclei segmentation workers, each loading its own StarDist model",
+    )
+
+    parser.add_argument(
+        "--tf-threads",
+        type=int,
+        default=None,
+        help="TensorFlow intra-op threads per nuclei segmentation or fused worker. "
+        "Defaults to splitting the CPU cores evenly between the workers.",
+    )
+
+    parser.add_argument(
+        "--zone-thicknesses",
+        type=int,
+        nargs="+",
+        help="Store distance maps during zoning and report the analysis for each of these zone thicknesses",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip ROIs whose stage inputs and parameters are unchanged since the last run",
+    )
+
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Run all stages per ROI in a single worker, keeping intermediates in memory",
+    )
+
+    parser.add_argument(
+        "--fused-jobs",
+        type=int,
+        default=-1,
+        help="Number of parallel workers in fused mode. Use 1 when nuclei segmentation runs on a GPU.",
+    )
+
+    parser.add_argument(
+        "--nuclei-memory-gb",
+        type=float,
+        default=None,
+        help="Memory budget per nuclei segmentation worker, used to choose the number of inference tiles",
+    )
+
+    parser.add_argument(
+        "--memory-budget-gb",
+        type=float,
+        default=None,
+        help="Memory shared by the workers of a stage. ROIs are only started while their "
+        "estimated memory fits. Defaults to 80%% of the memory of the node.",
+    )
+
+    parser.add_argument(
+        "--profile-dir",
+        type=str,
+        default=None,
+        help="Record the time, memory and I/O of every stage and ROI in this directory. "
+        f"Can also be set with the {profiling.PROFILE_DIR_ENV} environment variable.",
+    )
+
     args = parser.parse_args()
 
+    # before the workers are started, so they inherit the setting
+    if args.profile_dir is not None:
+        profiling.enable(args.profile_dir)
+
+    nuclei_memory_budget = None
+    if args.nuclei_memory_gb is not None:
+        nuclei_memory_budget = int(args.nuclei_memory_gb * 1024**3)
+
+    memory_budget = None
+    if args.memory_budget_gb is not None:
+        memory_budget = int(args.memory_budget_gb * 1024**3)
+
+    # StarDist runs in the fused workers, or in the nuclei segmentation workers
+    inference_jobs = args.fused_jobs if args.fused else args.nuclei_jobs
+    if inference_jobs < 0:
+        inference_jobs = max(1, cpu_count() + 1 + inference_jobs)
+    if args.tf_threads is None and inference_jobs > 1:
+        args.tf_threads = max(1, cpu_count() // inference_jobs)
+
     root = zarr.open(args.zarr_path, mode="r")
+    entries = catalog.read_catalog(args.zarr_path)
 
-    if args.skip_roi_segmentation is False:
-        mixes = list(root.keys())
-        assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
+    # the consolidated metadata is brought up to date also when a stage fails
+    with catalog.updated_after(args.zarr_path):
+        if args.fused is True:
+            mixes = catalog.mixes(entries)
+            assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
 
-        rois = []
-        for mix in mixes:
-            rois.extend(
-                (args.zarr_path, mix, roi)
-                for roi in list(root[mix]["apical_in"].keys())
-                + list(root[mix]["apical_out"].keys())
-            )
+            rois = [
+                entry
+                for mix in mixes
+                for apical_type in ["apical_in", "apical_out"]
+                for entry in catalog.select(entries, mix, apical_type)
+            ]
 
-        print("Segmenting ROIs...")
-        Parallel(n_jobs=-1, verbose=10)(delayed(segment_roi)(*roi) for roi in rois)
+            print("Processing ROIs...")
+            with profiling.span("fused"):
+                analysis_data = scheduling.schedule(
+                    [
+                        delayed(process_roi)(
+                            args.zarr_path,
+                            entry["mix"],
+                            entry["apical_type"],
+                            entry["roi"],
+                            skip_roi_segmentation=args.skip_roi_segmentation,
+                            threshold_method=args.threshold_method,
+                            skip_zoning=args.skip_zoning,
+                            skip_nuclei_segmentation=args.skip_nuclei_segmentation,
+                            skip_analysis=args.skip_analysis,
+                            skip_histograms=args.skip_histograms,
+                            incremental=args.incremental,
+                            zone_thicknesses=args.zone_thicknesses,
+                            intra_op_threads=args.tf_threads,
+                            memory_budget=nuclei_memory_budget,
+                        )
+                        for entry in rois
+                    ],
+                    [roi_pixel_count(entry) for entry in rois],
+                    "fused",
+                    n_jobs=args.fused_jobs,
+                    memory_budget=memory_budget,
+                    nuclei_memory_budget=nuclei_memory_budget,
+                    inference=not args.skip_nuclei_segmentation,
+                )
+            catalog.write_catalog(args.zarr_path)
 
-    if args.skip_zoning is False:
-        mixes = list(root.keys())
-        assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
+            if args.skip_analysis is False:
+                analysis_df = pd.DataFrame(
+                    [row for roi_rows in analysis_data for row in roi_rows]
+                )
+                analysis_df.to_csv(args.csv_path, index=False)
 
-        rois = []
-        for mix in mixes:
-            rois.extend(
-                (args.zarr_path, mix, roi)
-                for roi in list(root[mix]["apical_in"].keys())
-                + list(root[mix]["apical_out"].keys())
-            )
+        else:
+            if args.skip_roi_segmentation is False:
+                mixes = catalog.mixes(entries)
+                assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
 
-        print("Generating ROI zones...")
-        Parallel(n_jobs=6, verbose=10)(delayed(zone_roi)(*roi) for roi in rois)
+                rois = [
+                    entry
+                    for mix in mixes
+                    for apical_type in ["apical_in", "apical_out"]
+                    for entry in catalog.select(entries, mix, apical_type)
+                ]
 
-    if args.skip_nuclei_segmentation is False:
-        Parallel(n_jobs=1, verbose=10)(
-            delayed(segment_roi_nuclei)(args.zarr_path, mix, apical_type, roi)
-            for mix in list(root.keys())
-            for apical_type in list(root[mix].keys())
-            for roi in list(root[mix][apical_type].keys())
-        )
+                if args.incremental is True:
+                    rois = [
+                        entry
+                        for entry in rois
+                        if not segmentation_is_current(
+                            root, entry["mix"], entry["roi"], args.threshold_method
+                        )
+                    ]
 
-    if args.skip_analysis is False:
-        mixes = list(root.keys())
-        assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
+                print("Segmenting ROIs...")
+                with profiling.span("segmentation"):
+                    scheduling.schedule(
+                        [
+                            delayed(segment_roi)(
+                                args.zarr_path,
+                                entry["mix"],
+                                entry["roi"],
+                                args.threshold_method,
+                            )
+                            for entry in rois
+                        ],
+                        [roi_pixel_count(entry) for entry in rois],
+                        "segmentation",
+                        memory_budget=memory_budget,
+                    )
+                entries = catalog.write_catalog(args.zarr_path)
 
-        analysis_data = Parallel(n_jobs=-1, verbose=8)(
-            delayed(analyze_roi)(args.zarr_path, mix, apical_type, roi)
-            for mix in mixes
-            for apical_type in list(root[mix].keys())
-            for roi in list(root[mix][apical_type].keys())
-        )
+            if args.skip_zoning is False:
+                mixes = catalog.mixes(entries)
+                assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
+
+                rois = [
+                    entry
+                    for mix in mixes
+                    for apical_type in ["apical_in", "apical_out"]
+                    for entry in catalog.select(entries, mix, apical_type)
+                ]
+
+                if args.incremental is True:
+                    rois = [
+                        entry
+                        for entry in rois
+                        if not zoning_is_current(
+                            root,
+                            entry["mix"],
+                            entry["roi"],
+                            bool(args.zone_thicknesses),
+                        )
+                    ]
+
+                print("Generating ROI zones...")
+                with profiling.span("zoning"):
+                    scheduling.schedule(
+                        [
+                            delayed(zone_roi)(
+                                args.zarr_path,
+                                entry["mix"],
+                                entry["roi"],
+                                save_distances=bool(args.zone_thicknesses),
+                            )
+                            for entry in rois
+                        ],
+                        [roi_pixel_count(entry) for entry in rois],
+                        "zoning",
+                        n_jobs=6,
+                        memory_budget=memory_budget,
+                    )
+                entries = catalog.write_catalog(args.zarr_path)
+
+            if args.skip_nuclei_segmentation is False:
+                rois = entries
+
+                if args.incremental is True:
+                    rois = [
+                        entry
+                        for entry in rois
+                        if not nuclei_segmentation_is_current(
+                            root, entry["mix"], entry["apical_type"], entry["roi"]
+                        )
+                    ]
+
+                print("Segmenting nuclei...")
+                with profiling.span("nuclei_segmentation"):
+                    scheduling.schedule(
+                        [
+                            delayed(segment_roi_nuclei)(
+                                args.zarr_path,
+                                entry["mix"],
+                                entry["apical_type"],
+                                entry["roi"],
+                                intra_op_threads=args.tf_threads,
+                                memory_budget=nuclei_memory_budget,
+                            )
+                            for entry in rois
+                        ],
+                        [roi_pixel_count(entry) for entry in rois],
+                        "nuclei_segmentation",
+                        n_jobs=args.nuclei_jobs,
+                        memory_budget=memory_budget,
+                        nuclei_memory_budget=nuclei_memory_budget,
+                    )
+                entries = catalog.write_catalog(args.zarr_path)
+
+            if args.skip_histograms is False:
+                rois = entries
+
+                if args.incremental is True:
+                    rois = [
+                        entry
+                        for entry in rois
+                        if not histograms_are_current(
+                            root, entry["mix"], entry["apical_type"], entry["roi"]
+                        )
+                    ]
+
+                print("Generating intensity histograms...")
+                with profiling.span("histograms"):
+                    scheduling.schedule(
+                        [
+                            delayed(generate_roi_histograms)(
+                                args.zarr_path,
+                                entry["mix"],
+                                entry["apical_type"],
+                                entry["roi"],
+                            )
+                            for entry in rois
+                        ],
+                        [roi_pixel_count(entry) for entry in rois],
+                        "histograms",
+                        memory_budget=memory_budget,
+                    )
+                entries = catalog.write_catalog(args.zarr_path)
+
+            if args.skip_analysis is False:
+                mixes = catalog.mixes(entries)
+                assert len(mixes) == 2, "Expected 2 mixes in the Zarr file"
+
+                with profiling.span("analysis"):
+                    analysis_data = scheduling.schedule(
+                        [
+                            delayed(analyze_roi)(
+                                args.zarr_path,
+                                entry["mix"],
+                                entry["apical_type"],
+                                entry["roi"],
+                                args.zone_thicknesses,
+                            )
+                            for entry in entries
+                        ],
+                        [roi_pixel_count(entry) for entry in entries],
+                        "analysis",
+                        memory_budget=memory_budget,
+                    )
+
+                analysis_df = pd.DataFrame(
+                    [row for roi_rows in analysis_data for row in roi_rows]
+                )
+                analysis_df.to_csv(args.csv_path, index=False)
+
+    if args.skip_correlation is False:
+        correlation_dir = args.correlation_dir
+        if correlation_dir is None:
+            correlation_dir = os.path.dirname(os.path.abspath(args.csv_path))
+
+        print("Measuring correlations...")
+        with profiling.span("correlation"):
+            measure_correlation(
+                args.zarr_path, correlation_dir, memory_budget=memory_budget
+            )
 
-        analysis_df = pd.DataFrame(analysis_data)
-        analysis_df.to_csv(args.csv_path, index=False)
+    if profiling.enabled():
+        report = profiling.load_report(profiling.profile_dir())
+        print(profiling.summarize(report).round(3).to_string(index=False))
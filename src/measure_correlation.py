@@ -2,256 +2,131 @@
 Code to measure correlation between different signals in ROIs.
 
 Correlation analysis of intensity HER2 vs HER3 and HER2 vs SORLA within on patient samples for 1) whole region, (apical-in and apical-out), and for 2) basal and apical pole zones separately. Plot the correlations for each individual ROI and for average per patient.
+
+The per-ROI sufficient statistics are stored as well, see `correlation_statistics.py` for
+pooling them per patient.
 """
 
+import argparse
 import os
+from typing import Optional
 
-import numpy as np
 import pandas as pd
-import zarr
-from scipy.stats import pearsonr
-from tqdm import tqdm
+from joblib import delayed
+
+import catalog
+import profiling
+import scheduling
+from correlation_statistics import (
+    MIX_CH_NAMES,
+    STATISTICS_CSV,
+    statistics_rows,
+    summarize,
+)
+from zone_statistics import count_labels_in_zones, stream_zone_moments
 
 ZARR_PATH = os.path.join(os.path.dirname(__file__), "..", "zarr_data", "roi_data.zarr")
 
-MIX_1_CH_NAMES = ["HER2", "SORLA"]
-MIX_2_CH_NAMES = ["HER2", "HER3"]
-
-PIXEL_SIZE = 0.325  # um
-
-root = zarr.open(ZARR_PATH, mode="r")
-mixes = list(root.keys())
-rois = [
-    (mix, apical_type, roi)
-    for mix in mixes
-    for apical_type in list(root[mix].keys())
-    for roi in list(root[mix][apical_type].keys())
-]
-
-
-def _normalize_intensity_to_area(roi: np.ndarray, mask: np.ndarray) -> float:
-    assert roi.shape == mask.shape, "ROI and mask must have the same shape."
-    roi_pixels = roi[mask]
-    mask_um_area = np.count_nonzero(mask) * PIXEL_SIZE
-
-    return roi_pixels.sum() / mask_um_area
-
-
-def _normalize_intensity_to_nuclei(
-    roi: np.ndarray, nuclei_labels: np.ndarray, mask: np.ndarray
-) -> float:
-    assert (
-        nuclei_labels.shape == mask.shape
-    ), "Nuclei labels and mask must have the same shape."
-
-    roi_pixels = roi[mask]
-    masked_nuclei_labels = np.copy(nuclei_labels)
-    masked_nuclei_labels[mask == 0] = 0
-    # masked_nuclei_labels = np.array(nuclei_labels)[mask]
-
-    nuclei_count = np.count_nonzero(np.unique(masked_nuclei_labels))
-    print(nuclei_count)
-
-    return roi_pixels.sum() / nuclei_count
 
+def measure_roi(zarr_path: str, mix: str, apical_type: str, roi: str) -> list:
+    """
+    Measures the sufficient statistics of the zones of an ROI: the whole ROI, the
+    apical and the basal zone of apical-in ROIs, and the whole ROI and the apical zone
+    of apical-out ROIs.
 
-mix_1_data = []
-mix_2_data = []
-
-# apical-in
-for item in tqdm(rois):
-    mix, apical_type, roi = item
-
-    if apical_type == "apical_out":
-        continue
+    Returns:
+    list: One row of statistics per zone, see `correlation_statistics.statistics_rows`.
+    """
+    if mix not in MIX_CH_NAMES:
+        raise ValueError(f"Unknown mix: {mix}")
 
-    # process apical_in types
+    root = profiling.open_zarr(zarr_path, mode="r")
     roi_path = root[f"{mix}/{apical_type}/{roi}"]
 
     raw_data = roi_path["raw_data"]
     roi_mask = roi_path["segmentation"]["mask"]
-    apical_mask = roi_path["segmentation"]["zones"].get(
-        "inner_manual", roi_path["segmentation"]["zones"]["inner"]
-    )
-    basal_mask = roi_path["segmentation"]["zones"]["outer"]
-
-    ch2_roi = raw_data[:, :, 1][roi_mask]
-    ch3_roi = raw_data[:, :, 2][roi_mask]
-
-    ch2_apical = raw_data[:, :, 1][apical_mask]
-    ch2_basal = raw_data[:, :, 1][basal_mask]
-
-    ch3_apical = raw_data[:, :, 2][apical_mask]
-    ch3_basal = raw_data[:, :, 2][basal_mask]
-
-    if mix == "mix_1":
-        ch2_name, ch3_name = MIX_1_CH_NAMES
-    elif mix == "mix_2":
-        ch2_name, ch3_name = MIX_2_CH_NAMES
-    else:
-        raise ValueError(f"Unknown mix: {mix}")
-
-    # data for whole roi
-    whole_roi_data = {
-        "roi": roi,
-        "mix": mix,
-        "roi_type": apical_type,
-        "zone": "whole_roi",
-        f"{ch2_name}_total_intensity": ch2_roi.sum(),
-        f"{ch2_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 1], roi_mask
-        ),
-        f"{ch2_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 1], roi_path["segmentation"]["nuclei"], roi_mask
-        ),
-        f"{ch3_name}_total_intensity": ch3_roi.sum(),
-        f"{ch3_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 2], roi_mask
-        ),
-        f"{ch3_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 2], roi_path["segmentation"]["nuclei"], roi_mask
-        ),
-        f"{ch2_name}_{ch3_name}_correlation": (
-            pearsonr(ch2_roi, ch3_roi)[0] if len(ch2_roi) > 0 else 0
-        ),
-    }
-
-    # data for apical zone
-
-    apical_data = {
-        "roi": roi,
-        "mix": mix,
-        "roi_type": apical_type,
-        "zone": "apical",
-        f"{ch2_name}_total_intensity": ch2_apical.sum(),
-        f"{ch2_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 1], apical_mask
-        ),
-        f"{ch2_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 1], roi_path["segmentation"]["nuclei"], apical_mask
-        ),
-        f"{ch3_name}_total_intensity": ch3_apical.sum(),
-        f"{ch3_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 2], apical_mask
-        ),
-        f"{ch3_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 2], roi_path["segmentation"]["nuclei"], apical_mask
-        ),
-        f"{ch2_name}_{ch3_name}_correlation": (
-            pearsonr(ch2_apical, ch3_apical)[0] if len(ch2_apical) > 0 else 0
-        ),
-    }
-
-    # data for basal zone
-    basal_data = {
-        "roi": roi,
-        "mix": mix,
-        "roi_type": apical_type,
-        "zone": "basal",
-        f"{ch2_name}_total_intensity": ch2_basal.sum(),
-        f"{ch2_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 1], basal_mask
-        ),
-        f"{ch2_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 1], roi_path["segmentation"]["nuclei"], basal_mask
-        ),
-        f"{ch3_name}_total_intensity": ch3_basal.sum(),
-        f"{ch3_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 2], basal_mask
-        ),
-        f"{ch3_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 2], roi_path["segmentation"]["nuclei"], basal_mask
-        ),
-        f"{ch2_name}_{ch3_name}_correlation": (
-            pearsonr(ch2_basal, ch3_basal)[0] if len(ch2_basal) > 0 else 0
-        ),
-    }
-
-    if mix == "mix_1":
-        mix_1_data.extend([whole_roi_data, apical_data, basal_data])
-    elif mix == "mix_2":
-        mix_2_data.extend([whole_roi_data, apical_data, basal_data])
-
-# apical-out
-for item in tqdm(rois):
-    mix, apical_type, roi = item
+    nuclei_labels = roi_path["segmentation"]["nuclei"]
 
     if apical_type == "apical_in":
-        continue
-
-    roi_path = root[f"{mix}/{apical_type}/{roi}"]
-    raw_data = roi_path["raw_data"]
-    roi_mask = roi_path["segmentation"]["mask"]
-    apical_mask = roi_path["segmentation"]["zones"]["outer"]
-
-    ch2_roi = raw_data[:, :, 1][roi_mask]
-    ch3_roi = raw_data[:, :, 2][roi_mask]
-
-    ch2_apical = raw_data[:, :, 1][apical_mask]
-    ch3_apical = raw_data[:, :, 2][apical_mask]
-
-    if mix == "mix_1":
-        ch2_name, ch3_name = MIX_1_CH_NAMES
-    elif mix == "mix_2":
-        ch2_name, ch3_name = MIX_2_CH_NAMES
+        apical_mask = roi_path["segmentation"]["zones"].get(
+            "inner_manual", roi_path["segmentation"]["zones"]["inner"]
+        )
+        basal_mask = roi_path["segmentation"]["zones"]["outer"]
+        masks = [roi_mask, apical_mask, basal_mask]
+        zones = ["whole_roi", "apical", "basal"]
     else:
-        raise ValueError(f"Unknown mix: {mix}")
+        apical_mask = roi_path["segmentation"]["zones"]["outer"]
+        masks = [roi_mask, apical_mask]
+        zones = ["whole_roi", "apical"]
 
-    # data for whole
+    height, width = raw_data.shape[:2]
+    with profiling.span("correlation", roi_path.path, height * width):
+        # n, sums, sums of squares and cross products of both channels in all zones
+        with profiling.span("stream_zone_moments"):
+            moments = stream_zone_moments(raw_data, (1, 2), masks)
 
-    whole_roi_data = {
-        "roi": roi,
-        "mix": mix,
-        "roi_type": apical_type,
-        "zone": "whole_roi",
-        f"{ch2_name}_total_intensity": ch2_roi.sum(),
-        f"{ch2_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 1], roi_mask
-        ),
-        f"{ch3_name}_total_intensity": ch3_roi.sum(),
-        f"{ch3_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 2], roi_mask
-        ),
-        f"{ch2_name}_{ch3_name}_correlation": (
-            pearsonr(ch2_roi, ch3_roi)[0] if len(ch2_roi) > 0 else 0
-        ),
-    }
+        with profiling.span("count_labels_in_zones"):
+            nuclei_counts = list(count_labels_in_zones(nuclei_labels, masks))
 
-    # data for apical zone
+    if apical_type == "apical_out":
+        # no nuclei normalization for the whole apical-out ROI
+        nuclei_counts[0] = None
+
+    return statistics_rows(roi, mix, apical_type, zones, moments, nuclei_counts)
+
+
+def measure_correlation(
+    zarr_path: str,
+    output_dir: str = ".",
+    n_jobs: int = -1,
+    memory_budget: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Measures all ROIs in parallel, largest first within `memory_budget`, and writes the
+    sufficient statistics and the per-ROI correlations of each mix as CSV files to
+    `output_dir`.
+
+    Returns:
+    pd.DataFrame: The sufficient statistics of every zone of every ROI.
+    """
+    entries = catalog.read_catalog(zarr_path)
+
+    roi_rows = scheduling.schedule(
+        [
+            delayed(measure_roi)(
+                zarr_path, entry["mix"], entry["apical_type"], entry["roi"]
+            )
+            for entry in entries
+        ],
+        [entry["shape"][0] * entry["shape"][1] for entry in entries],
+        "correlation",
+        n_jobs=n_jobs,
+        memory_budget=memory_budget,
+    )
 
-    apical_data = {
-        "roi": roi,
-        "mix": mix,
-        "roi_type": apical_type,
-        "zone": "apical",
-        f"{ch2_name}_total_intensity": ch2_apical.sum(),
-        f"{ch2_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 1], apical_mask
-        ),
-        f"{ch2_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 1], roi_path["segmentation"]["nuclei"], apical_mask
-        ),
-        f"{ch3_name}_total_intensity": ch3_apical.sum(),
-        f"{ch3_name}_normalized_intensity_area": _normalize_intensity_to_area(
-            raw_data[:, :, 2], apical_mask
-        ),
-        f"{ch3_name}_normalized_intensity_nuclei": _normalize_intensity_to_nuclei(
-            raw_data[:, :, 2], roi_path["segmentation"]["nuclei"], apical_mask
-        ),
-        f"{ch2_name}_{ch3_name}_correlation": (
-            pearsonr(ch2_apical, ch3_apical)[0] if len(ch2_apical) > 0 else 0
-        ),
-    }
+    # sufficient statistics for pooling the ROIs, see correlation_statistics.py
+    statistics_df = pd.DataFrame([row for rows in roi_rows for row in rows])
+    os.makedirs(output_dir, exist_ok=True)
+    statistics_df.to_csv(os.path.join(output_dir, STATISTICS_CSV), index=False)
 
-    if mix == "mix_1":
-        mix_1_data.extend([whole_roi_data, apical_data])
-    elif mix == "mix_2":
-        mix_2_data.extend([whole_roi_data, apical_data])
+    for mix in catalog.mixes(entries):
+        mix_df = summarize(statistics_df, "roi", mix)
+        mix_df.to_csv(os.path.join(output_dir, f"correlation_{mix}.csv"), index=False)
 
+    return statistics_df
 
-mix_1_df = pd.DataFrame(mix_1_data)
-mix_1_df.to_csv("correlation_mix_1.csv", index=False)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the correlation of the channels in the ROIs and their zones."
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--output-dir", type=str, default=".", help="Directory of the CSV outputs"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=-1, help="Number of ROIs measured in parallel"
+    )
+    args = parser.parse_args()
 
-mix_2_df = pd.DataFrame(mix_2_data)
-mix_2_df.to_csv("correlation_mix_2.csv", index=False)
+    measure_correlation(args.zarr_path, args.output_dir, args.jobs)
@@ -1,50 +1,191 @@
 """
 Contains classes for nuclei segmentation
+
+TensorFlow and StarDist are imported when the model is first needed, so importing this
+module, e.g. when unpickling pipeline functions in a worker process, stays cheap.
 """
 
+import math
+from typing import Optional
+
 import numpy as np
 import zarr
 from skimage import img_as_uint
-from stardist.models import StarDist2D
-from csbdeep.utils import normalize
-from skimage.measure import regionprops
+
+import cropping
+import profiling
+import provenance
+import storage
 
 SIZE_THRESHOLD = 150
+MODEL_NAME = "2D_versatile_fluo"
 
+# percentiles used by csbdeep.utils.normalize
+NORMALIZE_PMIN = 3
+NORMALIZE_PMAX = 99.8
 
-class NucleiSegmenter:
+# Inference runs on the bounding box of the ROI mask, padded by this many pixels of
+# (zeroed) background so that nuclei at the ROI edge see the same context as before.
+INFERENCE_MARGIN = 64
+
+# Rough peak memory of StarDist inference per input pixel, used to pick `n_tiles`.
+INFERENCE_BYTES_PER_PIXEL = 1024
+INFERENCE_MEMORY_BUDGET = 4 * 1024**3
+
+
+_model = None
+
+
+def get_model(intra_op_threads: Optional[int] = None) -> "StarDist2D":
+    """
+    Returns the pre-trained StarDist model, loading it once per process.
+
+    Args:
+    intra_op_threads (int, optional): Number of threads TensorFlow may use within a single
+        operation. Only applied when the model is loaded, before TensorFlow initializes.
+    """
+    global _model
+
+    if _model is None:
+        if intra_op_threads is not None:
+            import tensorflow as tf
+
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+
+        from stardist.models import StarDist2D
+
+        _model = StarDist2D.from_pretrained(MODEL_NAME)
+
+    return _model
+
+
+def _filter_labels(
+    labels: np.ndarray, mask: np.ndarray, size_threshold: int = None
+) -> np.ndarray:
+    """
+    Removes labels that overlap with the background or are smaller than `size_threshold`.
+
+    Per-label areas and background overlaps are counted with one `np.bincount` each,
+    and the labels are then remapped at once with a lookup table.
+    """
+    if size_threshold is None:
+        size_threshold = SIZE_THRESHOLD
 
-    model = StarDist2D.from_pretrained("2D_versatile_fluo")
+    n_labels = int(labels.max()) + 1 if labels.size else 1
+    areas = np.bincount(labels.ravel(), minlength=n_labels)
+    background_overlap = np.bincount(labels[mask == 0], minlength=n_labels)
 
-    def __init__(self, zarr_path: str, sample_path: str):
+    keep = (areas >= size_threshold) & (background_overlap == 0)
+    keep[0] = False
+
+    lookup = np.where(keep, np.arange(n_labels), 0).astype(labels.dtype)
+    return lookup[labels]
+
+
+def _n_tiles(shape: tuple, memory_budget: int = None) -> tuple:
+    """
+    Returns the number of tiles per axis needed to keep StarDist inference on an image of
+    the given shape within `memory_budget` bytes. Tiles are kept roughly square.
+    """
+    if memory_budget is None:
+        memory_budget = INFERENCE_MEMORY_BUDGET
+
+    height, width = shape
+    n_total = math.ceil(height * width * INFERENCE_BYTES_PER_PIXEL / memory_budget)
+    if n_total <= 1:
+        return (1, 1)
+
+    n_y = max(1, min(n_total, round(math.sqrt(n_total * height / width))))
+    n_x = math.ceil(n_total / n_y)
+    return (n_y, n_x)
+
+
+class NucleiSegmenter:
+    stage = "nuclei_segmentation"
+    outputs = ["segmentation/nuclei"]
+
+    def __init__(
+        self,
+        zarr_path: str,
+        sample_path: str,
+        dapi: Optional[np.ndarray] = None,
+        mask: Optional[np.ndarray] = None,
+        intra_op_threads: Optional[int] = None,
+        memory_budget: Optional[int] = None,
+    ):
         self.zarr_path = zarr_path
-        self.root = zarr.open(zarr_path, mode="a")
+        self.root = profiling.open_zarr(zarr_path, mode="a")
         self.sample_path = sample_path
+        self.dapi = dapi
+        self.mask = mask
+        self.intra_op_threads = intra_op_threads
+        self.memory_budget = memory_budget
+
+    @property
+    def model(self) -> "StarDist2D":
+        return get_model(self.intra_op_threads)
+
+    @staticmethod
+    def parameters() -> dict:
+        return {
+            "size_threshold": SIZE_THRESHOLD,
+            "model": MODEL_NAME,
+            "normalize_percentiles": [NORMALIZE_PMIN, NORMALIZE_PMAX],
+            "inference_margin": INFERENCE_MARGIN,
+        }
+
+    @staticmethod
+    def _input_hashes(
+        root: zarr.Group, sample_path: str, mask: Optional[np.ndarray] = None
+    ) -> dict:
+        segmentation = root[sample_path]["segmentation"]
+        return {
+            "raw_data": provenance.dataset_hash(root[sample_path]["raw_data"]),
+            "mask": provenance.dataset_hash(segmentation["mask"], mask),
+        }
+
+    @classmethod
+    def is_up_to_date(cls, root: zarr.Group, sample_path: str) -> bool:
+        outputs = [f"{sample_path}/{output}" for output in cls.outputs]
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: cls._input_hashes(root, sample_path),
+            cls.parameters(),
+        )
 
+    @profiling.profiled_stage
     def segment(self) -> np.ndarray:
         """
         Segments the nuclei in the sample image and stores the segmentation labels in a dataset.
 
         This method applies a pre-trained StarDist model to predict the instances of nuclei in the sample image.
+        Inference is restricted to the bounding box of the ROI mask and tiled to stay within the memory budget.
         It then removes the labels of regions that overlap with the background or are smaller than a size threshold.
         The segmentation labels are stored in a Zarr dataset.
 
+        If the DAPI plane and ROI mask were passed to the constructor they are used as-is,
+        otherwise they are read from the Zarr dataset.
+
         Returns:
         np.ndarray: The segmentation labels of the nuclei in the sample image.
         """
-        dapi = self.root[self.sample_path]["raw_data"][:, :, 0]
+        dapi = self.dapi
+        if dapi is None:
+            dapi = storage.read_channel(self.root[self.sample_path]["raw_data"], "DAPI")
+
+        mask = self.mask
+        if mask is None:
+            mask = np.array(self.root[self.sample_path]["segmentation"]["mask"])
 
-        mask = np.array(self.root[self.sample_path]["segmentation"]["mask"])
+        inputs = self._input_hashes(self.root, self.sample_path, mask)
 
-        dapi[~mask] = 0
+        dapi = np.where(mask, dapi, 0).astype(dapi.dtype)
 
-        labels, _ = self.model.predict_instances(normalize(dapi))
+        labels = self._predict(dapi, mask)
 
-        mask_bg = mask == 0
-        for item in regionprops(labels):
-            overlap = np.logical_and((labels == item.label), mask_bg)
-            if np.any(overlap) or item.area < SIZE_THRESHOLD:
-                labels[labels == item.label] = 0
+        with profiling.span("filter_labels"):
+            labels = _filter_labels(labels, mask)
 
         labels = img_as_uint(labels)
 
@@ -54,9 +195,30 @@ class NucleiSegmenter:
         if label_path in self.root:
             del self.root[label_path]
 
-        label_dataset = self.root.create_dataset(label_path, data=labels)
+        label_dataset = storage.create_dataset(self.root, label_path, labels, "labels")
         label_dataset.attrs.update(
             {"author": "Turku BioImaging", "description": "Nuclei segmentation labels"}
         )
+        provenance.record(label_dataset, labels, self.stage, inputs, self.parameters())
+
+        return labels
+
+    def _predict(self, dapi: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        from csbdeep.utils import normalize_mi_ma
+
+        labels = np.zeros(dapi.shape, dtype=np.int32)
+
+        bbox = cropping.bounding_box(mask, INFERENCE_MARGIN)
+        if bbox is None:
+            return labels
+
+        # normalize with the percentiles of the full plane, as csbdeep's normalize would
+        mi, ma = np.percentile(dapi, [NORMALIZE_PMIN, NORMALIZE_PMAX])
+        img = normalize_mi_ma(dapi[bbox], mi, ma)
+
+        n_tiles = _n_tiles(img.shape, self.memory_budget)
+        with profiling.span("predict_instances"):
+            crop_labels, _ = self.model.predict_instances(img, n_tiles=n_tiles)
 
+        labels[bbox] = crop_labels
         return labels
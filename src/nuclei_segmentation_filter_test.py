@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from skimage.draw import disk
+from skimage.measure import regionprops
+
+from nuclei_segmentation import SIZE_THRESHOLD, _filter_labels
+
+
+def _reference_filter(labels, mask):
+    # per-nucleus loop used before the lookup-table implementation
+    labels = labels.copy()
+    mask_bg = mask == 0
+    for item in regionprops(labels):
+        overlap = np.logical_and((labels == item.label), mask_bg)
+        if np.any(overlap) or item.area < SIZE_THRESHOLD:
+            labels[labels == item.label] = 0
+    return labels
+
+
+def _random_labels(shape, n_nuclei, seed):
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for label in rng.permutation(np.arange(1, n_nuclei + 1)):
+        center = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        rr, cc = disk(center, rng.integers(3, 12), shape=shape)
+        labels[rr, cc] = label
+    return labels
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_filter_labels_matches_reference(seed):
+    shape = (300, 280)
+    labels = _random_labels(shape, 200, seed)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    mask = np.hypot(yy - 150, xx - 140) < 120
+
+    assert np.array_equal(_filter_labels(labels, mask), _reference_filter(labels, mask))
+
+
+def test_filter_labels_without_nuclei():
+    labels = np.zeros((20, 20), dtype=np.int32)
+    mask = np.ones((20, 20), dtype=bool)
+
+    assert np.array_equal(_filter_labels(labels, mask), labels)
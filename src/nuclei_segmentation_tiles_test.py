@@ -0,0 +1,61 @@
+import math
+
+import pytest
+
+from nuclei_segmentation import (
+    INFERENCE_BYTES_PER_PIXEL,
+    INFERENCE_MEMORY_BUDGET,
+    _n_tiles,
+)
+
+
+def _tile_memory(shape, n_tiles):
+    return (
+        math.ceil(shape[0] / n_tiles[0])
+        * math.ceil(shape[1] / n_tiles[1])
+        * INFERENCE_BYTES_PER_PIXEL
+    )
+
+
+def test_n_tiles_small_crop_is_not_tiled():
+    assert _n_tiles((512, 512)) == (1, 1)
+    assert _n_tiles((1, 1), memory_budget=INFERENCE_BYTES_PER_PIXEL) == (1, 1)
+
+
+def test_n_tiles_default_budget():
+    # exactly fits the default budget
+    pixels = INFERENCE_MEMORY_BUDGET // INFERENCE_BYTES_PER_PIXEL
+    assert _n_tiles((pixels // 1024, 1024)) == (1, 1)
+    assert _n_tiles((pixels // 1024 + 1, 1024)) != (1, 1)
+
+
+@pytest.mark.parametrize(
+    "shape", [(4000, 4000), (2000, 9000), (9000, 2000), (20000, 300), (6001, 7919)]
+)
+@pytest.mark.parametrize("budget", [256 * 1024**2, 1024**3, 4 * 1024**3])
+def test_n_tiles_within_budget(shape, budget):
+    n_tiles = _n_tiles(shape, budget)
+
+    assert n_tiles[0] >= 1 and n_tiles[1] >= 1
+    n_total = math.ceil(shape[0] * shape[1] * INFERENCE_BYTES_PER_PIXEL / budget)
+    assert n_tiles[0] * n_tiles[1] >= n_total
+    # rounding the tiles up to whole pixels costs at most one row and column of pixels
+    assert _tile_memory(shape, n_tiles) <= budget + (
+        (shape[0] / n_tiles[0] + shape[1] / n_tiles[1] + 1) * INFERENCE_BYTES_PER_PIXEL
+    )
+
+
+def test_n_tiles_more_tiles_for_smaller_budget():
+    shape = (8000, 8000)
+    budgets = [4 * 1024**3, 1024**3, 256 * 1024**2, 64 * 1024**2]
+    totals = [math.prod(_n_tiles(shape, budget)) for budget in budgets]
+    assert totals == sorted(totals)
+    assert totals[0] < totals[-1]
+
+
+def test_n_tiles_follow_aspect_ratio():
+    n_y, n_x = _n_tiles((2000, 16000), 256 * 1024**2)
+    assert n_x > n_y
+
+    n_y, n_x = _n_tiles((16000, 2000), 256 * 1024**2)
+    assert n_y > n_x
@@ -3,22 +3,27 @@ Plot intensity histograms of the different mixes, zones, and channels.
 """
 
 import os
-import zarr
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+
 ZARR_PATH = os.path.join(
     os.path.dirname(__file__), "..", "..", "zarr_data", "roi_data.zarr"
 )
 
-root = zarr.open(ZARR_PATH, mode="r")
+root = catalog.open_root(ZARR_PATH)
+entries = catalog.read_catalog(ZARR_PATH)
 
-mixes = list(root.keys())
-roi_types = list(root[mixes[0]].keys())
+mixes = catalog.mixes(entries)
+roi_types = sorted({entry["apical_type"] for entry in entries})
 
 # data for mix 1 / apical_in / ch 2
 mix_1_apical_in_whole_roi_ch2 = []
 mix_1_apical_in_whole_roi_ch3 = []
 
-for roi in list(root['mix_1']['apical_in'].keys()):
-    print(roi)
\ No newline at end of file
+for roi in catalog.roi_names(entries, "mix_1", "apical_in"):
+    print(roi)
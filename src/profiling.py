@@ -0,0 +1,293 @@
+"""
+Opt-in profiling of the pipeline stages.
+
+Profiling is enabled by setting the `ROI_PROFILE_DIR` environment variable, or the
+`--profile-dir` option of `main.py`, to a directory. Every stage run on an ROI then
+records its wall time, CPU time, peak resident memory, the bytes read from and written
+to Zarr and the pixel count of the ROI. Major calls within a stage are recorded as
+sub-spans of the stage. Each process appends its records to its own JSON lines file in
+the directory, so parallel workers do not contend for a file.
+
+Summarize the records with:
+
+    python profiling.py <profile dir> [--output report.parquet]
+
+When profiling is disabled, the spans cost a single environment lookup.
+"""
+
+import argparse
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from glob import glob
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import zarr
+
+PROFILE_DIR_ENV = "ROI_PROFILE_DIR"
+
+# bytes moved through the stores opened with `open_zarr` in this process
+_io = {"read": 0, "written": 0}
+
+# records of the spans enclosing the current code
+_stack = []
+
+
+def profile_dir() -> Optional[str]:
+    return os.environ.get(PROFILE_DIR_ENV) or None
+
+
+def enabled() -> bool:
+    return profile_dir() is not None
+
+
+def enable(directory: str):
+    """
+    Enables profiling to `directory` in this process and in the worker processes it
+    starts afterwards, which inherit the environment.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = os.path.abspath(directory)
+
+
+class CountingStore(zarr.storage.KVStore):
+    """
+    Store wrapper counting the bytes of the chunks and metadata read and written.
+    """
+
+    def __getitem__(self, key):
+        value = self._mutable_mapping[key]
+        _io["read"] += memoryview(value).nbytes
+        return value
+
+    def __setitem__(self, key, value):
+        _io["written"] += memoryview(value).nbytes
+        self._mutable_mapping[key] = value
+
+    def listdir(self, path: str = ""):
+        return self._mutable_mapping.listdir(path)
+
+    def rmdir(self, path: str = ""):
+        self._mutable_mapping.rmdir(path)
+
+    def getsize(self, path: str = ""):
+        return self._mutable_mapping.getsize(path)
+
+
+def open_zarr(zarr_path: str, mode: str = "a"):
+    """
+    Opens a Zarr file like `zarr.open`. When profiling, the store is wrapped to count
+    the bytes read and written.
+    """
+    if not enabled():
+        return zarr.open(zarr_path, mode=mode)
+
+    store = zarr.storage.normalize_store_arg(zarr_path, mode=mode)
+    return zarr.open(CountingStore(store), mode=mode)
+
+
+def _peak_rss() -> int:
+    """
+    Returns the peak resident memory of the process in bytes.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak resident memory to the current one, where the OS supports it, so
+    the peak of a stage is not masked by an earlier stage run in the same worker.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def _write(record: dict):
+    os.makedirs(profile_dir(), exist_ok=True)
+    path = os.path.join(profile_dir(), f"profile-{os.getpid()}.jsonl")
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def span(name: str, roi_path: Optional[str] = None, pixels: Optional[int] = None):
+    """
+    Records the resources used by the enclosed code. The outermost span names the
+    stage, spans nested in it are recorded as its sub-spans and inherit its ROI. A span
+    of an ROI within a span of all ROIs, e.g. a stage run sequentially by `main.py`,
+    is an outermost span of its own.
+
+    The CPU time covers all threads of the process, and the peak memory is that of the
+    whole process since the start of the outermost span.
+    """
+    if not enabled():
+        yield
+        return
+
+    enclosing = _stack[-1] if _stack else None
+    if enclosing is not None and (enclosing["roi"] is not None or roi_path is None):
+        stage, parent = enclosing["stage"], enclosing["span"]
+        roi_path = enclosing["roi"] if roi_path is None else roi_path
+    else:
+        stage, parent = name, None
+        _reset_peak_rss()
+
+    record = {
+        "pid": os.getpid(),
+        "roi": roi_path,
+        "stage": stage,
+        "span": name,
+        "parent": parent,
+        "start": time.time(),
+        "pixels": pixels,
+    }
+    _stack.append(record)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    read, written = _io["read"], _io["written"]
+    try:
+        yield
+    finally:
+        _stack.pop()
+        record.update(
+            {
+                "wall_time": time.perf_counter() - wall,
+                "cpu_time": time.process_time() - cpu,
+                "peak_rss": _peak_rss(),
+                "bytes_read": _io["read"] - read,
+                "bytes_written": _io["written"] - written,
+            }
+        )
+        _write(record)
+
+
+def profiled_stage(method):
+    """
+    Decorates the method running a stage class on its ROI, recording it as a span
+    named after the `stage` of the class. The pixel count of the ROI is also added to
+    the enclosing spans of the ROI, e.g. those opened by `main.py`, which include
+    reading the inputs in the constructor.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not enabled():
+            return method(self, *args, **kwargs)
+
+        roi_path = getattr(self, "roi_path", None) or self.sample_path
+        height, width = self.root[roi_path]["raw_data"].shape[:2]
+        for record in _stack:
+            if record["roi"] == roi_path and record["pixels"] is None:
+                record["pixels"] = height * width
+
+        with span(self.stage, roi_path, height * width):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def load_report(directory: str) -> pd.DataFrame:
+    """
+    Reads the records of all processes into one table.
+    """
+    records = []
+    for path in sorted(glob(os.path.join(directory, "profile-*.jsonl"))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame(records)
+
+
+def summarize(report: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarizes the records per stage, scope (one ROI or all ROIs) and span: the number
+    of runs, the total, median, 95th percentile and maximum wall time, the CPU time,
+    the largest peak memory, the data read and written and the throughput.
+    """
+    # in order of first appearance, stages before their sub-spans
+    report = report.sort_values("start")
+    report["parent"] = report["parent"].fillna("")
+    # spans without an ROI cover a stage over all ROIs, e.g. in main.py
+    report["scope"] = np.where(report["roi"].isna(), "all", "roi")
+
+    summary = report.groupby(["stage", "scope", "parent", "span"], sort=False).agg(
+        runs=("wall_time", "size"),
+        wall_total_s=("wall_time", "sum"),
+        wall_median_s=("wall_time", "median"),
+        wall_p95_s=("wall_time", lambda wall: np.percentile(wall, 95)),
+        wall_max_s=("wall_time", "max"),
+        cpu_total_s=("cpu_time", "sum"),
+        peak_rss_max_mb=("peak_rss", lambda rss: rss.max() / 1024**2),
+        read_mb=("bytes_read", lambda n: n.sum() / 1024**2),
+        written_mb=("bytes_written", lambda n: n.sum() / 1024**2),
+        pixels=("pixels", "sum"),
+    )
+    summary["mpixels_per_s"] = summary["pixels"] / summary["wall_total_s"] / 1e6
+    return summary.drop(columns="pixels").reset_index()
+
+
+def outliers(report: pd.DataFrame, top: int = 10) -> pd.DataFrame:
+    """
+    Returns the ROIs with the slowest stage runs relative to their size: the wall time
+    per megapixel compared to the median of the stage.
+    """
+    stages = report[
+        report["parent"].isna() & report["roi"].notna() & report["pixels"].notna()
+    ].copy()
+    stages["s_per_mpixel"] = stages["wall_time"] / stages["pixels"] * 1e6
+    stages["vs_median"] = stages["s_per_mpixel"] / stages.groupby("stage")[
+        "s_per_mpixel"
+    ].transform("median")
+    columns = ["stage", "roi", "pixels", "wall_time", "peak_rss", "vs_median"]
+    return stages.sort_values("vs_median", ascending=False)[columns].head(top)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Summarize the profiling records of pipeline runs."
+    )
+    parser.add_argument("profile_dir", type=str)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="Write all records to this .json or .parquet file",
+    )
+    parser.add_argument(
+        "--top", type=int, default=10, help="Number of outlier ROIs to list"
+    )
+    args = parser.parse_args()
+
+    report = load_report(args.profile_dir)
+    if report.empty:
+        sys.exit(f"No profiling records in {args.profile_dir}")
+
+    if args.output is not None:
+        if args.output.endswith(".parquet"):
+            report.to_parquet(args.output, index=False)
+        else:
+            report.to_json(args.output, orient="records", indent=1)
+
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summarize(report).round(3).to_string(index=False))
+        print()
+        print("Slowest ROIs per pixel relative to the median of their stage:")
+        print(outliers(report, args.top).round(3).to_string(index=False))
@@ -0,0 +1,107 @@
+"""
+Content hashing and provenance records for the Zarr datasets written by the pipeline.
+
+Every stage stores the content hash of each output dataset together with the hashes
+of its inputs and its parameters in the dataset attributes. A stage is up to date for
+an ROI when all of its outputs exist and were produced from the current inputs with
+the current parameters, in which case it can be skipped.
+"""
+
+import hashlib
+import json
+import os
+from typing import Callable, Optional
+
+import numpy as np
+import zarr
+
+
+def hash_array(arr: np.ndarray) -> str:
+    """
+    Returns a hash of the array contents, including its dtype and shape.
+    """
+    arr = np.ascontiguousarray(arr)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{arr.dtype.str}{arr.shape}".encode())
+    h.update(arr.data)
+    return h.hexdigest()
+
+
+def hash_file(path: str) -> Optional[str]:
+    """
+    Returns a hash of the file contents, or None if the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def dataset_hash(dataset: zarr.Array, data: Optional[np.ndarray] = None) -> str:
+    """
+    Returns the content hash of a dataset.
+
+    The hash stored in the dataset attributes is used when present. Otherwise it is
+    computed from `data`, or from the dataset itself if `data` is not given, and cached
+    in the attributes when the store is writable.
+    """
+    digest = dataset.attrs.get("content_hash")
+    if digest is None:
+        digest = hash_array(dataset[:] if data is None else data)
+        if not dataset.read_only:
+            dataset.attrs["content_hash"] = digest
+    return digest
+
+
+def _normalize(params: dict) -> dict:
+    # attributes are stored as JSON, so compare parameters in their JSON form
+    return json.loads(json.dumps(params))
+
+
+def record(
+    dataset: zarr.Array, data: np.ndarray, stage: str, inputs: dict, params: dict
+):
+    """
+    Stores the content hash and provenance of a newly written dataset.
+    """
+    dataset.attrs.update(
+        {
+            "content_hash": hash_array(data),
+            "provenance": {
+                "stage": stage,
+                "inputs": inputs,
+                "params": _normalize(params),
+            },
+        }
+    )
+
+
+def is_current(
+    root: zarr.Group, outputs: list, inputs: Callable[[], dict], params: dict
+) -> bool:
+    """
+    Checks whether all output datasets exist and were produced from the current input
+    hashes and parameters.
+
+    `inputs` is only called once all outputs are known to carry a provenance record,
+    so missing outputs never trigger hashing of the inputs.
+    """
+    records = []
+    for path in outputs:
+        if path not in root:
+            return False
+
+        record = root[path].attrs.get("provenance")
+        if record is None:
+            return False
+        records.append(record)
+
+    inputs = inputs()
+    params = _normalize(params)
+    return all(
+        record["inputs"] == inputs and record["params"] == params for record in records
+    )
@@ -0,0 +1,178 @@
+"""
+Cost-aware scheduling of the per-ROI stage runs.
+
+ROI sizes vary by orders of magnitude, so handing the ROIs to the workers in hierarchy
+order lets a large ROI that arrives last stretch the tail of a stage, and several large
+ROIs in flight at once can exhaust the memory of the node. Instead, the ROIs are run
+largest first, and a run is only started while the estimated peak memory of all runs
+in flight stays within a budget. Smaller ROIs fill the workers while a large ROI waits
+for memory. An ROI estimated above the whole budget runs alone.
+
+The cost and peak memory of a run are estimated from the ROI shape in the catalog, so
+scheduling needs no metadata reads.
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Optional
+
+from joblib import cpu_count
+from joblib.externals.loky import get_reusable_executor
+
+# Rough peak memory of a worker running a stage on an ROI: the imported libraries plus
+# bytes per ROI pixel. Measured with profiling.py on synthetic ROIs, with some headroom.
+WORKER_MEMORY = 256 * 1024**2
+BYTES_PER_PIXEL = {
+    "segmentation": 48,
+    "zoning": 32,
+    "nuclei_segmentation": 32,
+    "histograms": 24,
+    "analysis": 24,
+    "correlation": 16,
+    # all stages in one worker, with the raw data and intermediates kept in memory
+    "fused": 96,
+}
+
+# stages running StarDist inference, which also loads the model
+INFERENCE_STAGES = ["nuclei_segmentation", "fused"]
+NUCLEI_MODEL_MEMORY = 1024**3
+
+# share of the memory of the node or container used by default
+MEMORY_FRACTION = 0.8
+
+
+def total_memory() -> int:
+    """
+    Returns the memory of the node in bytes, or the limit of the container if lower.
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in [
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ]:
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def default_memory_budget() -> int:
+    return int(total_memory() * MEMORY_FRACTION)
+
+
+def estimate_memory(
+    stage: str,
+    pixels: int,
+    nuclei_memory_budget: Optional[int] = None,
+    inference: Optional[bool] = None,
+) -> int:
+    """
+    Estimates the peak memory in bytes of a worker running a stage on an ROI.
+
+    Args:
+    nuclei_memory_budget (int): Memory budget of StarDist inference, see
+        `NucleiSegmenter`. Inference never uses more than that, as it is tiled.
+    inference (bool): Whether the run includes StarDist inference. Defaults to
+        whether the stage is one of `INFERENCE_STAGES`.
+    """
+    if inference is None:
+        inference = stage in INFERENCE_STAGES
+
+    memory = WORKER_MEMORY + BYTES_PER_PIXEL[stage] * pixels
+    if inference:
+        from nuclei_segmentation import (
+            INFERENCE_BYTES_PER_PIXEL,
+            INFERENCE_MEMORY_BUDGET,
+        )
+
+        if nuclei_memory_budget is None:
+            nuclei_memory_budget = INFERENCE_MEMORY_BUDGET
+        memory += NUCLEI_MODEL_MEMORY + min(
+            pixels * INFERENCE_BYTES_PER_PIXEL, nuclei_memory_budget
+        )
+    return memory
+
+
+def schedule(
+    calls: list,
+    pixels: list,
+    stage: str,
+    n_jobs: int = -1,
+    memory_budget: Optional[int] = None,
+    nuclei_memory_budget: Optional[int] = None,
+    inference: Optional[bool] = None,
+    verbose: bool = True,
+) -> list:
+    """
+    Runs the calls of a stage on ROIs largest first, admitting a call only while the
+    estimated memory in flight stays within `memory_budget`.
+
+    Args:
+    calls (list): Calls created with `joblib.delayed`, one per ROI.
+    pixels (list): Pixel count of the ROI of each call.
+    n_jobs (int): Maximum number of parallel workers, -1 for all CPU cores.
+    memory_budget (int): Memory in bytes shared by the workers. Defaults to
+        `default_memory_budget()`.
+
+    Returns:
+    list: The results of the calls, in the order of `calls`.
+    """
+    if memory_budget is None:
+        memory_budget = default_memory_budget()
+    if n_jobs < 0:
+        n_jobs = max(1, cpu_count() + 1 + n_jobs)
+    n_jobs = min(n_jobs, len(calls))
+
+    # capped at the budget, so that calls estimated above it still run, alone and as
+    # early as their size says
+    memory = [
+        min(estimate_memory(stage, n, nuclei_memory_budget, inference), memory_budget)
+        for n in pixels
+    ]
+    # largest first, in their original order among equals
+    pending = sorted(range(len(calls)), key=lambda i: pixels[i], reverse=True)
+    results = [None] * len(calls)
+
+    if n_jobs <= 1:
+        for i in pending:
+            function, args, kwargs = calls[i]
+            results[i] = function(*args, **kwargs)
+        return results
+
+    executor = get_reusable_executor(max_workers=n_jobs)
+    running = {}
+    in_use = 0
+    start = time.perf_counter()
+    while pending or running:
+        while pending and len(running) < n_jobs:
+            # the largest call that fits
+            fitting = [i for i in pending if in_use + memory[i] <= memory_budget]
+            if not fitting:
+                break
+            i = fitting[0]
+            pending.remove(i)
+
+            function, args, kwargs = calls[i]
+            running[executor.submit(function, *args, **kwargs)] = i
+            in_use += memory[i]
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            i = running.pop(future)
+            in_use -= memory[i]
+            results[i] = future.result()
+
+        if verbose:
+            print(
+                f"[{stage}] Done {len(calls) - len(pending) - len(running)} of "
+                f"{len(calls)} ROIs, {len(running)} running with an estimated "
+                f"{in_use / 1024**3:.1f} of {memory_budget / 1024**3:.1f} GB | "
+                f"elapsed: {time.perf_counter() - start:.1f}s"
+            )
+
+    return results
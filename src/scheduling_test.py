@@ -0,0 +1,112 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from joblib import delayed
+
+import scheduling
+from scheduling import estimate_memory, schedule
+
+
+class _Recorder:
+    """
+    Records the order in which the calls start and the estimated memory in flight.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = []
+        self.peaks = []
+
+    def __call__(self, pixels):
+        with self.lock:
+            self.started.append(pixels)
+            self.running.append(pixels)
+            self.peaks.append(
+                (sum(estimate_memory(self.stage, n) for n in self.running), pixels)
+            )
+        time.sleep(0.01)
+        with self.lock:
+            self.running.remove(pixels)
+        return pixels * 2
+
+
+@pytest.fixture
+def threads(monkeypatch):
+    # threads instead of worker processes, so the recorder is shared
+    monkeypatch.setattr(
+        scheduling,
+        "get_reusable_executor",
+        lambda max_workers: ThreadPoolExecutor(max_workers),
+    )
+
+
+def test_schedule_runs_largest_first_and_keeps_order():
+    pixels = [10, 1000, 100, 5000, 1]
+    recorder = _Recorder("analysis")
+
+    results = schedule(
+        [delayed(recorder)(n) for n in pixels], pixels, "analysis", n_jobs=1
+    )
+
+    assert results == [n * 2 for n in pixels]
+    assert recorder.started == sorted(pixels, reverse=True)
+
+
+def test_schedule_stays_within_memory_budget(threads):
+    pixels = [4_000_000, 1_000_000, 2_000_000, 500_000] * 4
+    recorder = _Recorder("zoning")
+    # room for the largest ROI and a couple of small ones
+    budget = estimate_memory("zoning", 4_000_000) + 2 * estimate_memory(
+        "zoning", 500_000
+    )
+
+    results = schedule(
+        [delayed(recorder)(n) for n in pixels],
+        pixels,
+        "zoning",
+        n_jobs=4,
+        memory_budget=budget,
+        verbose=False,
+    )
+
+    assert results == [n * 2 for n in pixels]
+    assert max(peak for peak, _ in recorder.peaks) <= budget
+    assert len(recorder.started) == len(pixels)
+
+
+def test_schedule_runs_oversized_roi_alone(threads):
+    pixels = [100_000_000, 1000, 1000]
+    recorder = _Recorder("segmentation")
+    budget = estimate_memory("segmentation", 1000) * 3
+
+    schedule(
+        [delayed(recorder)(n) for n in pixels],
+        pixels,
+        "segmentation",
+        n_jobs=3,
+        memory_budget=budget,
+        verbose=False,
+    )
+
+    assert recorder.started[0] == 100_000_000
+    # nothing else ran alongside it
+    assert recorder.peaks[0] == (
+        estimate_memory("segmentation", 100_000_000),
+        100_000_000,
+    )
+    assert recorder.peaks[1][0] <= budget
+
+
+def test_estimate_memory_caps_inference():
+    pixels = 10_000 * 10_000
+    budget = 2 * 1024**3
+
+    assert estimate_memory(
+        "nuclei_segmentation", pixels, nuclei_memory_budget=budget
+    ) == estimate_memory("nuclei_segmentation", pixels, inference=False) + (
+        scheduling.NUCLEI_MODEL_MEMORY + budget
+    )
@@ -1,19 +1,136 @@
 """
 Contains the classes used for epithelial segmentation
 """
+
+from typing import Optional
+
 import numpy as np
 import zarr
 from scipy import ndimage as ndi
-from skimage import filters, measure, morphology, segmentation
+from skimage import filters, morphology, segmentation
 from skimage.color import rgb2gray
 
+import cropping
+import profiling
+import provenance
+import storage
+
+BLOCK_SIZE = 355
+GAUSSIAN_SIGMA = 3
+CLOSING_RADIUS = 7
+
+# Local threshold backend of ApicalInSegmenter. "gaussian" is the gaussian-weighted
+# local mean of skimage's threshold_local, "integral" is the unweighted local mean
+# computed from a summed-area table, whose cost does not depend on the block size.
+THRESHOLD_METHODS = ["gaussian", "integral"]
+THRESHOLD_METHOD = "gaussian"
+
+# Context the filters of primitive_mask need around the tissue when working on a crop:
+# the reach of both gaussian kernels (truncated at 4 sigma, with the local threshold
+# using sigma = (BLOCK_SIZE - 1) / 6) and the closing radius. Beyond it the padding
+# outside the tissue stays background, so the cropped masks equal the full-frame ones.
+SEGMENTATION_MARGIN = (
+    round(4 * GAUSSIAN_SIGMA) + round(4 * (BLOCK_SIZE - 1) / 6) + CLOSING_RADIUS + 1
+)
+
+
+def threshold_local_integral(image: np.ndarray, block_size: int) -> np.ndarray:
+    """
+    Local mean threshold computed from a summed-area table.
+
+    Gives the same result as `filters.threshold_local(image, block_size, method="mean")`,
+    with the image border handled by reflection, but each pixel costs four lookups
+    regardless of the block size.
+    """
+    assert block_size % 2 == 1, "Block size must be odd."
+    radius = block_size // 2
+
+    padded = np.pad(image, radius, mode="symmetric")
+    if np.issubdtype(padded.dtype, np.integer):
+        padded = padded.astype(np.int64)
+    else:
+        padded = padded.astype(np.float64)
+
+    table = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=padded.dtype)
+    np.cumsum(padded, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+
+    height, width = image.shape
+    block_sums = (
+        table[block_size : block_size + height, block_size : block_size + width]
+        - table[:height, block_size : block_size + width]
+        - table[block_size : block_size + height, :width]
+        + table[:height, :width]
+    )
+    return block_sums / block_size**2
+
+
+def _threshold_local(image: np.ndarray, method: str) -> np.ndarray:
+    if method == "gaussian":
+        return filters.threshold_local(image, block_size=BLOCK_SIZE)
+    elif method == "integral":
+        return threshold_local_integral(image, BLOCK_SIZE)
+    else:
+        raise ValueError(f"Unknown threshold method: {method}")
+
+
+def primitive_mask(img: np.ndarray, threshold_method: str = None) -> np.ndarray:
+    """
+    Returns the primitive epithelium mask of an apical-in ROI, before hole filling.
+    """
+    if threshold_method is None:
+        threshold_method = THRESHOLD_METHOD
+
+    # Invert the image, apply a gaussian filter, and use adaptive threshold
+    inverted_img = rgb2gray(img)
+    inverted_img = (
+        filters.gaussian(inverted_img, sigma=GAUSSIAN_SIGMA) * 65535
+    ).astype(np.uint16)
+
+    with profiling.span("threshold_local"):
+        thr = _threshold_local(inverted_img, threshold_method)
+    inverted_img = inverted_img > thr
+    with profiling.span("binary_closing"):
+        inverted_img = morphology.binary_closing(
+            inverted_img, morphology.disk(CLOSING_RADIUS)
+        )
+    return inverted_img
+
+
+def largest_filled_component(mask: np.ndarray) -> np.ndarray:
+    """
+    Returns the largest connected component of a binary mask with its holes filled.
+
+    Component areas are taken from a histogram of the labels instead of regionprops,
+    and the holes are only filled inside the bounding box of the component. Ties are
+    resolved in favour of the lowest label, like `max` over regionprops.
+    """
+    component = np.zeros(mask.shape, dtype=bool)
+    labels, n_labels = ndi.label(mask, structure=np.ones((3, 3)))
+    if n_labels == 0:
+        return component
+
+    areas = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    largest = np.argmax(areas[1:]) + 1
+
+    # the component lies entirely inside its bounding box, so filling the cropped
+    # component gives the same result as filling the full frame
+    bbox = ndi.find_objects(labels, max_label=largest)[largest - 1]
+    component[bbox] = ndi.binary_fill_holes(labels[bbox] == largest)
+    return component
+
 
 class ApicalOutSegmenter:
-    def __init__(self, zarr_path: str, mix: str, roi: str):
+    stage = "apical_out_segmentation"
+    outputs = ["segmentation/mask"]
+
+    def __init__(
+        self, zarr_path: str, mix: str, roi: str, img: Optional[np.ndarray] = None
+    ):
         self.zarr_path = zarr_path
         self.mix = mix
         self.roi = roi
-        self.root = zarr.open(zarr_path, mode="a")
+        self.root = profiling.open_zarr(zarr_path, mode="a")
 
         self.roi_path = f"{self.mix}/apical_out/{self.roi}"
 
@@ -21,30 +138,78 @@ class ApicalOutSegmenter:
             self.roi_path in self.root
         ), f"ROI '{self.roi}' not found in mix '{self.mix}'"
 
-        self.img = self.root[mix]["apical_out"][roi]["raw_data"][:]
+        if img is None:
+            img = self.root[mix]["apical_out"][roi]["raw_data"][:]
+        self.img = img
 
-    def segment(self):
+    @staticmethod
+    def parameters() -> dict:
+        return {}
+
+    @classmethod
+    def is_up_to_date(cls, root: zarr.Group, mix: str, roi: str) -> bool:
+        roi_path = f"{mix}/apical_out/{roi}"
+        outputs = [f"{roi_path}/{output}" for output in cls.outputs]
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: {"raw_data": provenance.dataset_hash(root[roi_path]["raw_data"])},
+            cls.parameters(),
+        )
+
+    def _input_hashes(self) -> dict:
+        raw_data = self.root[self.roi_path]["raw_data"]
+        return {"raw_data": provenance.dataset_hash(raw_data, self.img)}
+
+    @profiling.profiled_stage
+    def segment(self) -> dict:
         img = self.img
-        mask = np.invert(img == 0)
+        inputs = self._input_hashes()
+        crop = cropping.tissue_crop(self.root, self.roi_path, raw_data=img)
+
+        mask = np.invert(img[crop] == 0)
         mask = rgb2gray(mask).astype(bool)
+        mask = cropping.uncrop(mask, crop, img.shape)
 
         mask_dataset_path = f"{self.mix}/apical_out/{self.roi}/segmentation/mask"
 
         if mask_dataset_path in self.root:
             del self.root[mask_dataset_path]
 
-        mask_dataset = self.root.create_dataset(mask_dataset_path, data=mask)
+        mask_dataset = storage.create_dataset(
+            self.root, mask_dataset_path, mask, "mask"
+        )
         mask_dataset.attrs.update(
             {"author": "Turku BioImaging", "description": "Apical-out mask"}
         )
+        provenance.record(mask_dataset, mask, self.stage, inputs, self.parameters())
+
+        return {"mask": mask}
 
 
 class ApicalInSegmenter:
-    def __init__(self, zarr_path: str, mix: str, roi: str):
+    stage = "apical_in_segmentation"
+    outputs = [
+        "segmentation/primitive_mask",
+        "segmentation/largest_hole",
+        "segmentation/mask",
+    ]
+
+    def __init__(
+        self,
+        zarr_path: str,
+        mix: str,
+        roi: str,
+        img: Optional[np.ndarray] = None,
+        threshold_method: Optional[str] = None,
+    ):
         self.zarr_path = zarr_path
         self.mix = mix
         self.roi = roi
-        self.root = zarr.open(zarr_path, mode="a")
+        self.root = profiling.open_zarr(zarr_path, mode="a")
+        self.threshold_method = (
+            THRESHOLD_METHOD if threshold_method is None else threshold_method
+        )
 
         self.roi_path = f"{self.mix}/apical_in/{self.roi}"
 
@@ -52,42 +217,74 @@ class ApicalInSegmenter:
             self.roi_path in self.root
         ), f"ROI '{self.roi}' not found in mix '{self.mix}'"
 
-        self.img = self.root[mix]["apical_in"][roi]["raw_data"][:]
+        if img is None:
+            img = self.root[mix]["apical_in"][roi]["raw_data"][:]
+        self.img = img
+
+    @staticmethod
+    def parameters(threshold_method: Optional[str] = None) -> dict:
+        return {
+            "block_size": BLOCK_SIZE,
+            "gaussian_sigma": GAUSSIAN_SIGMA,
+            "closing_radius": CLOSING_RADIUS,
+            "threshold_method": (
+                THRESHOLD_METHOD if threshold_method is None else threshold_method
+            ),
+        }
+
+    @classmethod
+    def is_up_to_date(
+        cls,
+        root: zarr.Group,
+        mix: str,
+        roi: str,
+        threshold_method: Optional[str] = None,
+    ) -> bool:
+        roi_path = f"{mix}/apical_in/{roi}"
+        outputs = [f"{roi_path}/{output}" for output in cls.outputs]
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: {"raw_data": provenance.dataset_hash(root[roi_path]["raw_data"])},
+            cls.parameters(threshold_method),
+        )
+
+    def _input_hashes(self) -> dict:
+        raw_data = self.root[self.roi_path]["raw_data"]
+        return {"raw_data": provenance.dataset_hash(raw_data, self.img)}
 
-    def segment(self):
+    @profiling.profiled_stage
+    def segment(self) -> dict:
         img = self.img
+        inputs = self._input_hashes()
+        crop = cropping.tissue_crop(
+            self.root, self.roi_path, SEGMENTATION_MARGIN, raw_data=img
+        )
+        img = img[crop]
 
         # Get the outer mask
         outer_mask = np.invert(img == 0)
         outer_mask = rgb2gray(outer_mask)
 
-        # Invert the image, apply a gaussian filter, and use adaptive threshold
-        inverted_img = rgb2gray(img)
-        inverted_img = (filters.gaussian(inverted_img, sigma=3) * 65535).astype(
-            np.uint16
-        )
-
-        thr = filters.threshold_local(inverted_img, block_size=355)
-        inverted_img = inverted_img > thr
-        inverted_img = morphology.binary_closing(inverted_img, morphology.disk(7))
+        inverted_img = primitive_mask(img, self.threshold_method)
 
         # Get the largest "hole".
         # This usually corresponds to the luminal space.
         holes = np.invert(inverted_img)
         holes = segmentation.clear_border(holes)
-        hole_img = np.zeros_like(holes)
-        hole_labels = measure.label(holes)
-        regions = measure.regionprops(hole_labels)
-        if regions:
-            largest_hole = max(regions, key=lambda region: region.area)
-            hole_img[largest_hole.coords[:, 0], largest_hole.coords[:, 1]] = 1
-            hole_img = ndi.binary_fill_holes(hole_img)
+        with profiling.span("largest_filled_component"):
+            hole_img = largest_filled_component(holes)
 
         # Now take the epithelium masks, fill all holes, and then remove the largest hole
         mask = outer_mask + inverted_img
         mask = ndi.binary_fill_holes(mask)
         mask[hole_img] = 0
 
+        shape = self.img.shape
+        inverted_img = cropping.uncrop(inverted_img, crop, shape)
+        hole_img = cropping.uncrop(hole_img, crop, shape)
+        mask = cropping.uncrop(mask, crop, shape)
+
         # Save outputs to zarr datasets
         inv_dataset_path = (
             f"{self.mix}/apical_in/{self.roi}/segmentation/primitive_mask"
@@ -107,20 +304,49 @@ class ApicalInSegmenter:
         if mask_dataset_path in self.root:
             del self.root[mask_dataset_path]
 
-        inv_dataset = self.root.create_dataset(inv_dataset_path, data=inverted_img)
+        inv_dataset = storage.create_dataset(
+            self.root, inv_dataset_path, inverted_img, "mask"
+        )
         inv_dataset.attrs.update(
             {"author": "Turku BioImaging", "description": "Primitive mask"}
         )
+        provenance.record(
+            inv_dataset,
+            inverted_img,
+            self.stage,
+            inputs,
+            self.parameters(self.threshold_method),
+        )
 
-        hole_dataset = self.root.create_dataset(hole_dataset_path, data=hole_img)
+        hole_dataset = storage.create_dataset(
+            self.root, hole_dataset_path, hole_img, "mask"
+        )
         hole_dataset.attrs.update(
             {
                 "author": "Turku BioImaging",
                 "description": "Mask of the largest inner hole, usually corresponding to the luminal space",
             }
         )
+        provenance.record(
+            hole_dataset,
+            hole_img,
+            self.stage,
+            inputs,
+            self.parameters(self.threshold_method),
+        )
 
-        mask_dataset = self.root.create_dataset(mask_dataset_path, data=mask)
+        mask_dataset = storage.create_dataset(
+            self.root, mask_dataset_path, mask, "mask"
+        )
         mask_dataset.attrs.update(
             {"author": "Turku BioImaging", "description": "Final apical-in mask"}
         )
+        provenance.record(
+            mask_dataset,
+            mask,
+            self.stage,
+            inputs,
+            self.parameters(self.threshold_method),
+        )
+
+        return {"primitive_mask": inverted_img, "largest_hole": hole_img, "mask": mask}
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import zarr
+from scipy import ndimage as ndi
+from skimage import filters, measure
+from skimage.draw import disk
+
+import cropping
+from segmentation_classes import (
+    ApicalInSegmenter,
+    largest_filled_component,
+    threshold_local_integral,
+)
+
+
+@pytest.mark.parametrize("dtype", [np.uint16, np.float64])
+@pytest.mark.parametrize("block_size", [3, 35, 355])
+def test_integral_threshold_matches_local_mean(dtype, block_size):
+    rng = np.random.default_rng(0)
+    image = (rng.random((240, 310)) * 65535).astype(dtype)
+
+    expected = filters.threshold_local(image, block_size=block_size, method="mean")
+    np.testing.assert_allclose(
+        threshold_local_integral(image, block_size), expected, rtol=1e-9
+    )
+
+
+def _reference_largest_hole(holes):
+    # regionprops implementation used before largest_filled_component
+    hole_img = np.zeros_like(holes)
+    regions = measure.regionprops(measure.label(holes))
+    if regions:
+        largest_hole = max(regions, key=lambda region: region.area)
+        hole_img[largest_hole.coords[:, 0], largest_hole.coords[:, 1]] = 1
+        hole_img = ndi.binary_fill_holes(hole_img)
+    return hole_img
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_largest_filled_component_matches_regionprops(seed):
+    rng = np.random.default_rng(seed)
+    shape = (300, 320)
+    holes = rng.random(shape) < 0.3
+    # a ring with speckles inside, so that filling changes the result
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    radius = np.hypot(yy - rng.integers(100, 200), xx - rng.integers(100, 220))
+    holes[(radius > 40) & (radius < 70)] = True
+    for _ in range(3):
+        rr, cc = disk((rng.integers(0, 300), rng.integers(0, 320)), 20, shape=shape)
+        holes[rr, cc] = True
+
+    assert np.array_equal(
+        largest_filled_component(holes), _reference_largest_hole(holes)
+    )
+
+
+def test_largest_filled_component_ties_and_empty():
+    holes = np.zeros((30, 30), dtype=bool)
+    assert not largest_filled_component(holes).any()
+
+    holes[2:6, 20:24] = True
+    holes[10:14, 3:7] = True
+    assert np.array_equal(
+        largest_filled_component(holes), _reference_largest_hole(holes)
+    )
+
+
+def _apical_in_store(path):
+    # small tissue in the corner of a large zero-padded frame
+    rng = np.random.default_rng(0)
+    shape = (900, 800)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    radius = np.hypot(yy - 220, xx - 200)
+    img = np.zeros(shape + (3,), dtype=np.uint16)
+    tissue = radius < 150
+    img[tissue] = rng.integers(1000, 5000, (np.count_nonzero(tissue), 3))
+    lumen = radius < 50
+    img[lumen] = rng.integers(1, 50, (np.count_nonzero(lumen), 3))
+
+    root = zarr.open(str(path), mode="w")
+    root.create_dataset("mix_1/apical_in/231019_mix1_8_in_1/raw_data", data=img)
+    return str(path)
+
+
+def test_cropped_segmentation_matches_full_frame(tmp_path, monkeypatch):
+    outputs = {}
+    for crop_to_tissue in [True, False]:
+        monkeypatch.setattr(cropping, "CROP_TO_TISSUE", crop_to_tissue)
+        zarr_path = _apical_in_store(tmp_path / f"{crop_to_tissue}.zarr")
+        segmenter = ApicalInSegmenter(zarr_path, "mix_1", "231019_mix1_8_in_1")
+        outputs[crop_to_tissue] = segmenter.segment()
+
+    assert outputs[True]["largest_hole"].any()
+    for name in ["primitive_mask", "largest_hole", "mask"]:
+        assert np.array_equal(outputs[True][name], outputs[False][name])
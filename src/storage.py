@@ -0,0 +1,134 @@
+"""
+Storage layout of the raw data arrays in the Zarr file.
+
+The raw data of every ROI is a YXC array. In the "interleaved" layout, Zarr's default
+chunks span all three channels, so reading a single channel decompresses all of them.
+The "planar" layout keeps the YXC shape, so existing readers keep working, but stores
+every channel in its own chunks. Single-channel reads like `raw_data[:, :, 0]` then
+only touch the chunks of that channel.
+
+The compression codec is chosen per kind of dataset, since the 16-bit fluorescence data,
+the boolean masks, the label images and the overlays compress very differently.
+"""
+
+from typing import Optional, Union
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+
+CHANNELS = ["DAPI", "Cy3", "AF647"]
+
+LAYOUTS = ["interleaved", "planar"]
+DEFAULT_LAYOUT = "planar"
+
+# Spatial chunk size of the planar layout. Whole planes are read by every stage, and
+# crops to the tissue bounding box by some, so chunks are large enough to keep the
+# per-chunk overhead low on full reads while not reading far past a crop.
+PLANAR_CHUNK_SIZE = 1024
+
+CODECS = {
+    # Zarr's default compressor
+    "lz4": Blosc(cname="lz4", clevel=5, shuffle=Blosc.SHUFFLE),
+    "lz4-bitshuffle": Blosc(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    "zstd": Blosc(cname="zstd", clevel=3, shuffle=Blosc.SHUFFLE),
+    "zstd-bitshuffle": Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE),
+    "zstd-9-bitshuffle": Blosc(cname="zstd", clevel=9, shuffle=Blosc.BITSHUFFLE),
+}
+
+# Codec of each kind of dataset, chosen with benchmarks/codec_benchmark.py on a dataset
+# written by benchmarks/synthetic_data.py (16 ROIs of 1024 and 2048 pixels) after a
+# pipeline run, histograms included. To be re-checked on the real ROI data.
+DATASET_CODECS = {
+    "raw": "zstd",
+    "mask": "zstd",
+    "labels": "zstd-bitshuffle",
+    "overlay": "lz4",
+    "distances": "zstd",
+    "histograms": "zstd-bitshuffle",
+}
+
+
+def compressor(kind: str) -> Blosc:
+    """
+    Returns the compression codec for a kind of dataset, one of `DATASET_CODECS`.
+    """
+    if kind not in DATASET_CODECS:
+        raise ValueError(f"Unknown dataset kind: {kind}")
+    return CODECS[DATASET_CODECS[kind]]
+
+
+def create_dataset(
+    group: zarr.Group, path: str, data: np.ndarray, kind: str, **kwargs
+) -> zarr.Array:
+    """
+    Creates a dataset compressed with the codec of its kind.
+    """
+    return group.create_dataset(path, data=data, compressor=compressor(kind), **kwargs)
+
+
+def raw_data_chunks(shape: tuple, layout: str = None) -> Optional[tuple]:
+    """
+    Returns the chunk shape of a raw data array with the given YXC shape, or None to
+    let Zarr choose the chunks.
+    """
+    layout = DEFAULT_LAYOUT if layout is None else layout
+
+    if layout == "interleaved":
+        return None
+    elif layout == "planar":
+        height, width = shape[:2]
+        return (min(PLANAR_CHUNK_SIZE, height), min(PLANAR_CHUNK_SIZE, width), 1)
+    else:
+        raise ValueError(f"Unknown raw data layout: {layout}")
+
+
+def create_raw_data(
+    group: zarr.Group, path: str, data, layout: str = None
+) -> zarr.Array:
+    """
+    Creates a raw data dataset in the given layout.
+
+    `data` can also be a lazily read array, e.g. a tiff opened with
+    `tifffile.imread(aszarr=True)`, which is then copied one row of chunks at a time
+    instead of being read into memory whole.
+    """
+    layout = DEFAULT_LAYOUT if layout is None else layout
+    chunks = raw_data_chunks(data.shape, layout)
+
+    if isinstance(data, np.ndarray):
+        dataset = create_dataset(group, path, data, "raw", chunks=chunks)
+    else:
+        dataset = create_dataset(
+            group, path, None, "raw", shape=data.shape, dtype=data.dtype, chunks=chunks
+        )
+        step = dataset.chunks[0]
+        for y in range(0, data.shape[0], step):
+            dataset[y : y + step] = data[y : y + step]
+
+    dataset.attrs["layout"] = layout
+    return dataset
+
+
+def channel_index(dataset: zarr.Array, channel: Union[int, str]) -> int:
+    """
+    Returns the index of a channel given by index or by name.
+    """
+    if isinstance(channel, str):
+        dimensions = dataset.attrs.get("dimensions", {})
+        return dimensions.get("channels", CHANNELS).index(channel)
+    return channel
+
+
+def read_channel(
+    dataset: zarr.Array, channel: Union[int, str], crop: Optional[tuple] = None
+) -> np.ndarray:
+    """
+    Reads a single channel plane of a raw data dataset, optionally cropped.
+
+    Works with both layouts. With the planar layout only the chunks of the channel are
+    read and decompressed.
+    """
+    if crop is None:
+        crop = (slice(None), slice(None))
+    return dataset[crop + (channel_index(dataset, channel),)]
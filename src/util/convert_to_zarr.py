@@ -1,13 +1,27 @@
 """
 Convert the ROI data to zarr format, organized into a suitable heirarchy.
+
+ROIs are converted in parallel threads and large tiffs are streamed into the Zarr array
+one row of chunks at a time. Conversion is resumable: ROIs whose source tiff has the
+same modification time and size as when it was converted are skipped.
 """
 
+import argparse
+import contextlib
 import os
+import sys
 from glob import glob
 
+import numpy as np
+import tifffile
 import zarr
-from skimage import io
-from tqdm import tqdm
+from joblib import Parallel, delayed
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+import cropping  # noqa: E402
+import storage  # noqa: E402
 
 ROI_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "rois")
 ZARR_PATH = os.path.join(
@@ -15,53 +29,161 @@ ZARR_PATH = os.path.join(
 )
 
 MIX_PROTEINS = {"mix_1": "HER2 / SORLA", "mix_2": "HER2 / HER3"}
+AUTHOR = "Nicolas Pasquier, Cell Adhesion and Cancer Lab, University of Turku"
+
+
+def create_mix_group(root: zarr.Group, mix: str) -> zarr.Group:
+    mix_group = root.require_group(mix)
+    mix_group.attrs["name"] = mix
+    mix_group.attrs["targets"] = MIX_PROTEINS[mix]
+    mix_group.attrs["author"] = AUTHOR
+    return mix_group
+
+
+def create_roi_dataset(
+    mix_group: zarr.Group,
+    apical_class: str,
+    roi_name: str,
+    img: np.ndarray,
+    layout: str = None,
+) -> zarr.Array:
+    raw_data_path = f"{apical_class}/{roi_name}/raw_data"
+    if raw_data_path in mix_group:
+        del mix_group[raw_data_path]
+        # the tissue bounding box was derived from the replaced raw data
+        mix_group[f"{apical_class}/{roi_name}"].attrs.pop(
+            cropping.TISSUE_BBOX_ATTR, None
+        )
+
+    r_dataset = storage.create_raw_data(mix_group, raw_data_path, img, layout)
+    r_dataset.attrs["name"] = roi_name
+    r_dataset.attrs["author"] = mix_group.attrs["author"]
+    r_dataset.attrs["resolution"] = {
+        "unit": "microns / pixel",
+        "x": 0.3250000,
+        "y": 0.3250000,
+    }
+    r_dataset.attrs["bit_depth"] = 16
+    r_dataset.attrs["dim_order"] = "YXC"
+    r_dataset.attrs["dimensions"] = {
+        "height": img.shape[0],
+        "width": img.shape[1],
+        "channels": ["DAPI", "Cy3", "AF647"],
+    }
+    r_dataset.attrs["height"] = img.shape[0]
+    r_dataset.attrs["width"] = img.shape[1]
+    return r_dataset
+
+
+def source_info(path: str) -> dict:
+    stat = os.stat(path)
+    return {
+        "file": os.path.basename(path),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+    }
+
+
+def is_converted(mix_group: zarr.Group, roi_path: str) -> bool:
+    """
+    Checks whether the ROI tiff was already converted and has not changed since.
+    """
+    roi_name = os.path.basename(roi_path).split(".")[0]
+    apical_class = "apical_in" if "_in_" in roi_name else "apical_out"
+    raw_data_path = f"{apical_class}/{roi_name}/raw_data"
+
+    if raw_data_path not in mix_group:
+        return False
+
+    source = mix_group[raw_data_path].attrs.get("source")
+    current = source_info(roi_path)
+    return (
+        source is not None
+        and source["mtime"] == current["mtime"]
+        and source["size"] == current["size"]
+    )
+
+
+@contextlib.contextmanager
+def open_tiff(path: str):
+    """
+    Opens a tiff as a lazily read array, so that only the strips or tiles that are
+    accessed get decoded. Falls back to reading the whole image when the installed
+    tifffile cannot expose the tiff as a zarr array of this zarr version.
+    """
+    try:
+        store = tifffile.imread(path, aszarr=True)
+    except ValueError:
+        yield tifffile.imread(path)
+        return
+
+    with store:
+        yield zarr.open(store, mode="r")
+
+
+def convert_roi(zarr_path: str, mix: str, roi_path: str, layout: str = None) -> str:
+    root = zarr.open(zarr_path, mode="a")
+    mix_group = root[mix]
+
+    roi_name = os.path.basename(roi_path).split(".")[0]
+    apical_class = "apical_in" if "_in_" in roi_name else "apical_out"
+
+    with open_tiff(roi_path) as img:
+        r_dataset = create_roi_dataset(mix_group, apical_class, roi_name, img, layout)
+
+    # recorded last, so that an interrupted conversion is redone
+    r_dataset.attrs["source"] = source_info(roi_path)
+    return roi_name
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the ROI tiffs to Zarr.")
+    parser.add_argument("--roi-dir", type=str, default=ROI_DIR)
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--layout",
+        choices=storage.LAYOUTS,
+        default=storage.DEFAULT_LAYOUT,
+        help="Chunk layout of the raw data. 'planar' stores every channel in its own chunks.",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=-1, help="Number of ROIs converted in parallel"
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Recreate the Zarr file instead of only converting new or changed ROIs",
+    )
+    args = parser.parse_args()
 
-    root = zarr.open(ZARR_PATH, mode="w")
+    root = zarr.open(args.zarr_path, mode="w" if args.overwrite else "a")
 
     mix_dirs = [
         d
-        for d in os.listdir(ROI_DIR)
-        if (os.path.isdir(os.path.join(ROI_DIR, d)) and d != "manual")
+        for d in os.listdir(args.roi_dir)
+        if (os.path.isdir(os.path.join(args.roi_dir, d)) and d != "manual")
     ]
 
+    rois = []
     for mix in mix_dirs:
-        mix_group = root.create_group(mix)
-        mix_group.attrs["name"] = mix
-        mix_group.attrs["targets"] = MIX_PROTEINS[mix]
-        mix_group.attrs["author"] = (
-            "Nicolas Pasquier, Cell Adhesion and Cancer Lab, University of Turku"
-        )
+        mix_group = create_mix_group(root, mix)
+        # created here, as threads creating them concurrently can collide
+        for apical_class in ["apical_in", "apical_out"]:
+            mix_group.require_group(apical_class)
+
+        mix_rois = glob(os.path.join(args.roi_dir, mix, "*.tif"))
+        apical_in_rois = [r for r in mix_rois if "_in_" in r]
+        apical_out_rois = [r for r in mix_rois if "_out_" in r]
 
-        rois = glob(os.path.join(ROI_DIR, mix, "*.tif"))
-        apical_in_rois = [r for r in rois if "_in_" in r]
-        apical_out_rois = [r for r in rois if "_out_" in r]
-
-        assert len(apical_in_rois) + len(apical_out_rois) == len(rois)
-
-        for roi in tqdm(rois, desc=f"Processing {mix} apical in"):
-            roi_name = os.path.basename(roi).split(".")[0]
-            apical_class = "apical_in" if "_in_" in roi_name else "apical_out"
-
-            img = io.imread(roi)
-
-            r_dataset = mix_group.create_dataset(
-                f"{apical_class}/{roi_name}/raw_data", data=img
-            )
-            r_dataset.attrs["name"] = roi_name
-            r_dataset.attrs["author"] = mix_group.attrs["author"]
-            r_dataset.attrs["resolution"] = {
-                "unit": "microns / pixel",
-                "x": 0.3250000,
-                "y": 0.3250000,
-            }
-            r_dataset.attrs["bit_depth"] = 16
-            r_dataset.attrs["dim_order"] = "YXC"
-            r_dataset.attrs["dimensions"] = {
-                "height": img.shape[0],
-                "width": img.shape[1],
-                "channels": ["DAPI", "Cy3", "AF647"],
-            }
-            r_dataset.attrs["height"] = img.shape[0]
-            r_dataset.attrs["width"] = img.shape[1]
+        assert len(apical_in_rois) + len(apical_out_rois) == len(mix_rois)
+
+        rois.extend((mix, roi) for roi in mix_rois if not is_converted(mix_group, roi))
+
+    print(f"Converting {len(rois)} ROIs...")
+    # tiff decoding and compression release the GIL, so threads avoid copying the
+    # images between processes
+    with catalog.updated_after(args.zarr_path):
+        Parallel(n_jobs=args.jobs, prefer="threads", verbose=10)(
+            delayed(convert_roi)(args.zarr_path, mix, roi, args.layout)
+            for mix, roi in rois
+        )
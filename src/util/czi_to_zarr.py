@@ -0,0 +1,172 @@
+"""
+Read the annotated ROIs straight from the CZI slides into zarr, without exporting them
+to tiff first.
+
+The bounding boxes and polygons of the annotations are read from the `*_roi_bboxes.csv`
+files written by `extract_roi_bounding_boxes.groovy`. Only the bounding box of each
+annotation is read from the CZI file, pixels outside the annotation polygon are zeroed
+like in the QuPath tiff exports, and the ROIs are stored in the same hierarchy as
+`convert_to_zarr.py` creates. Slides are processed in parallel, and each worker holds
+only one ROI in memory at a time.
+"""
+
+import argparse
+import math
+import os
+import re
+import sys
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import zarr
+from joblib import Parallel, delayed
+from skimage.draw import polygon2mask
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+import storage  # noqa: E402
+from convert_to_zarr import (  # noqa: E402
+    ZARR_PATH,
+    create_mix_group,
+    create_roi_dataset,
+)
+
+CZI_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "czi")
+BBOX_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "roi_bboxes")
+
+
+def _mix(slide: str) -> str:
+    match = re.search(r"mix(\d+)", slide)
+    if match is None:
+        raise ValueError(f"Cannot infer the mix of slide {slide}")
+    return f"mix_{match.group(1)}"
+
+
+def _apical_class(path_class: str) -> str:
+    path_class = str(path_class).lower()
+    if "out" in path_class:
+        return "apical_out"
+    elif "in" in path_class:
+        return "apical_in"
+    else:
+        raise ValueError(f"Cannot infer apical type of annotation class {path_class}")
+
+
+def _polygon_mask(polygon: str, x0: int, y0: int, shape: tuple) -> np.ndarray:
+    """
+    Rasterizes an annotation given as rings of "x y" vertices separated by semicolons,
+    the rings separated by "|": the outlines of all parts of the annotation and of
+    their holes. The rings are combined with the even-odd rule, so holes are cut out.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    for ring in polygon.split("|"):
+        vertices = np.array(
+            [[float(v) for v in point.split()] for point in ring.split(";")]
+        )
+        # polygon2mask expects (row, column) vertices
+        mask ^= polygon2mask(shape, vertices[:, ::-1] - [y0, x0])
+    return mask
+
+
+def read_rois(czi_path: str, bboxes: pd.DataFrame):
+    """
+    Reads the bounding box of every annotation from a CZI file, one at a time.
+
+    Yields:
+    tuple: (apical class, ROI name, YXC image) of every annotation, numbered per apical
+    class in the order of the CSV like the tiff exports.
+    """
+    from pylibCZIrw import czi as pyczi
+
+    slide = os.path.basename(czi_path).replace(".czi", "")
+    counts = {"apical_in": 0, "apical_out": 0}
+
+    with pyczi.open_czi(czi_path) as czi:
+        # QuPath coordinates are relative to the corner of the scanned area
+        origin = czi.total_bounding_rectangle
+        n_channels = czi.total_bounding_box["C"][1]
+
+        for row in bboxes.itertuples():
+            apical_class = _apical_class(row.path_class)
+            counts[apical_class] += 1
+            roi_name = f"{slide}_{apical_class.split('_')[1]}_{counts[apical_class]}"
+
+            x0, y0 = math.floor(row.bounds_x), math.floor(row.bounds_y)
+            x1 = math.ceil(row.bounds_x + row.bounds_width)
+            y1 = math.ceil(row.bounds_y + row.bounds_height)
+            region = (origin.x + x0, origin.y + y0, x1 - x0, y1 - y0)
+
+            img = np.stack(
+                [
+                    czi.read(roi=region, plane={"C": c})[:, :, 0]
+                    for c in range(n_channels)
+                ],
+                axis=-1,
+            )
+
+            if isinstance(getattr(row, "polygon", None), str):
+                img[~_polygon_mask(row.polygon, x0, y0, img.shape[:2])] = 0
+
+            yield apical_class, roi_name, img
+
+
+def ingest_slide(
+    zarr_path: str, czi_path: str, bbox_path: str, layout: str = None
+) -> list:
+    bboxes = pd.read_csv(bbox_path)
+    slide = os.path.basename(czi_path).replace(".czi", "")
+
+    root = zarr.open(zarr_path, mode="a")
+    mix_group = root[_mix(slide)]
+
+    roi_names = []
+    # each ROI is written before the next one is read
+    for apical_class, roi_name, img in read_rois(czi_path, bboxes):
+        create_roi_dataset(mix_group, apical_class, roi_name, img, layout)
+        roi_names.append(roi_name)
+        del img
+    return roi_names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Read the annotated ROIs from the CZI slides into Zarr."
+    )
+    parser.add_argument("--czi-dir", type=str, default=CZI_DIR)
+    parser.add_argument(
+        "--bbox-dir",
+        type=str,
+        default=BBOX_DIR,
+        help="Directory of the *_roi_bboxes.csv files exported from QuPath",
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--layout", choices=storage.LAYOUTS, default=storage.DEFAULT_LAYOUT
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=-1, help="Number of slides read in parallel"
+    )
+    args = parser.parse_args()
+
+    slides = []
+    for bbox_path in sorted(glob(os.path.join(args.bbox_dir, "*_roi_bboxes.csv"))):
+        slide = os.path.basename(bbox_path).replace("_roi_bboxes.csv", "")
+        czi_path = os.path.join(args.czi_dir, f"{slide}.czi")
+        assert os.path.exists(czi_path), f"CZI file not found for slide {slide}"
+        slides.append((czi_path, bbox_path))
+
+    root = zarr.open(args.zarr_path, mode="w")
+    for mix in sorted({_mix(os.path.basename(czi_path)) for czi_path, _ in slides}):
+        mix_group = create_mix_group(root, mix)
+        # created here, as workers creating them concurrently can collide
+        for apical_class in ["apical_in", "apical_out"]:
+            mix_group.require_group(apical_class)
+
+    roi_names = Parallel(n_jobs=args.jobs, verbose=10)(
+        delayed(ingest_slide)(args.zarr_path, czi_path, bbox_path, args.layout)
+        for czi_path, bbox_path in slides
+    )
+    catalog.write_catalog(args.zarr_path)
+    print(f"Stored {sum(len(names) for names in roi_names)} ROIs")
@@ -12,11 +12,29 @@ def annotationData = []
 annotations.each { annotation ->
 def roi = annotation.getROI()    
     bounds = [roi.getBoundsX(), roi.getBoundsY(), roi.getBoundsWidth(), roi.getBoundsHeight()]
+    // rings of the annotation as "x y" vertices separated by semicolons, the rings
+    // separated by "|": the outline of every part and of every hole. They are filled
+    // with the even-odd rule to zero the pixels outside the annotation when reading the
+    // bounding box from the CZI file
+    def geometry = roi.getGeometry()
+    def rings = []
+    for (int i = 0; i < geometry.getNumGeometries(); i++) {
+        def part = geometry.getGeometryN(i)
+        if (part instanceof org.locationtech.jts.geom.Polygon) {
+            rings << part.getExteriorRing()
+            for (int j = 0; j < part.getNumInteriorRing(); j++) {
+                rings << part.getInteriorRingN(j)
+            }
+        }
+    }
+    def polygon = rings.collect { ring ->
+        ring.getCoordinates().collect { "${it.x} ${it.y}" }.join(';')
+    }.join('|')
     print("${filename}, ${annotation.getPathClass()}, ${bounds}")
-    annotationData << [filename, annotation.getPathClass(), bounds]
+    annotationData << [filename, annotation.getPathClass(), bounds, polygon]
 }
 
-def csvHeader = ["filename", "path_class", "bounds_x", "bounds_y", "bounds_width", "bounds_height"]
+def csvHeader = ["filename", "path_class", "bounds_x", "bounds_y", "bounds_width", "bounds_height", "polygon"]
 def csvFile = new File("f:/scratch/${filename}_roi_bboxes.csv")
 
 // Save data to CSV using QuPath's file writing capabilities
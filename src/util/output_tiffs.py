@@ -3,9 +3,13 @@ Utility script for generating tiff outputs of ROI roi data and their generated m
 """
 
 import os
-import zarr
+import sys
 from skimage import io, img_as_ubyte
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+
 ZARR_PATH = os.path.join(
     os.path.dirname(__file__), "..", "..", "zarr_data", "roi_data.zarr"
 )
@@ -14,14 +18,15 @@ OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "tiff_outputs")
 
 
 if __name__ == "__main__":
-    root = zarr.open(ZARR_PATH, mode="r")
+    root = catalog.open_root(ZARR_PATH)
+    entries = catalog.read_catalog(ZARR_PATH)
 
-    mixes = list(root.keys())
+    mixes = catalog.mixes(entries)
     for mix in mixes:
 
-        for ap in list(root[mix].keys()):
+        for ap in ["apical_in", "apical_out"]:
 
-            roi_keys = list(root[mix][ap].keys())
+            roi_keys = catalog.roi_names(entries, mix, ap)
 
             for roi_key in roi_keys:
 
@@ -0,0 +1,67 @@
+"""
+Rewrite the raw data of an existing Zarr file in another chunk layout and with the
+current raw data codec.
+
+The data and attributes of every raw data dataset are kept, so content hashes and the
+provenance of downstream outputs remain valid.
+"""
+
+import argparse
+import os
+import sys
+
+import zarr
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import catalog  # noqa: E402
+import storage  # noqa: E402
+
+ZARR_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "zarr_data", "roi_data.zarr"
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rewrite the raw data of a Zarr file in another chunk layout."
+    )
+    parser.add_argument("--zarr-path", type=str, default=ZARR_PATH)
+    parser.add_argument(
+        "--layout", choices=storage.LAYOUTS, default=storage.DEFAULT_LAYOUT
+    )
+    args = parser.parse_args()
+
+    root = zarr.open(args.zarr_path, mode="a")
+
+    raw_data_paths = [
+        f"{entry['mix']}/{entry['apical_type']}/{entry['roi']}/raw_data"
+        for entry in catalog.read_catalog(args.zarr_path)
+    ]
+
+    compressor = storage.compressor("raw")
+    with catalog.updated_after(args.zarr_path):
+        for path in tqdm(raw_data_paths, desc="Rechunking raw data"):
+            # the copy is written next to the original, which is only removed afterwards
+            copy_path = f"{path}_rechunked"
+            if path not in root and copy_path in root:
+                # interrupted between removing the original and moving the copy
+                root.move(copy_path, path)
+            if copy_path in root:
+                del root[copy_path]
+
+            dataset = root[path]
+            chunks = zarr.util.normalize_chunks(
+                storage.raw_data_chunks(dataset.shape, args.layout),
+                dataset.shape,
+                dataset.dtype.itemsize,
+            )
+            if dataset.chunks == chunks and dataset.compressor == compressor:
+                continue
+
+            # copied one row of chunks at a time
+            copy = storage.create_raw_data(root, copy_path, dataset, args.layout)
+            copy.attrs.update({**dataset.attrs.asdict(), "layout": args.layout})
+
+            del root[path]
+            root.move(copy_path, path)
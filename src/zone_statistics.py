@@ -0,0 +1,274 @@
+"""
+Vectorized per-zone intensity statistics.
+
+The zones of an ROI overlap (e.g. the outer zone is part of the ROI mask), so instead
+of boolean-indexing every channel once per zone, the zone memberships of each pixel are
+packed into the bits of a compact label image. Counts and sums for every combination of
+zones are then computed with a single `np.bincount` per channel and statistic, and the
+per-zone values are recovered by summing over the combinations that contain the zone.
+The same labels are used by `ZoneMoments` to accumulate the statistics of large ROIs
+band by band instead of in a single pass.
+"""
+
+import math
+
+import numpy as np
+import zarr
+
+import storage
+
+MAX_ZONES = 8
+
+
+def zone_label_image(zones: list) -> np.ndarray:
+    """
+    Packs a list of boolean zone masks into a uint8 image where bit `i` of each pixel
+    is set if the pixel belongs to `zones[i]`.
+    """
+    assert 0 < len(zones) <= MAX_ZONES, f"Expected 1 to {MAX_ZONES} zones."
+
+    labels = np.zeros(zones[0].shape, dtype=np.uint8)
+    for i, zone in enumerate(zones):
+        labels |= zone.astype(np.uint8) << np.uint8(i)
+    return labels
+
+
+def zone_membership(n_zones: int) -> np.ndarray:
+    """
+    Returns a boolean (n_zones, 2 ** n_zones) table telling which zones each label of
+    `zone_label_image` belongs to.
+    """
+    codes = np.arange(1 << n_zones)
+    return ((codes[None, :] >> np.arange(n_zones)[:, None]) & 1).astype(bool)
+
+
+def zone_statistics(channels: list, zones: list) -> dict:
+    """
+    Computes pixel counts, intensity sums, means and sums of squares of each channel
+    in each zone in a single pass over the image.
+
+    Args:
+    channels (list): 2D intensity arrays with the same shape as the zones.
+    zones (list): Boolean masks of the zones.
+
+    Returns:
+    dict: "count" with shape (n_zones,) and "sum", "mean" and "sum_sq" with shape
+    (n_zones, n_channels). Means of empty zones are NaN.
+    """
+    labels = zone_label_image(zones).ravel()
+    n_labels = 1 << len(zones)
+    membership = zone_membership(len(zones))
+
+    label_counts = np.bincount(labels, minlength=n_labels)
+    label_sums = np.empty((n_labels, len(channels)))
+    label_sums_sq = np.empty((n_labels, len(channels)))
+    for c, channel in enumerate(channels):
+        values = channel.ravel().astype(np.float64)
+        label_sums[:, c] = np.bincount(labels, weights=values, minlength=n_labels)
+        np.square(values, out=values)
+        label_sums_sq[:, c] = np.bincount(labels, weights=values, minlength=n_labels)
+
+    counts = membership @ label_counts
+    # float64 sums of 16-bit data are exact below 2 ** 53
+    sums = np.rint(membership @ label_sums).astype(np.int64)
+    sums_sq = membership @ label_sums_sq
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, None]
+
+    return {"count": counts, "sum": sums, "mean": means, "sum_sq": sums_sq}
+
+
+def zone_histograms(channels: list, zones: list, n_values: int = 1 << 16) -> np.ndarray:
+    """
+    Computes the intensity histogram of each channel in each zone.
+
+    The zone label of each pixel and its intensity are combined into a single code, so
+    the histograms of all combinations of zones come from one `np.bincount` per channel.
+
+    Args:
+    channels (list): 2D integer intensity arrays with values below `n_values`.
+    zones (list): Boolean masks of the zones.
+
+    Returns:
+    np.ndarray: Pixel counts with shape (n_zones, n_channels, n_values).
+    """
+    labels = zone_label_image(zones).ravel().astype(np.int64) * n_values
+    n_labels = 1 << len(zones)
+    membership = zone_membership(len(zones))
+
+    histograms = np.empty((len(zones), len(channels), n_values), dtype=np.int64)
+    for c, channel in enumerate(channels):
+        codes = labels + channel.ravel()
+        label_histograms = np.bincount(codes, minlength=n_labels * n_values)
+        label_histograms = label_histograms.reshape(n_labels, n_values)
+        histograms[:, c] = membership.astype(np.int64) @ label_histograms
+
+    return histograms
+
+
+class ZoneMoments:
+    """
+    Streaming accumulator of the sufficient statistics of the joint distribution of two
+    channels in each zone: the pixel count n and the sums of x, y, x², y² and xy.
+
+    Blocks of the image are added one at a time with `update`, so only a block has to
+    be held in memory. The sums are accumulated as exact integers, so the Pearson
+    correlation and the totals do not depend on how the image is split into blocks.
+    """
+
+    STATISTICS = ["sum_x", "sum_y", "sum_xx", "sum_yy", "sum_xy"]
+
+    # Pixels per bincount. The float64 weighted bincounts are exact as long as the
+    # sums of products of 16-bit values over a block stay below 2 ** 53.
+    BLOCK_PIXELS = 1 << 21
+
+    def __init__(self, n_zones: int):
+        assert 0 < n_zones <= MAX_ZONES, f"Expected 1 to {MAX_ZONES} zones."
+        self.n_zones = n_zones
+        self.n_labels = 1 << n_zones
+        self.label_counts = np.zeros(self.n_labels, dtype=np.int64)
+        self.label_sums = np.zeros(
+            (len(self.STATISTICS), self.n_labels), dtype=np.int64
+        )
+
+    def update(self, x: np.ndarray, y: np.ndarray, zones: list):
+        """
+        Adds a block of the two channels and the zone masks, all of the same shape.
+        """
+        assert len(zones) == self.n_zones, f"Expected {self.n_zones} zones."
+
+        labels = zone_label_image(zones).ravel()
+        x = x.ravel()
+        y = y.ravel()
+
+        for start in range(0, labels.size, self.BLOCK_PIXELS):
+            block = slice(start, start + self.BLOCK_PIXELS)
+            block_labels = labels[block]
+            bx = x[block].astype(np.float64)
+            by = y[block].astype(np.float64)
+
+            self.label_counts += np.bincount(block_labels, minlength=self.n_labels)
+            for s, weights in enumerate([bx, by, bx * bx, by * by, bx * by]):
+                self.label_sums[s] += np.rint(
+                    np.bincount(block_labels, weights=weights, minlength=self.n_labels)
+                ).astype(np.int64)
+
+    def count(self) -> np.ndarray:
+        """
+        Returns the pixel count of each zone.
+        """
+        return zone_membership(self.n_zones) @ self.label_counts
+
+    def sums(self) -> dict:
+        """
+        Returns the sums of x, y, x², y² and xy in each zone as int64 arrays.
+        """
+        membership = zone_membership(self.n_zones).astype(np.int64)
+        return {
+            name: membership @ self.label_sums[s]
+            for s, name in enumerate(self.STATISTICS)
+        }
+
+    def pearson(self) -> np.ndarray:
+        """
+        Returns the Pearson correlation of the two channels in each zone: 0 for empty
+        zones and NaN for zones where either channel is constant, like
+        `scipy.stats.pearsonr`.
+        """
+        counts = self.count()
+        sums = self.sums()
+
+        return np.array(
+            [
+                pearson_from_sums(
+                    int(counts[z]), *(int(sums[name][z]) for name in self.STATISTICS)
+                )
+                for z in range(self.n_zones)
+            ]
+        )
+
+
+def pearson_from_sums(
+    n: int, sum_x: int, sum_y: int, sum_xx: int, sum_yy: int, sum_xy: int
+) -> float:
+    """
+    Returns the Pearson correlation from the sufficient statistics of two channels: 0
+    if there are no pixels and NaN if either channel is constant, like
+    `scipy.stats.pearsonr`. The statistics are Python ints, so the products do not
+    overflow.
+    """
+    if n == 0:
+        return 0.0
+
+    covariance = n * sum_xy - sum_x * sum_y
+    variance_x = n * sum_xx - sum_x * sum_x
+    variance_y = n * sum_yy - sum_y * sum_y
+    if variance_x == 0 or variance_y == 0:
+        return np.nan
+    return covariance / math.sqrt(variance_x * variance_y)
+
+
+def stream_zone_moments(
+    raw_data: zarr.Array, channels: tuple, zones: list, rows: int = None
+) -> ZoneMoments:
+    """
+    Accumulates the `ZoneMoments` of two channels of a YXC raw data dataset, reading
+    the raw data and the zone masks one band of rows at a time.
+
+    Args:
+    raw_data (zarr.Array): YXC raw data.
+    channels (tuple): Indices of the x and y channels.
+    zones (list): Boolean zone mask datasets or arrays with the YX shape of the raw data.
+    rows (int): Height of the bands, by default the chunk height of the raw data.
+    """
+    if rows is None:
+        rows = raw_data.chunks[0]
+
+    moments = ZoneMoments(len(zones))
+    for y0 in range(0, raw_data.shape[0], rows):
+        band = slice(y0, y0 + rows)
+        moments.update(
+            storage.read_channel(raw_data, channels[0], (band, slice(None))),
+            storage.read_channel(raw_data, channels[1], (band, slice(None))),
+            [np.asarray(zone[band]) for zone in zones],
+        )
+    return moments
+
+
+def count_labels_in_zones(labels, zones: list, rows: int = None) -> np.ndarray:
+    """
+    Counts the distinct non-zero labels, e.g. nuclei, that overlap each zone.
+
+    The label image and the zone masks are read one band of rows at a time. Each pixel
+    is encoded as label * 2 ** n_zones + zone label, so a single `np.bincount` per band
+    fills a label × zone combination presence table, from which the labels present in
+    every zone are counted at once.
+
+    Args:
+    labels (zarr.Array): Label image dataset or array.
+    zones (list): Boolean zone mask datasets or arrays with the shape of `labels`.
+    rows (int): Height of the bands, by default the chunk height of the labels.
+
+    Returns:
+    np.ndarray: The number of labels in each zone.
+    """
+    if rows is None:
+        rows = labels.chunks[0] if isinstance(labels, zarr.Array) else labels.shape[0]
+
+    n_codes = 1 << len(zones)
+    presence = np.zeros((1, n_codes), dtype=bool)
+    for y0 in range(0, labels.shape[0], rows):
+        band = slice(y0, y0 + rows)
+        codes = zone_label_image([np.asarray(zone[band]) for zone in zones])
+        combined = np.asarray(labels[band]).astype(np.int64) * n_codes + codes
+        band_presence = np.bincount(combined.ravel()).astype(bool)
+
+        n_labels = -(-band_presence.size // n_codes)
+        if n_labels > presence.shape[0]:
+            presence = np.pad(presence, ((0, n_labels - presence.shape[0]), (0, 0)))
+        presence.ravel()[: band_presence.size] |= band_presence
+
+    # the background label 0 is not counted
+    in_zones = presence[1:].astype(np.int64) @ zone_membership(len(zones)).T
+    return np.count_nonzero(in_zones, axis=0)
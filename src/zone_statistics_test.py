@@ -0,0 +1,277 @@
+import numpy as np
+import pytest
+import zarr
+from scipy.stats import pearsonr
+
+from histograms import N_VALUES, rebin
+from zone_statistics import (
+    count_labels_in_zones,
+    ZoneMoments,
+    pearson_from_sums,
+    stream_zone_moments,
+    zone_histograms,
+    zone_statistics,
+)
+
+
+def _random_zones(shape, rng):
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    roi = np.hypot(yy - shape[0] / 2, xx - shape[1] / 2) < min(shape) * 0.45
+    # overlapping zones: the outer zone is part of the ROI, the inner one partly too
+    outer = roi & (np.hypot(yy - shape[0] / 2, xx - shape[1] / 2) > min(shape) * 0.3)
+    inner = rng.random(shape) < 0.3
+    empty = np.zeros(shape, dtype=bool)
+    return [roi, outer, inner, empty]
+
+
+def _random_channels(shape, rng):
+    return [rng.integers(0, 1 << 16, shape, dtype=np.uint16) for _ in range(2)]
+
+
+def _reference_statistics(channels, zones):
+    # boolean indexing per zone and channel, as RoiAnalyzer did before
+    counts = np.array([np.count_nonzero(zone) for zone in zones])
+    sums = np.array(
+        [
+            [np.sum(channel[zone], dtype=np.int64) for channel in channels]
+            for zone in zones
+        ]
+    )
+    sums_sq = np.array(
+        [
+            [np.sum(channel[zone].astype(np.float64) ** 2) for channel in channels]
+            for zone in zones
+        ]
+    )
+    means = np.array(
+        [
+            [np.mean(channel[zone]) if zone.any() else np.nan for channel in channels]
+            for zone in zones
+        ]
+    )
+    return {"count": counts, "sum": sums, "mean": means, "sum_sq": sums_sq}
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_zone_statistics_matches_boolean_indexing(seed):
+    rng = np.random.default_rng(seed)
+    shape = (211, 157)
+    channels = _random_channels(shape, rng)
+    zones = _random_zones(shape, rng)
+
+    stats = zone_statistics(channels, zones)
+    expected = _reference_statistics(channels, zones)
+
+    assert np.array_equal(stats["count"], expected["count"])
+    assert np.array_equal(stats["sum"], expected["sum"])
+    np.testing.assert_allclose(stats["sum_sq"], expected["sum_sq"], rtol=1e-12)
+    np.testing.assert_allclose(stats["mean"], expected["mean"], rtol=1e-12)
+
+
+def test_zone_statistics_empty_zone():
+    rng = np.random.default_rng(0)
+    shape = (64, 64)
+    channels = _random_channels(shape, rng)
+    zones = _random_zones(shape, rng)
+
+    stats = zone_statistics(channels, zones)
+
+    assert stats["count"][-1] == 0
+    assert np.all(stats["sum"][-1] == 0)
+    assert np.all(stats["sum_sq"][-1] == 0)
+    assert np.all(np.isnan(stats["mean"][-1]))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_zone_histograms_match_bincount(seed):
+    rng = np.random.default_rng(seed)
+    shape = (211, 157)
+    channels = _random_channels(shape, rng)
+    zones = _random_zones(shape, rng)
+
+    histograms = zone_histograms(channels, zones)
+
+    assert histograms.shape == (len(zones), len(channels), N_VALUES)
+    for z, zone in enumerate(zones):
+        for c, channel in enumerate(channels):
+            expected = np.bincount(channel[zone], minlength=N_VALUES)
+            assert np.array_equal(histograms[z, c], expected)
+
+
+@pytest.mark.parametrize(
+    "pixels",
+    [
+        np.random.default_rng(0).integers(0, 1 << 16, 10_000),
+        np.random.default_rng(1).integers(100, 140, 500),
+        np.full(50, 1234),
+        np.array([], dtype=np.int64),
+    ],
+    ids=["full_range", "narrow_range", "single_value", "empty"],
+)
+def test_rebin_matches_np_histogram(pixels):
+    histogram = np.bincount(pixels, minlength=N_VALUES)
+
+    counts, edges = rebin(histogram)
+    expected_counts, expected_edges = np.histogram(pixels, bins=128)
+
+    assert np.array_equal(counts, expected_counts)
+    assert np.array_equal(edges, expected_edges)
+
+
+def _correlated_channels(shape, rng):
+    shared = rng.integers(0, 1 << 15, shape)
+    x = (shared + rng.integers(0, 1 << 15, shape)).astype(np.uint16)
+    y = (shared + rng.integers(0, 1 << 14, shape)).astype(np.uint16)
+    return x, y
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_zone_moments_match_pearsonr(seed):
+    rng = np.random.default_rng(seed)
+    shape = (173, 201)
+    x, y = _correlated_channels(shape, rng)
+    zones = _random_zones(shape, rng)[:3]
+
+    moments = ZoneMoments(len(zones))
+    moments.update(x, y, zones)
+
+    expected = [pearsonr(x[zone], y[zone])[0] for zone in zones]
+    np.testing.assert_allclose(moments.pearson(), expected, rtol=1e-12)
+    assert np.array_equal(moments.count(), [np.count_nonzero(z) for z in zones])
+    assert np.array_equal(
+        moments.sums()["sum_xy"],
+        [np.sum(x[z].astype(np.int64) * y[z].astype(np.int64)) for z in zones],
+    )
+
+
+def test_zone_moments_do_not_depend_on_blocks(monkeypatch):
+    rng = np.random.default_rng(0)
+    shape = (300, 250)
+    x, y = _correlated_channels(shape, rng)
+    zones = _random_zones(shape, rng)
+
+    whole = ZoneMoments(len(zones))
+    whole.update(x, y, zones)
+
+    # small bincount blocks, and the image added in uneven bands
+    monkeypatch.setattr(ZoneMoments, "BLOCK_PIXELS", 997)
+    banded = ZoneMoments(len(zones))
+    for band in [slice(0, 1), slice(1, 120), slice(120, 299), slice(299, 300)]:
+        banded.update(x[band], y[band], [zone[band] for zone in zones])
+
+    assert np.array_equal(banded.label_counts, whole.label_counts)
+    assert np.array_equal(banded.label_sums, whole.label_sums)
+    assert np.array_equal(banded.pearson(), whole.pearson(), equal_nan=True)
+
+
+@pytest.mark.parametrize("rows", [None, 1, 7, 64, 1000])
+def test_stream_zone_moments_do_not_depend_on_bands(rows):
+    rng = np.random.default_rng(1)
+    shape = (150, 130)
+    x, y = _correlated_channels(shape, rng)
+    raw_data = zarr.array(
+        np.stack([np.zeros(shape, dtype=np.uint16), x, y], axis=-1),
+        chunks=(32, 64, 1),
+    )
+    zones = _random_zones(shape, rng)
+    zone_datasets = [zarr.array(zone, chunks=(32, 64)) for zone in zones]
+
+    streamed = stream_zone_moments(raw_data, (1, 2), zone_datasets, rows)
+    expected = ZoneMoments(len(zones))
+    expected.update(x, y, zones)
+
+    assert np.array_equal(streamed.label_counts, expected.label_counts)
+    assert np.array_equal(streamed.label_sums, expected.label_sums)
+
+
+def test_zone_moments_constant_channel_is_nan():
+    rng = np.random.default_rng(2)
+    shape = (50, 60)
+    x = np.full(shape, 1000, dtype=np.uint16)
+    y = rng.integers(0, 1 << 16, shape, dtype=np.uint16)
+    zones = [np.ones(shape, dtype=bool)]
+
+    moments = ZoneMoments(1)
+    moments.update(x, y, zones)
+
+    assert np.isnan(moments.pearson()[0])
+
+
+def test_zone_moments_empty_zone_is_zero():
+    rng = np.random.default_rng(3)
+    shape = (50, 60)
+    x, y = _correlated_channels(shape, rng)
+    zones = [np.ones(shape, dtype=bool), np.zeros(shape, dtype=bool)]
+
+    moments = ZoneMoments(2)
+    moments.update(x, y, zones)
+
+    assert moments.count()[1] == 0
+    assert moments.pearson()[1] == 0
+    assert pearson_from_sums(0, 0, 0, 0, 0, 0) == 0
+
+
+def test_pearson_from_sums_beyond_int64():
+    # the sums of many pooled ROIs overflow int64 in the products
+    x = np.array([1, 2, 3, 4, 6]) * 40000
+    y = np.array([2, 1, 4, 3, 7]) * 40000
+    repeats = 10**8
+    n = x.size * repeats
+    sums = [int(s) * repeats for s in [x.sum(), y.sum(), x @ x, y @ y, x @ y]]
+
+    assert n * sums[2] > np.iinfo(np.int64).max
+    assert pearson_from_sums(n, *sums) == pytest.approx(pearsonr(x, y)[0], rel=1e-12)
+
+
+def _reference_label_counts(labels, zones):
+    # distinct labels per zone, as measure_correlation counted nuclei before
+    return [np.count_nonzero(np.unique(labels[zone])) for zone in zones]
+
+
+def _random_labels(shape, n_labels, rng):
+    labels = np.zeros(shape, dtype=np.int32)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    for label in range(1, n_labels + 1):
+        cy, cx = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        labels[np.hypot(yy - cy, xx - cx) < rng.integers(2, 9)] = label
+    return labels
+
+
+@pytest.mark.parametrize("rows", [None, 1, 5, 16, 500])
+def test_count_labels_in_zones_matches_unique(rows):
+    rng = np.random.default_rng(4)
+    shape = (120, 90)
+    labels = _random_labels(shape, 80, rng)
+    zones = _random_zones(shape, rng)
+
+    counts = count_labels_in_zones(labels, zones, rows)
+
+    assert list(counts) == _reference_label_counts(labels, zones)
+    # the empty zone has no labels, and the background is never counted
+    assert counts[-1] == 0
+
+
+def test_count_labels_in_zones_across_bands():
+    shape = (40, 30)
+    labels = np.zeros(shape, dtype=np.int32)
+    # spans the band boundary at row 10 and only overlaps the zone below it
+    labels[5:15, 2:6] = 3
+    # only in the last band, with the largest label, so the table grows there
+    labels[35:40, 20:25] = 1000
+    zone = np.zeros(shape, dtype=bool)
+    zone[12:, :] = True
+    zones = [zone, np.ones(shape, dtype=bool)]
+
+    counts = count_labels_in_zones(zarr.array(labels, chunks=(10, 30)), zones)
+
+    assert list(counts) == [2, 2]
+    assert list(counts) == _reference_label_counts(labels, zones)
+
+
+def test_count_labels_in_zones_background_only():
+    shape = (20, 20)
+    zones = [np.ones(shape, dtype=bool)]
+
+    counts = count_labels_in_zones(np.zeros(shape, dtype=np.int32), zones, 7)
+
+    assert list(counts) == [0]
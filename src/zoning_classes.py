@@ -6,6 +6,7 @@ from typing import Optional
 import os
 import numpy as np
 import zarr
+from scipy import ndimage as ndi
 from skimage import img_as_ubyte
 from skimage import io
 from skimage.draw import set_color
@@ -14,10 +15,63 @@ from skimage.exposure import adjust_gamma
 from skimage.morphology import dilation, disk, erosion
 from glob import glob
 
+import cropping
+import profiling
+import provenance
+import storage
+
 INNER_ZONE_THICKNESS = 45
 OUTER_ZONE_THICKNESS = 45
 MANUAL_ROI_DIR = os.path.join(os.path.dirname(__file__), "..", "rois", "manual")
 
+# "distance" derives the zones from Euclidean distance transforms, "footprint" uses
+# erosion / dilation with a flat disk footprint. Both give identical masks.
+ZONING_METHOD = "distance"
+
+
+def _erode_disk(mask: np.ndarray, radius: int, method: str = None) -> np.ndarray:
+    """
+    Binary erosion of `mask` with `disk(radius)`.
+
+    A pixel survives the erosion if no background pixel lies within `radius`, which is
+    exactly `distance_transform_edt(mask) > radius`. The cost of the distance transform
+    does not depend on the radius.
+    """
+    method = ZONING_METHOD if method is None else method
+
+    with profiling.span("erosion"):
+        if method == "footprint":
+            return erosion(mask, disk(radius))
+        elif method == "distance":
+            mask = mask.astype(bool)
+            if mask.all():
+                # no background pixel to measure distances to
+                return mask
+            return ndi.distance_transform_edt(mask) > radius
+        else:
+            raise ValueError(f"Unknown zoning method: {method}")
+
+
+def _dilate_disk(mask: np.ndarray, radius: int, method: str = None) -> np.ndarray:
+    """
+    Binary dilation of `mask` with `disk(radius)`.
+
+    A pixel is set if a foreground pixel lies within `radius`, which is exactly
+    `distance_transform_edt(~mask) <= radius`.
+    """
+    method = ZONING_METHOD if method is None else method
+
+    with profiling.span("dilation"):
+        if method == "footprint":
+            return dilation(mask, disk(radius))
+        elif method == "distance":
+            mask = mask.astype(bool)
+            if not mask.any():
+                return mask
+            return ndi.distance_transform_edt(np.invert(mask)) <= radius
+        else:
+            raise ValueError(f"Unknown zoning method: {method}")
+
 
 def _generate_outer_zone(
     mask: np.ndarray, largest_hole_mask: np.ndarray = None
@@ -27,17 +81,139 @@ def _generate_outer_zone(
         mask = mask + largest_hole_mask
 
     # outer_zone_mask = mask + largest_hole_mask
-    outer_zone_mask = np.invert(erosion(mask, disk(OUTER_ZONE_THICKNESS)))
+    outer_zone_mask = np.invert(_erode_disk(mask, OUTER_ZONE_THICKNESS))
     outer_zone_mask = np.logical_and(outer_zone_mask, mask)
     return outer_zone_mask
 
 
+def compute_distance_maps(
+    mask: np.ndarray, largest_hole_mask: np.ndarray = None
+) -> dict:
+    """
+    Computes the distance maps from which the zones of any thickness can be derived.
+
+    "boundary" is the signed distance to the ROI boundary, positive inside the ROI
+    (including the lumen) and negative outside. For apical-in ROIs, "lumen" is the
+    distance to the nearest lumen pixel, zero inside the lumen.
+    """
+    if largest_hole_mask is not None:
+        mask = mask + largest_hole_mask
+    mask = mask.astype(bool)
+
+    if mask.all():
+        boundary = np.full(mask.shape, np.inf, dtype=np.float32)
+    elif not mask.any():
+        boundary = np.full(mask.shape, -np.inf, dtype=np.float32)
+    else:
+        boundary = ndi.distance_transform_edt(mask) - ndi.distance_transform_edt(
+            np.invert(mask)
+        )
+    distances = {"boundary": boundary.astype(np.float32)}
+
+    if largest_hole_mask is not None:
+        largest_hole_mask = largest_hole_mask.astype(bool)
+        if largest_hole_mask.any():
+            lumen = ndi.distance_transform_edt(np.invert(largest_hole_mask))
+        else:
+            lumen = np.full(mask.shape, np.inf)
+        distances["lumen"] = lumen.astype(np.float32)
+
+    return distances
+
+
+def zones_from_distances(
+    mask: np.ndarray,
+    distances: dict,
+    outer_zone_thickness: int = None,
+    inner_zone_thickness: int = None,
+) -> dict:
+    """
+    Derives the zones for the given thicknesses by thresholding the distance maps
+    returned by `compute_distance_maps`. The zones are identical to those generated
+    by the zoners for the same thicknesses.
+    """
+    if outer_zone_thickness is None:
+        outer_zone_thickness = OUTER_ZONE_THICKNESS
+    if inner_zone_thickness is None:
+        inner_zone_thickness = INNER_ZONE_THICKNESS
+
+    boundary = distances["boundary"]
+    outer_zone = np.logical_and(boundary > 0, boundary <= outer_zone_thickness)
+    zones = {"outer": outer_zone}
+
+    if "lumen" in distances:
+        inner_zone = np.logical_and(distances["lumen"] <= inner_zone_thickness, mask)
+
+        overlap_mask = np.logical_and(outer_zone, inner_zone)
+        inner_zone[overlap_mask] = False
+        outer_zone[overlap_mask] = False
+        zones["inner"] = inner_zone
+
+    return zones
+
+
+def _save_distance_maps(
+    root: zarr.Group,
+    roi_path: str,
+    distances: dict,
+    stage: str,
+    inputs: dict,
+    parameters: dict,
+):
+    descriptions = {
+        "boundary": "Signed distance to the ROI boundary, positive inside",
+        "lumen": "Distance to the luminal space",
+    }
+
+    for name, distance_map in distances.items():
+        distance_dataset_path = f"{roi_path}/segmentation/distances/{name}"
+
+        if distance_dataset_path in root:
+            del root[distance_dataset_path]
+
+        distance_dataset = storage.create_dataset(
+            root, distance_dataset_path, distance_map, "distances"
+        )
+        distance_dataset.attrs.update(
+            {
+                "author": "Turku BioImaging",
+                "description": descriptions[name],
+                "unit": "pixels",
+            }
+        )
+        provenance.record(distance_dataset, distance_map, stage, inputs, parameters)
+
+
+def _overlay_crop(
+    root: zarr.Group,
+    roi_path: str,
+    zones: list,
+    raw_data: Optional[np.ndarray] = None,
+) -> tuple:
+    # outside the tissue and the zones the overlay is zero, as is the padded raw data
+    crop = cropping.tissue_crop(root, roi_path, raw_data=raw_data)
+    zones_bbox = cropping.bounding_box(np.logical_or.reduce(zones))
+    if zones_bbox is None:
+        return crop
+    return cropping.union(crop, zones_bbox)
+
+
 class ApicalOutZoner:
-    def __init__(self, zarr_path: str, mix: str, roi: str):
+    stage = "apical_out_zoning"
+    outputs = ["segmentation/zones/outer", "segmentation/zones/overlay"]
+
+    def __init__(
+        self,
+        zarr_path: str,
+        mix: str,
+        roi: str,
+        mask: Optional[np.ndarray] = None,
+        raw_data: Optional[np.ndarray] = None,
+    ):
         self.zarr_path = zarr_path
         self.mix = mix
         self.roi = roi
-        self.root = zarr.open(zarr_path, mode="a")
+        self.root = profiling.open_zarr(zarr_path, mode="a")
 
         self.roi_path = f"{self.mix}/apical_out/{self.roi}"
 
@@ -46,11 +222,52 @@ class ApicalOutZoner:
             self.roi_path in self.root
         ), f"ROI '{self.roi}' not found in mix '{self.mix}'"
 
-        self.mask = self.root[mix]["apical_out"][roi]["segmentation"]["mask"][:]
+        if mask is None:
+            mask = self.root[mix]["apical_out"][roi]["segmentation"]["mask"][:]
+        self.mask = mask
+        self.raw_data = raw_data
+
+    @staticmethod
+    def parameters() -> dict:
+        return {"outer_zone_thickness": OUTER_ZONE_THICKNESS}
+
+    @staticmethod
+    def _input_hashes(
+        root: zarr.Group,
+        roi_path: str,
+        mask: Optional[np.ndarray] = None,
+        raw_data: Optional[np.ndarray] = None,
+    ) -> dict:
+        segmentation = root[roi_path]["segmentation"]
+        return {
+            "mask": provenance.dataset_hash(segmentation["mask"], mask),
+            "raw_data": provenance.dataset_hash(root[roi_path]["raw_data"], raw_data),
+        }
+
+    @classmethod
+    def is_up_to_date(
+        cls, root: zarr.Group, mix: str, roi: str, save_distances: bool = False
+    ) -> bool:
+        roi_path = f"{mix}/apical_out/{roi}"
+        outputs = [f"{roi_path}/{output}" for output in cls.outputs]
+        if save_distances is True:
+            outputs.append(f"{roi_path}/segmentation/distances/boundary")
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: cls._input_hashes(root, roi_path),
+            cls.parameters(),
+        )
 
-    def generate(self):
+    @profiling.profiled_stage
+    def generate(self, save_distances: bool = False) -> dict:
         mask = self.mask
-        outer_zone_mask = _generate_outer_zone(mask)
+        inputs = self._input_hashes(self.root, self.roi_path, mask, self.raw_data)
+
+        # a one pixel border of background keeps the erosion identical to the full frame
+        crop = cropping.mask_crop(mask, 1)
+        outer_zone_mask = _generate_outer_zone(mask[crop])
+        outer_zone_mask = cropping.uncrop(outer_zone_mask, crop, mask.shape)
 
         outer_zone_dataset_path = (
             f"{self.mix}/apical_out/{self.roi}/segmentation/zones/outer"
@@ -59,8 +276,8 @@ class ApicalOutZoner:
         if outer_zone_dataset_path in self.root:
             del self.root[outer_zone_dataset_path]
 
-        outer_zone_dataset = self.root.create_dataset(
-            outer_zone_dataset_path, data=outer_zone_mask
+        outer_zone_dataset = storage.create_dataset(
+            self.root, outer_zone_dataset_path, outer_zone_mask, "mask"
         )
         outer_zone_dataset.attrs.update(
             {
@@ -71,8 +288,12 @@ class ApicalOutZoner:
                 "zone_thickness": OUTER_ZONE_THICKNESS,
             }
         )
+        provenance.record(
+            outer_zone_dataset, outer_zone_mask, self.stage, inputs, self.parameters()
+        )
 
-        overlay_img = self._generate_overlay(outer_zone_mask)
+        with profiling.span("overlay"):
+            overlay_img = self._generate_overlay(outer_zone_mask)
         overlay_dataset_path = (
             f"{self.mix}/apical_out/{self.roi}/segmentation/zones/overlay"
         )
@@ -80,8 +301,8 @@ class ApicalOutZoner:
         if overlay_dataset_path in self.root:
             del self.root[overlay_dataset_path]
 
-        overlay_dataset = self.root.create_dataset(
-            overlay_dataset_path, data=overlay_img
+        overlay_dataset = storage.create_dataset(
+            self.root, overlay_dataset_path, overlay_img, "overlay"
         )
         overlay_dataset.attrs.update(
             {
@@ -91,27 +312,64 @@ class ApicalOutZoner:
                 "roi": self.roi,
             }
         )
+        provenance.record(
+            overlay_dataset, overlay_img, self.stage, inputs, self.parameters()
+        )
+
+        zones = {"outer": outer_zone_mask}
+
+        if save_distances is True:
+            distances = compute_distance_maps(mask)
+            _save_distance_maps(
+                self.root,
+                self.roi_path,
+                distances,
+                self.stage,
+                inputs,
+                self.parameters(),
+            )
+            zones["distances"] = distances
+
+        return zones
 
     def _generate_overlay(self, outer_zone: np.ndarray, alpha=0.25):
-        raw_data = img_as_ubyte(
-            self.root[self.mix]["apical_out"][self.roi]["raw_data"][:]
-        )
+        crop = _overlay_crop(self.root, self.roi_path, [outer_zone], self.raw_data)
+        raw_data = self.raw_data
+        if raw_data is None:
+            raw_data = self.root[self.mix]["apical_out"][self.roi]["raw_data"][crop]
+        else:
+            raw_data = raw_data[crop]
 
         raw_data = img_as_ubyte(raw_data)
         raw_data = adjust_gamma(raw_data, 0.5)
 
-        rr, cc = np.where(outer_zone)
+        rr, cc = np.where(outer_zone[crop])
         set_color(raw_data, (rr, cc), [0, 255, 0], alpha=alpha)
 
-        return raw_data
+        return cropping.uncrop(raw_data, crop, outer_zone.shape)
 
 
 class ApicalInZoner:
-    def __init__(self, zarr_path: str, mix: str, roi: str):
+    stage = "apical_in_zoning"
+    outputs = [
+        "segmentation/zones/outer",
+        "segmentation/zones/inner",
+        "segmentation/zones/overlay",
+    ]
+
+    def __init__(
+        self,
+        zarr_path: str,
+        mix: str,
+        roi: str,
+        mask: Optional[np.ndarray] = None,
+        largest_hole_mask: Optional[np.ndarray] = None,
+        raw_data: Optional[np.ndarray] = None,
+    ):
         self.zarr_path = zarr_path
         self.mix = mix
         self.roi = roi
-        self.root = zarr.open(zarr_path, mode="a")
+        self.root = profiling.open_zarr(zarr_path, mode="a")
 
         self.roi_path = f"{self.mix}/apical_in/{self.roi}"
 
@@ -120,25 +378,93 @@ class ApicalInZoner:
             self.roi_path in self.root
         ), f"ROI '{self.roi}' not found in mix '{self.mix}'"
 
-        self.mask = self.root[mix]["apical_in"][roi]["segmentation"]["mask"][:]
-        self.largest_hole_mask = self.root[mix]["apical_in"][roi]["segmentation"][
-            "largest_hole"
-        ][:]
+        if mask is None:
+            mask = self.root[mix]["apical_in"][roi]["segmentation"]["mask"][:]
+        if largest_hole_mask is None:
+            largest_hole_mask = self.root[mix]["apical_in"][roi]["segmentation"][
+                "largest_hole"
+            ][:]
+        self.mask = mask
+        self.largest_hole_mask = largest_hole_mask
+        self.raw_data = raw_data
+
+    @staticmethod
+    def parameters() -> dict:
+        return {
+            "inner_zone_thickness": INNER_ZONE_THICKNESS,
+            "outer_zone_thickness": OUTER_ZONE_THICKNESS,
+        }
+
+    @staticmethod
+    def _input_hashes(
+        root: zarr.Group,
+        roi_path: str,
+        mask: Optional[np.ndarray] = None,
+        largest_hole_mask: Optional[np.ndarray] = None,
+        raw_data: Optional[np.ndarray] = None,
+    ) -> dict:
+        segmentation = root[roi_path]["segmentation"]
+        roi = os.path.basename(roi_path)
+        return {
+            "mask": provenance.dataset_hash(segmentation["mask"], mask),
+            "largest_hole": provenance.dataset_hash(
+                segmentation["largest_hole"], largest_hole_mask
+            ),
+            "raw_data": provenance.dataset_hash(root[roi_path]["raw_data"], raw_data),
+            "inner_manual": provenance.hash_file(
+                os.path.join(MANUAL_ROI_DIR, f"{roi}.tif")
+            ),
+        }
+
+    @classmethod
+    def is_up_to_date(
+        cls, root: zarr.Group, mix: str, roi: str, save_distances: bool = False
+    ) -> bool:
+        roi_path = f"{mix}/apical_in/{roi}"
+        outputs = [f"{roi_path}/{output}" for output in cls.outputs]
+        if save_distances is True:
+            outputs.append(f"{roi_path}/segmentation/distances/boundary")
+            outputs.append(f"{roi_path}/segmentation/distances/lumen")
+        return provenance.is_current(
+            root,
+            outputs,
+            lambda: cls._input_hashes(root, roi_path),
+            cls.parameters(),
+        )
+
+    @profiling.profiled_stage
+    def generate(
+        self, save_overlays: bool = True, save_distances: bool = False
+    ) -> dict:
+        inputs = self._input_hashes(
+            self.root,
+            self.roi_path,
+            self.mask,
+            self.largest_hole_mask,
+            self.raw_data,
+        )
 
-    def generate(self, save_overlays: bool = True):
+        # work on the bounding box of the ROI and its lumen, with a one pixel border of
+        # background that keeps the erosion and dilation identical to the full frame
+        crop = cropping.mask_crop(np.logical_or(self.mask, self.largest_hole_mask), 1)
+        mask = self.mask[crop]
+        largest_hole_mask = self.largest_hole_mask[crop]
 
         # create outer zone
-        outer_zone = _generate_outer_zone(self.mask, self.largest_hole_mask)
+        outer_zone = _generate_outer_zone(mask, largest_hole_mask)
 
         # create inner zone
-        inner_zone = dilation(self.largest_hole_mask, disk(INNER_ZONE_THICKNESS))
-        inner_zone = np.logical_and(inner_zone, self.mask)
+        inner_zone = _dilate_disk(largest_hole_mask, INNER_ZONE_THICKNESS)
+        inner_zone = np.logical_and(inner_zone, mask)
 
         # remove overlaps between outer and inner zones
         overlap_mask = np.logical_and(outer_zone, inner_zone)
         inner_zone[overlap_mask] = False
         outer_zone[overlap_mask] = False
 
+        outer_zone = cropping.uncrop(outer_zone, crop, self.mask.shape)
+        inner_zone = cropping.uncrop(inner_zone, crop, self.mask.shape)
+
         # clean existing datasets and create new ones
         outer_zone_dataset_path = (
             f"{self.mix}/apical_in/{self.roi}/segmentation/zones/outer"
@@ -146,8 +472,8 @@ class ApicalInZoner:
         if outer_zone_dataset_path in self.root:
             del self.root[outer_zone_dataset_path]
 
-        outer_zone_dataset = self.root.create_dataset(
-            outer_zone_dataset_path, data=outer_zone
+        outer_zone_dataset = storage.create_dataset(
+            self.root, outer_zone_dataset_path, outer_zone, "mask"
         )
         outer_zone_dataset.attrs.update(
             {
@@ -158,6 +484,9 @@ class ApicalInZoner:
                 "zone_thickness": OUTER_ZONE_THICKNESS,
             }
         )
+        provenance.record(
+            outer_zone_dataset, outer_zone, self.stage, inputs, self.parameters()
+        )
 
         inner_zone_dataset_path = (
             f"{self.mix}/apical_in/{self.roi}/segmentation/zones/inner"
@@ -166,8 +495,8 @@ class ApicalInZoner:
         if inner_zone_dataset_path in self.root:
             del self.root[inner_zone_dataset_path]
 
-        inner_zone_dataset = self.root.create_dataset(
-            inner_zone_dataset_path, data=inner_zone
+        inner_zone_dataset = storage.create_dataset(
+            self.root, inner_zone_dataset_path, inner_zone, "mask"
         )
         inner_zone_dataset.attrs.update(
             {
@@ -178,6 +507,9 @@ class ApicalInZoner:
                 "zone_thickness": INNER_ZONE_THICKNESS,
             }
         )
+        provenance.record(
+            inner_zone_dataset, inner_zone, self.stage, inputs, self.parameters()
+        )
 
         # If there is a mmanual roi for the inner zone, save it as well
         inner_zone_manual = self._get_manual_inner_zone()
@@ -191,8 +523,8 @@ class ApicalInZoner:
 
         if inner_zone_manual is not None:
 
-            inner_zone_manual_dataset = self.root.create_dataset(
-                inner_zone_manual_dataset_path, data=inner_zone_manual
+            inner_zone_manual_dataset = storage.create_dataset(
+                self.root, inner_zone_manual_dataset_path, inner_zone_manual, "mask"
             )
             inner_zone_manual_dataset.attrs.update(
                 {
@@ -202,9 +534,17 @@ class ApicalInZoner:
                     "roi": self.roi,
                 }
             )
+            provenance.record(
+                inner_zone_manual_dataset,
+                inner_zone_manual,
+                self.stage,
+                inputs,
+                self.parameters(),
+            )
 
         if save_overlays is True:
-            overlay_img = self._generate_overlays(outer_zone, inner_zone)
+            with profiling.span("overlay"):
+                overlay_img = self._generate_overlays(outer_zone, inner_zone)
 
             overlay_dataset_path = (
                 f"{self.mix}/apical_in/{self.roi}/segmentation/zones/overlay"
@@ -213,8 +553,8 @@ class ApicalInZoner:
             if overlay_dataset_path in self.root:
                 del self.root[overlay_dataset_path]
 
-            overlay_dataset = self.root.create_dataset(
-                overlay_dataset_path, data=overlay_img
+            overlay_dataset = storage.create_dataset(
+                self.root, overlay_dataset_path, overlay_img, "overlay"
             )
             overlay_dataset.attrs.update(
                 {
@@ -224,6 +564,29 @@ class ApicalInZoner:
                     "roi": self.roi,
                 }
             )
+            provenance.record(
+                overlay_dataset, overlay_img, self.stage, inputs, self.parameters()
+            )
+
+        zones = {
+            "outer": outer_zone,
+            "inner": inner_zone,
+            "inner_manual": inner_zone_manual,
+        }
+
+        if save_distances is True:
+            distances = compute_distance_maps(self.mask, self.largest_hole_mask)
+            _save_distance_maps(
+                self.root,
+                self.roi_path,
+                distances,
+                self.stage,
+                inputs,
+                self.parameters(),
+            )
+            zones["distances"] = distances
+
+        return zones
 
     def _get_manual_inner_zone(self) -> Optional[np.ndarray]:
         manual_inner_zone_paths = glob(os.path.join(MANUAL_ROI_DIR, "*.tif"))
@@ -242,17 +605,22 @@ class ApicalInZoner:
         self, outer_zone: np.ndarray, inner_zone: np.ndarray, alpha=0.25
     ):
 
-        raw_data = img_as_ubyte(
-            self.root[self.mix]["apical_in"][self.roi]["raw_data"][:]
+        crop = _overlay_crop(
+            self.root, self.roi_path, [outer_zone, inner_zone], self.raw_data
         )
+        raw_data = self.raw_data
+        if raw_data is None:
+            raw_data = self.root[self.mix]["apical_in"][self.roi]["raw_data"][crop]
+        else:
+            raw_data = raw_data[crop]
 
         raw_data = img_as_ubyte(raw_data)
         raw_data = adjust_gamma(raw_data, 0.5)
 
-        rr, cc = np.where(outer_zone)
+        rr, cc = np.where(outer_zone[crop])
         set_color(raw_data, (rr, cc), [0, 255, 0], alpha=alpha)
 
-        rr, cc = np.where(inner_zone)
+        rr, cc = np.where(inner_zone[crop])
         set_color(raw_data, (rr, cc), [255, 0, 0], alpha=alpha)
 
-        return raw_data
+        return cropping.uncrop(raw_data, crop, outer_zone.shape)
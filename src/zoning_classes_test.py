@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import zarr
+from skimage.draw import disk as draw_disk
+from skimage.morphology import dilation, disk, erosion
+
+import zoning_classes
+from zoning_classes import (
+    ApicalInZoner,
+    _dilate_disk,
+    _erode_disk,
+    compute_distance_maps,
+    zones_from_distances,
+)
+
+
+def _random_mask(shape, n_blobs, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=bool)
+    for _ in range(n_blobs):
+        center = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        radius = rng.integers(5, 60)
+        rr, cc = draw_disk(center, radius, shape=shape)
+        mask[rr, cc] = True
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("radius", [1, 7, 45])
+def test_distance_erosion_matches_footprint(seed, radius):
+    mask = _random_mask((257, 301), 12, seed)
+    assert np.array_equal(
+        _erode_disk(mask, radius, "distance"), erosion(mask, disk(radius))
+    )
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("radius", [1, 7, 45])
+def test_distance_dilation_matches_footprint(seed, radius):
+    mask = _random_mask((257, 301), 3, seed)
+    assert np.array_equal(
+        _dilate_disk(mask, radius, "distance"), dilation(mask, disk(radius))
+    )
+
+
+def test_distance_morphology_edge_cases():
+    full = np.ones((50, 60), dtype=bool)
+    empty = np.zeros((50, 60), dtype=bool)
+    assert np.array_equal(_erode_disk(full, 45, "distance"), erosion(full, disk(45)))
+    assert np.array_equal(
+        _dilate_disk(empty, 45, "distance"), dilation(empty, disk(45))
+    )
+
+
+def _apical_in_store(tmp_path):
+    shape = (400, 420)
+    yy, xx = np.mgrid[: shape[0], : shape[1]]
+    radius = np.hypot(yy - 200, xx - 190)
+    hole = radius < 60
+    mask = (radius < 170) & ~hole
+
+    zarr_path = str(tmp_path / "roi_data.zarr")
+    root = zarr.open(zarr_path, mode="w")
+    roi_path = "mix_1/apical_in/231019_mix1_8_in_1"
+    root.create_dataset(f"{roi_path}/raw_data", data=np.zeros(shape + (3,), np.uint16))
+    root.create_dataset(f"{roi_path}/segmentation/mask", data=mask)
+    root.create_dataset(f"{roi_path}/segmentation/largest_hole", data=hole)
+    return zarr_path
+
+
+def test_apical_in_zones_match_footprint(tmp_path, monkeypatch):
+    zarr_path = _apical_in_store(tmp_path)
+
+    zones = {}
+    for method in ["footprint", "distance"]:
+        monkeypatch.setattr(zoning_classes, "ZONING_METHOD", method)
+        zoner = ApicalInZoner(zarr_path, "mix_1", "231019_mix1_8_in_1")
+        zones[method] = zoner.generate(save_overlays=False)
+
+    assert np.array_equal(zones["footprint"]["outer"], zones["distance"]["outer"])
+    assert np.array_equal(zones["footprint"]["inner"], zones["distance"]["inner"])
+
+
+@pytest.mark.parametrize("thickness", [10, 45, 80])
+def test_zones_from_distances_match_zoner(tmp_path, monkeypatch, thickness):
+    zarr_path = _apical_in_store(tmp_path)
+    monkeypatch.setattr(zoning_classes, "INNER_ZONE_THICKNESS", thickness)
+    monkeypatch.setattr(zoning_classes, "OUTER_ZONE_THICKNESS", thickness)
+
+    zoner = ApicalInZoner(zarr_path, "mix_1", "231019_mix1_8_in_1")
+    zones = zoner.generate(save_overlays=False)
+
+    distances = compute_distance_maps(zoner.mask, zoner.largest_hole_mask)
+    swept = zones_from_distances(zoner.mask, distances, thickness, thickness)
+
+    assert np.array_equal(zones["outer"], swept["outer"])
+    assert np.array_equal(zones["inner"], swept["inner"])